@@ -0,0 +1,108 @@
+import os
+import glob
+from threading import Lock
+
+# Tracks which cpu cores each job container holds and hands out the least loaded cores,
+# keeping a job's cores on one NUMA node when it fits there.
+# load of a core = number of live containers whose cpuset includes it.
+
+NODE_CPULIST_GLOB = '/sys/devices/system/node/node*/cpulist'
+
+
+def parse_cpulist(cpulist):
+    # '0-3,8-11' -> [0, 1, 2, 3, 8, 9, 10, 11]
+    cpus = []
+    for part in cpulist.strip().split(','):
+        if part == '':
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def numa_nodes(cpu_count):
+    # cores 0..cpu_count-1 grouped by NUMA node, one node when the host does not expose its topology
+    nodes = []
+    for path in sorted(glob.glob(NODE_CPULIST_GLOB), key=lambda path: int(os.path.basename(os.path.dirname(path))[4:])):
+        try:
+            with open(path) as cpulist_file:
+                cpus = [cpu for cpu in parse_cpulist(cpulist_file.read()) if cpu < cpu_count]
+        except (OSError, ValueError):
+            return [list(range(cpu_count))]
+        if len(cpus) > 0:
+            nodes.append(cpus)
+    covered = set(cpu for cpus in nodes for cpu in cpus)
+    missing = [cpu for cpu in range(cpu_count) if cpu not in covered]
+    if len(missing) > 0:
+        nodes.append(missing)
+    return nodes
+
+
+class CoreAllocator:
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.lock = Lock()
+        self.load = {cpu: 0 for cpus in nodes for cpu in cpus}
+        self.holders = {} # owner -> cpus it holds
+        self.stats = {'allocations': 0, 'releases': 0, 'spanning': 0, 'oversubscribed': 0}
+
+    def allocate(self, owner, count):
+        # reserve count cores for owner and return them. prefers a node that fits all of them,
+        # then the node whose least loaded count cores carry the least load, then the least loaded node
+        with self.lock:
+            if owner in self.holders:
+                return list(self.holders[owner])
+            count = max(1, min(count, len(self.load)))
+            ranked = sorted(range(len(self.nodes)), key=lambda index: self.node_rank(index, count))
+            cpus = []
+            for index in ranked:
+                free = sorted(self.nodes[index], key=lambda cpu: (self.load[cpu], cpu))
+                cpus.extend(free[:count - len(cpus)])
+                if len(cpus) == count:
+                    break
+            self.hold_locked(owner, cpus)
+            self.stats['allocations'] += 1
+            if ranked and len(cpus) > len(self.nodes[ranked[0]]):
+                self.stats['spanning'] += 1
+            if any(self.load[cpu] > 1 for cpu in cpus):
+                self.stats['oversubscribed'] += 1
+            return sorted(cpus)
+
+    def node_rank(self, index, count):
+        loads = sorted(self.load[cpu] for cpu in self.nodes[index])
+        return (len(loads) < count, sum(loads[:count]), sum(loads), index)
+
+    def hold(self, owner, cpus):
+        # account cores owner already runs on, e.g. a released container that docker restarted
+        with self.lock:
+            if owner not in self.holders:
+                self.hold_locked(owner, [cpu for cpu in cpus if cpu in self.load])
+
+    def hold_locked(self, owner, cpus):
+        self.holders[owner] = cpus
+        for cpu in cpus:
+            self.load[cpu] += 1
+
+    def release(self, owner):
+        with self.lock:
+            cpus = self.holders.pop(owner, None)
+            if cpus is None:
+                return
+            for cpu in cpus:
+                self.load[cpu] -= 1
+            self.stats['releases'] += 1
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['holders'] = len(self.holders)
+            stats['node_loads'] = [sum(self.load[cpu] for cpu in cpus) for cpus in self.nodes]
+            stats['max_core_load'] = max(self.load.values()) if self.load else 0
+        return stats
+
+
+def cpuset_str(cpus):
+    return ','.join(str(cpu) for cpu in cpus)
@@ -0,0 +1,73 @@
+import time
+import random
+import docker
+import psutil
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from core_allocator import CoreAllocator, numa_nodes, cpuset_str
+
+# Throughput of co-scheduled cpu-bound jobs on this host with the old random cpuset per job
+# versus cores handed out by CoreAllocator. Each job is a busy loop pinned to --cpus cores,
+# --jobs of them run at once, and the run is repeated --rounds times per placement.
+# usage: python cpuset_bench.py [--image busybox:latest] [--jobs 8] [--cpus 1] [--loops 2000000]
+
+BUSY_LOOP = 'i=0; while [ $i -lt %d ]; do i=$((i+1)); done'
+
+
+def random_placement(cpu_count):
+    def place(job_id, count):
+        cpus = list(range(cpu_count))
+        random.shuffle(cpus)
+        return cpus[:count]
+    return place, lambda job_id: None
+
+
+def allocator_placement(cpu_count):
+    allocator = CoreAllocator(numa_nodes(cpu_count))
+    return allocator.allocate, allocator.release
+
+
+def run_job(docker_client, image, command, cpus):
+    container = docker_client.containers.run(image, ['sh', '-c', command], cpuset_cpus=cpuset_str(cpus), detach=True)
+    try:
+        container.wait()
+    finally:
+        container.remove(force=True)
+
+
+def run_round(docker_client, args, place, release):
+    command = BUSY_LOOP % args.loops
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = []
+        for i in range(args.jobs):
+            job_id = 'job-%d' % i
+            cpus = place(job_id, args.cpus)
+            futures.append(executor.submit(run_job, docker_client, args.image, command, cpus))
+            futures[-1].add_done_callback(lambda future, job_id=job_id: release(job_id))
+        for future in futures:
+            future.result()
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='random vs allocated cpuset benchmark')
+    parser.add_argument('--image', default='busybox:latest', type=str)
+    parser.add_argument('--jobs', default=0, type=int, help='concurrent jobs, default one per physical core')
+    parser.add_argument('--cpus', default=1, type=int, help='cores per job')
+    parser.add_argument('--loops', default=2000000, type=int, help='busy loop iterations per job')
+    parser.add_argument('--rounds', default=3, type=int)
+    args = parser.parse_args()
+    cpu_count = psutil.cpu_count(logical=False)
+    if args.jobs <= 0:
+        args.jobs = max(1, cpu_count // args.cpus)
+    docker_client = docker.from_env()
+    docker_client.images.pull(args.image)
+    print('%d cores, %d NUMA nodes, %d jobs x %d cores, %d rounds' % (cpu_count, len(numa_nodes(cpu_count)), args.jobs, args.cpus, args.rounds))
+    for name, placement in [('random', random_placement), ('allocator', allocator_placement)]:
+        durations = []
+        for i in range(args.rounds):
+            place, release = placement(cpu_count)
+            durations.append(run_round(docker_client, args, place, release))
+        mean = sum(durations) / len(durations)
+        print('%-10s makespan mean %.2f s  max %.2f s  %.2f jobs/s' % (name, mean, max(durations), args.jobs / mean))
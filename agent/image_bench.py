@@ -0,0 +1,47 @@
+import time
+import docker
+import argparse
+from docker.errors import ImageNotFound
+
+# Job start latency on this host for a cold placement (image not present, pulled by containers.run
+# as on an agent without it) versus a warm one (image already local, as on an agent picked by
+# image-locality placement or after prepull_image).
+# usage: python image_bench.py [--image busybox:latest] [--runs 5]
+
+
+def remove_image(docker_client, image):
+    try:
+        docker_client.images.remove(image, force=True)
+    except ImageNotFound:
+        pass
+
+
+def start_latency(docker_client, image):
+    # seconds from the run call until the container is running, containers.run pulls a missing image
+    start = time.time()
+    container = docker_client.containers.run(image, 'sleep 5', detach=True)
+    try:
+        while True:
+            container.reload()
+            if container.status != 'created':
+                return time.time() - start
+            time.sleep(0.005)
+    finally:
+        container.remove(force=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='cold vs warm job start benchmark')
+    parser.add_argument('--image', default='busybox:latest', type=str)
+    parser.add_argument('--runs', default=5, type=int)
+    args = parser.parse_args()
+    docker_client = docker.from_env()
+    cold = []
+    warm = []
+    for i in range(args.runs):
+        remove_image(docker_client, args.image)
+        cold.append(start_latency(docker_client, args.image))
+        warm.append(start_latency(docker_client, args.image))
+    print('image %s, %d runs' % (args.image, args.runs))
+    print('cold start  mean %.3f s  max %.3f s' % (sum(cold) / len(cold), max(cold)))
+    print('warm start  mean %.3f s  max %.3f s' % (sum(warm) / len(warm), max(warm)))
@@ -1,34 +1,108 @@
+import os
 import re
+import json
 import time
+import bisect
+import uuid
 import http
 import docker
 import socket
 import psutil
-import random
 import xmlrpc.client
 import xmlrpc.server
-from threading import Thread
-from docker.errors import APIError, ImageNotFound
+import msgpack_rpc
+from threading import Thread, Lock, Event
+from collections import OrderedDict, deque
+from docker.errors import APIError, ImageNotFound, NotFound
 from arg_parser import get_parser
+from warm_pool import WarmPool
+from core_allocator import CoreAllocator, numa_nodes, cpuset_str
+from metrics import registry, TimedLock, MetricsRequestHandler, instrument_rpc_server
+from rpc_server import PooledXMLRPCServer
 
 # Agent Configuration
 MAX_RETRY = 5
 AGENT_IP = 'localhost'
 AGENT_PORT = 8001
+RPC_SERVER_MODE = 'threaded' # 'threaded' serves requests on a worker pool, 'serial' one at a time
+RPC_WORKERS = 16 # max requests handled concurrently in threaded mode, idle keep-alive connections are parked and hold none
+RPC_REQUEST_TIMEOUT = 60 # seconds, socket timeout for reading a request and writing its response
+RPC_KEEPALIVE_TIMEOUT = 5 # seconds an idle keep-alive connection is held open in threaded mode
+RPC_TRANSPORT = 'xmlrpc' # 'msgpack' also serves the rpc methods as msgpack frames on MSGPACK_PORT, falls back to xml-rpc without msgpack
+MSGPACK_PORT = 8002
+EVENTS_RETRY_DELAY = 1 # seconds before reconnecting to a broken docker events stream
+SAMPLE_INTERVAL = 1 # seconds between host cpu/memory samples
+CONTAINER_SAMPLE_INTERVAL = 5 # seconds between per-container usage samples
+CONTAINER_PEAK_WINDOW = 12 # number of recent container samples the reported per-job peaks cover
+USAGE_EMA_ALPHA = 0.3 # weight of the newest sample in the usage moving averages
+PEAK_WINDOW = 60 # number of recent host samples the reported peaks cover
+LOG_CHUNK_SIZE = 1024 * 1024 # default bytes returned by one stream_output_chunk call
+MAX_LOG_CHUNK_SIZE = 8 * 1024 * 1024 # upper bound on max_bytes and tail
+LOG_CHECKPOINT_BYTES = 1024 * 1024 # log bytes between two json log file offsets a log cursor remembers
+LOG_CURSORS = 1024 # containers whose log cursor is kept, least recently read ones are dropped first
+# docker container events that can change the status or restart count of a job
+STATE_EVENTS = ['create', 'start', 'restart', 'die', 'oom', 'pause', 'unpause', 'destroy']
+# docker image events that can change the set of local images
+IMAGE_EVENTS = ['pull', 'tag', 'untag', 'delete', 'load', 'import']
+PUSH_COALESCE_DELAY = 0.05 # seconds state changes are gathered before one report is pushed to the master
+PUSH_RETRY_DELAY = 1 # seconds before retrying a report the master did not take
+WARM_POOL_SIZE = 0 # idle pre-created containers kept per hot image, 0 disables the warm pool
+WARM_POOL_IMAGES = 4 # most recently submitted (image, memory, restart) combinations kept warm
 
 # Global Variables
 docker_client = docker.from_env()
 agent_cpu = psutil.cpu_count(logical=False)
 agent_memory = int(psutil.virtual_memory().total / (1024**3))
+core_allocator = CoreAllocator(numa_nodes(agent_cpu)) # cores held by each job's container
+job_cpus = {} # job_id -> cores its container was given, kept to re-account a restarted container
 agent_jobs = {}
+agent_jobs_lock = TimedLock('agent_jobs_lock')
+launching_jobs = set() # job ids whose container is being created
+killed_jobs = set() # job ids whose container was killed and may not have exited yet
+job_states = OrderedDict() # job_id -> {'status': str, 'restart_count': int, 'seq': int}, ordered by seq
+state_seq = 0 # bumped on every job state change, heartbeats report changes since a given seq
+agent_epoch = str(uuid.uuid4()) # new on every agent start, tells the master its seq is from another run
+# rolling usage maintained by the resource sampler thread, heartbeats only read it
+resource_usage = {'cpu_usage': 0.0, 'memory_usage': 0.0, 'cpu_peak': 0.0, 'memory_peak': 0.0}
+job_usage = {} # job_id -> {'cpu', 'memory', 'cpu_peak', 'memory_peak'} in percent, per running container
+container_windows = {} # job_id -> (cpu window, memory window, previous (container cpu total, system cpu total))
+resource_lock = TimedLock('resource_lock')
+container_jobs = {} # container id -> job_id
+# container id -> {'path', 'file_offset', 'position', 'checkpoints', 'lock'}, or None when the
+# container's log can not be read from its json log file. see read_log_chunk
+log_cursors = OrderedDict()
+log_cursors_lock = Lock()
+agent_id = None # assigned by the master at registration
+master_proxy = None
+state_changed = Event() # set on every job state change, wakes the state pusher
+acked_seq = None # last seq the master acknowledged for agent_epoch, None before the first (full) report
+local_images = [] # [{'refs': [tags and repo digests], 'id': str, 'size': int}]
+images_version = None # changes whenever local_images does, heartbeats only carry the images on a change
+images_lock = TimedLock('images_lock')
+warm_pool = None # WarmPool when WARM_POOL_SIZE > 0
+# submit to running container, split by whether the container came from the warm pool
+job_start_stats = {'pooled': 0, 'cold': 0, 'pooled_seconds': 0.0, 'cold_seconds': 0.0, 'max_seconds': 0.0}
+job_start_lock = Lock()
+# hot path timings for GET /metrics and get_metrics
+docker_run_seconds = registry.histogram('docker_run_seconds', 'containers.run of a job without a pooled container')
+job_start_seconds = registry.histogram('job_start_seconds', 'submit_job until the container runs', ('source',))
+container_inspect_seconds = registry.histogram('container_inspect_seconds', 'container reload in check_job')
+log_fetch_seconds = registry.histogram('log_fetch_seconds', 'docker log reads', ('kind',))
+registry.gauge('jobs_tracked', 'jobs with a container on this agent', lambda: len(agent_jobs))
+registry.gauge('state_seq', 'job state changes since the agent started', lambda: state_seq)
 
 # psutil bug fix: first call to cpu_percent will return 0
 psutil.cpu_percent(interval=None)
 
 # Internal Methods
-def check_job(job_id):
-    job_container = agent_jobs[job_id]
-    job_container.reload()
+def get_job_container(job_id):
+    with agent_jobs_lock:
+        if job_id not in agent_jobs:
+            raise xmlrpc.client.Fault(1, 'job not exist')
+        return agent_jobs[job_id]
+
+
+def container_job_state(job_container):
     container_status = job_container.status
     container_attrs = job_container.attrs
     job_restart_count = container_attrs['RestartCount']
@@ -50,72 +124,539 @@ def check_job(job_id):
     return job_status, job_restart_count
 
 
+def check_job(job_id):
+    # inspect the container of a job and store its state in job_states
+    job_container = get_job_container(job_id)
+    try:
+        with container_inspect_seconds.time():
+            job_container.reload()
+        job_status, job_restart_count = container_job_state(job_container)
+    except NotFound:
+        # container removed behind our back
+        job_status, job_restart_count = 'fail', job_states[job_id]['restart_count']
+    with agent_jobs_lock:
+        set_job_state(job_id, job_status, job_restart_count)
+    return job_status, job_restart_count
+
+
+def set_job_state(job_id, job_status, job_restart_count):
+    # agent_jobs_lock held. only real changes get a new seq
+    global state_seq
+    job_state = job_states.get(job_id)
+    if job_state is not None and job_state['status'] == job_status and job_state['restart_count'] == job_restart_count:
+        return
+    # terminal containers free their cores, docker restarting one takes the same cores again
+    if job_status in ['end', 'fail']:
+        core_allocator.release(job_id)
+        killed_jobs.discard(job_id)
+    elif job_id in job_cpus:
+        core_allocator.hold(job_id, job_cpus[job_id])
+    state_seq += 1
+    job_states[job_id] = {'status': job_status, 'restart_count': job_restart_count, 'seq': state_seq}
+    job_states.move_to_end(job_id)
+    state_changed.set()
+
+
+def job_state_changes(since_seq, epoch):
+    # the jobs whose state changed after since_seq, or all jobs (full resync) when since_seq
+    # is None or belongs to an earlier run of this agent. returns (job_attrs_list, seq, full)
+    job_attrs_list = []
+    with agent_jobs_lock:
+        full = since_seq is None or epoch != agent_epoch or since_seq > state_seq
+        for job_id in reversed(job_states):
+            job_state = job_states[job_id]
+            if not full and job_state['seq'] <= since_seq:
+                break
+            job_attrs = {}
+            job_attrs['job_id'] = job_id
+            job_attrs['status'] = job_state['status']
+            job_attrs['restart_count'] = job_state['restart_count']
+            job_attrs_list.append(job_attrs)
+        return job_attrs_list, state_seq, full
+
+
+def push_job_states():
+    # push state changes to the master as they happen, each report covers everything after
+    # the seq the master last acknowledged, so a lost report is repeated by the next one
+    global acked_seq
+    while True:
+        state_changed.wait()
+        time.sleep(PUSH_COALESCE_DELAY)
+        state_changed.clear()
+        job_attrs_list, seq, full = job_state_changes(acked_seq, agent_epoch)
+        if not full and len(job_attrs_list) == 0:
+            continue
+        report = {'epoch': agent_epoch, 'since_seq': None if full else acked_seq, 'seq': seq, 'full': full, 'job_attrs_list': job_attrs_list}
+        try:
+            ack = master_proxy.report_job_states(agent_id, report)
+        except (xmlrpc.client.Fault, xmlrpc.client.ProtocolError, http.client.HTTPException, OSError) as err:
+            print("state push error:", str(err))
+            time.sleep(PUSH_RETRY_DELAY)
+            state_changed.set()
+            continue
+        # the master answers with the seq it holds for us; another epoch or None means resend in full
+        acked_seq = ack['acked_seq'] if ack['epoch'] == agent_epoch else None
+        if acked_seq is None or acked_seq < seq:
+            state_changed.set()
+
+
+def start_state_pusher():
+    pusher_thread = Thread(target=push_job_states)
+    pusher_thread.setDaemon(True)
+    pusher_thread.start()
+    return pusher_thread
+
+
+def track_job(job_id, job_container):
+    with agent_jobs_lock:
+        agent_jobs[job_id] = job_container
+        container_jobs[job_container.id] = job_id
+        set_job_state(job_id, 'deploying', 0)
+
+
+def image_record(image):
+    return {'refs': image.tags + image.attrs.get('RepoDigests', []), 'id': image.id, 'size': image.attrs.get('Size', 0)}
+
+
+def refresh_images():
+    global local_images, images_version
+    images = [image_record(image) for image in docker_client.images.list()]
+    with images_lock:
+        if images != local_images:
+            local_images = images
+            images_version = str(uuid.uuid4())
+
+
+def handle_container_event(event):
+    if event.get('Type') == 'image':
+        if event.get('Action') in IMAGE_EVENTS:
+            refresh_images()
+        return
+    action = event.get('Action', event.get('status', ''))
+    # exec_start etc. carry a suffix after a colon
+    if action.split(':')[0] not in STATE_EVENTS:
+        return
+    with agent_jobs_lock:
+        job_id = container_jobs.get(event.get('id'))
+    if job_id is not None:
+        # one inspect per state change instead of one per job per heartbeat
+        check_job(job_id)
+
+
+def watch_container_events():
+    # keep job_states in sync with docker; after every (re)connect all jobs are inspected once
+    # so that changes missed while the stream was down are not lost
+    while True:
+        try:
+            since = int(time.time())
+            with agent_jobs_lock:
+                job_ids = list(agent_jobs)
+            for job_id in job_ids:
+                check_job(job_id)
+            refresh_images()
+            for event in docker_client.events(since=since, decode=True, filters={'type': ['container', 'image']}):
+                handle_container_event(event)
+        except Exception as err:
+            print("docker events stream error:", str(err))
+        time.sleep(EVENTS_RETRY_DELAY)
+
+
+def start_events_watcher():
+    events_thread = Thread(target=watch_container_events)
+    events_thread.setDaemon(True)
+    events_thread.start()
+    return events_thread
+
+
+def moving_average(previous, sample):
+    if previous is None:
+        return sample
+    return previous + USAGE_EMA_ALPHA * (sample - previous)
+
+
+def sample_container_usage(job_id, job_container):
+    # one-shot stats read, cpu percent is computed against our own previous sample of the container
+    stats = job_container.stats(stream=False, one_shot=True)
+    cpu_stats = stats.get('cpu_stats', {})
+    cpu_total = cpu_stats.get('cpu_usage', {}).get('total_usage', 0)
+    system_total = cpu_stats.get('system_cpu_usage', 0)
+    online_cpus = cpu_stats.get('online_cpus', 1)
+    cpu_window, memory_window, previous = container_windows.get(job_id, (deque(maxlen=CONTAINER_PEAK_WINDOW), deque(maxlen=CONTAINER_PEAK_WINDOW), None))
+    container_windows[job_id] = (cpu_window, memory_window, (cpu_total, system_total))
+    memory_stats = stats.get('memory_stats', {})
+    memory_percent = 0.0
+    if memory_stats.get('limit'):
+        memory_percent = memory_stats.get('usage', 0) / memory_stats['limit'] * 100
+    memory_window.append(memory_percent)
+    # a container that replaced the job's previous one starts its cpu total over
+    if previous is None or system_total <= previous[1] or cpu_total < previous[0]:
+        return None, memory_percent
+    cpu_percent = (cpu_total - previous[0]) / (system_total - previous[1]) * online_cpus * 100
+    cpu_window.append(cpu_percent)
+    return cpu_percent, memory_percent
+
+
+def sample_containers():
+    with agent_jobs_lock:
+        running = [(job_id, agent_jobs[job_id]) for job_id, job_state in job_states.items() if job_state['status'] == 'running' and job_id in agent_jobs]
+    running_ids = set()
+    for job_id, job_container in running:
+        running_ids.add(job_id)
+        try:
+            cpu_percent, memory_percent = sample_container_usage(job_id, job_container)
+        except (APIError, NotFound):
+            continue
+        cpu_window, memory_window = container_windows[job_id][:2]
+        with resource_lock:
+            usage = job_usage.setdefault(job_id, {'cpu': None, 'memory': None, 'cpu_peak': None, 'memory_peak': None})
+            if cpu_percent is not None:
+                usage['cpu'] = moving_average(usage['cpu'], cpu_percent)
+                usage['cpu_peak'] = max(cpu_window)
+            usage['memory'] = moving_average(usage['memory'], memory_percent)
+            usage['memory_peak'] = max(memory_window)
+    # forget jobs that stopped running
+    with resource_lock:
+        for job_id in list(job_usage):
+            if job_id not in running_ids:
+                del job_usage[job_id]
+    for job_id in list(container_windows):
+        if job_id not in running_ids:
+            del container_windows[job_id]
+
+
+def sample_resources():
+    # background sampler, keeps heartbeats free of blocking cpu_percent(interval) calls.
+    # host usage every SAMPLE_INTERVAL, running containers every CONTAINER_SAMPLE_INTERVAL
+    cpu_window = deque(maxlen=PEAK_WINDOW)
+    memory_window = deque(maxlen=PEAK_WINDOW)
+    cpu_average = None
+    memory_average = None
+    last_container_sample = 0
+    while True:
+        time.sleep(SAMPLE_INTERVAL)
+        cpu_percent = psutil.cpu_percent(interval=None)
+        memory_percent = psutil.virtual_memory()[2]
+        cpu_window.append(cpu_percent)
+        memory_window.append(memory_percent)
+        cpu_average = moving_average(cpu_average, cpu_percent)
+        memory_average = moving_average(memory_average, memory_percent)
+        with resource_lock:
+            resource_usage['cpu_usage'] = cpu_average
+            resource_usage['memory_usage'] = memory_average
+            resource_usage['cpu_peak'] = max(cpu_window)
+            resource_usage['memory_peak'] = max(memory_window)
+        if time.time() - last_container_sample >= CONTAINER_SAMPLE_INTERVAL:
+            last_container_sample = time.time()
+            try:
+                sample_containers()
+            except Exception as err:
+                print("container sampling error:", str(err))
+
+
+def start_resource_sampler():
+    sampler_thread = Thread(target=sample_resources)
+    sampler_thread.setDaemon(True)
+    sampler_thread.start()
+    return sampler_thread
+
+
 """
 RPC Methods
 """
-def rpc_heartbeat():
-    cpu_percentage = psutil.cpu_percent(interval=True)
-    memory_percentage = psutil.virtual_memory()[2]
-    job_attrs_list = []
-    for job_id in agent_jobs:
-        job_attrs = {}
-        job_attrs['job_id'] = job_id
-        job_attrs['status'], job_attrs['restart_count'] = check_job(job_id)
-        job_attrs_list.append(job_attrs)
+def record_job_start(pooled, seconds):
+    kind = 'pooled' if pooled else 'cold'
+    job_start_seconds.labels(kind).observe(seconds)
+    with job_start_lock:
+        job_start_stats[kind] += 1
+        job_start_stats[kind + '_seconds'] += seconds
+        job_start_stats['max_seconds'] = max(job_start_stats['max_seconds'], seconds)
+
+
+def get_job_start_stats():
+    with job_start_lock:
+        stats = dict(job_start_stats)
+    if warm_pool is not None:
+        stats['warm_pool'] = warm_pool.get_stats()
+    return stats
+
+
+def start_warm_pool():
+    global warm_pool
+    if WARM_POOL_SIZE <= 0:
+        return None
+    warm_pool = WarmPool(docker_client, WARM_POOL_SIZE, WARM_POOL_IMAGES, '0-%d' % (agent_cpu - 1))
+    return warm_pool.start()
+
+
+def start_pooled_container(job_container, usable_cpu_str):
+    # give a pooled container the job's cpuset and start it, False if it is unusable
+    try:
+        job_container.update(cpuset_cpus=usable_cpu_str)
+        job_container.start()
+    except (APIError, NotFound) as err:
+        print("warm pool container unusable:", str(err))
+        warm_pool.discard([job_container])
+        return False
+    return True
+
+
+def rpc_heartbeat(since_seq=None, epoch=None, known_images_version=None):
+    # liveness probe and usage report. job states are pushed by push_job_states, the heartbeat
+    # still carries the changes after since_seq in case a push was lost, usually none.
+    # answered from the events-driven cache, no docker api calls
+    job_attrs_list, current_seq, full = job_state_changes(since_seq, epoch)
     pulse_data = {}
-    pulse_data['cpu_usage'] = cpu_percentage
-    pulse_data['memory_usage'] = memory_percentage
+    with resource_lock:
+        # moving averages and recent peaks from the resource sampler
+        pulse_data.update(resource_usage)
+        # per running job, once its container has two cpu samples
+        pulse_data['job_usage'] = {job_id: dict(usage) for job_id, usage in job_usage.items() if usage['cpu'] is not None}
     pulse_data['job_attrs_list'] = job_attrs_list
+    pulse_data['epoch'] = agent_epoch
+    pulse_data['since_seq'] = None if full else since_seq
+    pulse_data['seq'] = current_seq
+    pulse_data['full'] = full
+    with images_lock:
+        pulse_data['images_version'] = images_version
+        if known_images_version != images_version:
+            pulse_data['images'] = local_images
+    pulse_data['job_start'] = get_job_start_stats()
+    pulse_data['cores'] = core_allocator.get_stats()
     return pulse_data
 
 
 def rpc_submit_job(job_dict):
-    # setup and run container
-    if job_dict['job_id'] in agent_jobs:
-        return True
-    cpu_limit = min(agent_cpu, job_dict['resource_limit']['cpu'])
-    cpus = [str(i) for i in range(agent_cpu)]
-    random.shuffle(cpus)
-    usable_cpu_str = ','.join(cpus[:cpu_limit])
+    # setup and run container. a job already running here is not started twice, but one whose
+    # container finished or was killed is launched again in a new container, e.g. a job the
+    # master relaunches on an agent that held it before
+    job_id = job_dict['job_id']
+    with agent_jobs_lock:
+        if job_id in launching_jobs:
+            return True
+        if job_id in agent_jobs:
+            if job_states[job_id]['status'] not in ['end', 'fail'] and job_id not in killed_jobs:
+                return True
+            # the old container is no longer the job's, its events are ignored from now on
+            container_jobs.pop(agent_jobs.pop(job_id).id, None)
+            killed_jobs.discard(job_id)
+        launching_jobs.add(job_id)
+    try:
+        return run_job_container(job_dict)
+    finally:
+        with agent_jobs_lock:
+            launching_jobs.discard(job_dict['job_id'])
+
+
+def run_job_container(job_dict):
+    submit_time = time.time()
+    max_restarts = 0
+    if job_dict['restart']:
+        # check restart times
+        assert job_dict['restart_times'] > 0 and type(job_dict['restart_times']) == type(1)
+        max_restarts = min(MAX_RETRY, job_dict['restart_times'])
     mem_limit = min(agent_memory, job_dict['resource_limit']['memory'])
     mem_limit_str = str(mem_limit)+'g'
+    cpu_limit = min(agent_cpu, job_dict['resource_limit']['cpu'])
+    cpus = core_allocator.allocate(job_dict['job_id'], cpu_limit)
+    usable_cpu_str = cpuset_str(cpus)
+    # optional, e.g. filled in per task of an array job. pooled containers are created with the image defaults
+    run_options = {key: job_dict[key] for key in ['command', 'environment'] if job_dict.get(key) is not None}
     try:
-        if job_dict['restart']:
-            # check restart times
-            assert job_dict['restart_times'] > 0 and type(job_dict['restart_times']) == type(1)
-            restart_policy_dict = {"Name": "on-failure", "MaximumRetryCount": min(MAX_RETRY, job_dict['restart_times'])}
-            job_container = docker_client.containers.run(job_dict['img_url'], cpuset_cpus=usable_cpu_str, \
-            mem_limit=mem_limit_str, restart_policy=restart_policy_dict, detach=True)
-        else:
-            job_container = docker_client.containers.run(job_dict['img_url'], cpuset_cpus=usable_cpu_str, \
-            mem_limit=mem_limit_str, detach=True)
-        agent_jobs[job_dict['job_id']] = job_container
+        job_container = None
+        if warm_pool is not None and len(run_options) == 0:
+            job_container = warm_pool.take((job_dict['img_url'], mem_limit_str, max_restarts))
+            if job_container is not None and not start_pooled_container(job_container, usable_cpu_str):
+                job_container = None
+        pooled = job_container is not None
+        if not pooled:
+            with docker_run_seconds.time():
+                if max_restarts > 0:
+                    restart_policy_dict = {"Name": "on-failure", "MaximumRetryCount": max_restarts}
+                    job_container = docker_client.containers.run(job_dict['img_url'], cpuset_cpus=usable_cpu_str, \
+                    mem_limit=mem_limit_str, restart_policy=restart_policy_dict, detach=True, **run_options)
+                else:
+                    job_container = docker_client.containers.run(job_dict['img_url'], cpuset_cpus=usable_cpu_str, \
+                    mem_limit=mem_limit_str, detach=True, **run_options)
+        with agent_jobs_lock:
+            job_cpus[job_dict['job_id']] = cpus
+        track_job(job_dict['job_id'], job_container)
+        # events that fired before the container was tracked were dropped, inspect once now
+        check_job(job_dict['job_id'])
+        record_job_start(pooled, time.time() - submit_time)
     except ImageNotFound as err:
+        core_allocator.release(job_dict['job_id'])
         raise xmlrpc.client.Fault(1, 'docker image not exist')
     except APIError as err:
+        core_allocator.release(job_dict['job_id'])
         raise xmlrpc.client.Fault(2, 'docker server error')
     return True
 
 
+def rpc_prepull_image(img_url):
+    # pull the image ahead of any job using it, returns its image record
+    try:
+        image = docker_client.images.pull(img_url)
+    except ImageNotFound as err:
+        raise xmlrpc.client.Fault(1, 'docker image not exist')
+    except APIError as err:
+        raise xmlrpc.client.Fault(2, 'docker server error')
+    refresh_images()
+    return image_record(image)
+
+
 def rpc_stream_output(job_id):
-    if job_id not in agent_jobs:
-        raise xmlrpc.client.Fault(1, 'job not exist')
-    job_container = agent_jobs[job_id]
+    job_container = get_job_container(job_id)
     job_container.reload()
     try:
-        job_logs = job_container.logs()
+        with log_fetch_seconds.labels('full').time():
+            job_logs = job_container.logs()
         # type(job_logs) == <class 'bytes'>
         return job_logs
     except APIError as err:
         raise xmlrpc.client.Fault(2, str(err))
 
 
+def json_log_path(job_container):
+    # the file docker keeps the container's log in, None unless it uses the json-file log driver
+    log_config = job_container.attrs.get('HostConfig', {}).get('LogConfig', {})
+    if log_config.get('Type') != 'json-file':
+        return None
+    return job_container.attrs.get('LogPath') or None
+
+
+def get_log_cursor(job_container):
+    with log_cursors_lock:
+        if job_container.id in log_cursors:
+            log_cursors.move_to_end(job_container.id)
+            return log_cursors[job_container.id]
+        path = json_log_path(job_container)
+        # checkpoints: (log bytes before, json log file offset), the first at the start of the log
+        cursor = {'path': path, 'file_offset': 0, 'position': 0, 'checkpoints': [(0, 0)], 'lock': Lock()} if path is not None else None
+        log_cursors[job_container.id] = cursor
+        while len(log_cursors) > LOG_CURSORS:
+            log_cursors.popitem(last=False)
+        return cursor
+
+
+def read_json_log(log_file):
+    # (file offset after the entry, log bytes of the entry) for each complete entry from the current position
+    file_offset = log_file.tell()
+    for line in log_file:
+        if not line.endswith(b'\n'):
+            # still being written
+            return
+        file_offset += len(line)
+        yield file_offset, json.loads(line)['log'].encode()
+
+
+def read_log_chunk(cursor, offset, max_bytes, tail):
+    # the chunk read from the json log file. the cursor follows the end of the log, so each call only
+    # parses what was written since the previous one plus the chunk itself, read from the last
+    # checkpoint before offset. returns (data, offset after data)
+    with cursor['lock'], open(cursor['path'], 'rb') as log_file:
+        if os.fstat(log_file.fileno()).st_size < cursor['file_offset']:
+            # truncated behind our back, start over
+            cursor.update({'file_offset': 0, 'position': 0, 'checkpoints': [(0, 0)]})
+        log_file.seek(cursor['file_offset'])
+        for file_offset, log_bytes in read_json_log(log_file):
+            cursor['position'] += len(log_bytes)
+            cursor['file_offset'] = file_offset
+            if cursor['position'] - cursor['checkpoints'][-1][0] >= LOG_CHECKPOINT_BYTES:
+                cursor['checkpoints'].append((cursor['position'], file_offset))
+        end = cursor['position']
+        end_file_offset = cursor['file_offset']
+        if tail is not None:
+            offset = max(0, end - tail)
+            max_bytes = tail
+        position, file_offset = cursor['checkpoints'][bisect.bisect_right(cursor['checkpoints'], (offset, float('inf'))) - 1]
+        log_file.seek(file_offset)
+        data = bytearray()
+        if max_bytes > 0:
+            for file_offset, log_bytes in read_json_log(log_file):
+                if file_offset > end_file_offset:
+                    break
+                next_position = position + len(log_bytes)
+                if next_position > offset:
+                    data += log_bytes[max(0, offset - position):]
+                position = next_position
+                if len(data) >= max_bytes:
+                    break
+    del data[max_bytes:]
+    return bytes(data), end if tail is not None else offset + len(data)
+
+
+def stream_log_chunk(job_container, offset, max_bytes, tail):
+    # the chunk read through the docker api, which has no byte offsets: the log is streamed from its
+    # start and skipped up to offset without being held in memory. returns (data, offset after data)
+    data = bytearray()
+    position = 0
+    log_stream = job_container.logs(stream=True, follow=False)
+    try:
+        for log_bytes in log_stream:
+            if tail is not None:
+                # keep a sliding window of the last tail bytes
+                data += log_bytes
+                if len(data) > tail:
+                    del data[:len(data) - tail]
+                position += len(log_bytes)
+                continue
+            end = position + len(log_bytes)
+            if end > offset:
+                data += log_bytes[max(0, offset - position):]
+            position = end
+            if len(data) >= max_bytes:
+                break
+    finally:
+        log_stream.close()
+    if tail is not None:
+        return bytes(data), position
+    del data[max_bytes:]
+    return bytes(data), offset + len(data)
+
+
+def rpc_stream_output_chunk(job_id, offset=0, max_bytes=LOG_CHUNK_SIZE, tail=None):
+    # up to max_bytes of the job log starting at byte offset, or with tail set, the last tail bytes.
+    # returns {'data': bytes, 'offset': offset after data, 'complete': job finished and all of its log was read}.
+    # read from the container's json log file when the agent can, else through the docker api
+    job_container = get_job_container(job_id)
+    with agent_jobs_lock:
+        finished = job_states[job_id]['status'] in ['end', 'fail']
+    max_bytes = max(1, min(max_bytes, MAX_LOG_CHUNK_SIZE))
+    if tail is not None:
+        tail = max(0, min(tail, MAX_LOG_CHUNK_SIZE))
+    cursor = get_log_cursor(job_container)
+    try:
+        with log_fetch_seconds.labels('chunk').time():
+            if cursor is not None:
+                try:
+                    data, next_offset = read_log_chunk(cursor, offset, max_bytes, tail)
+                except (OSError, ValueError, KeyError) as err:
+                    # e.g. no access to docker's files, use the docker api for this container from now on
+                    print("json log of job %s unreadable: %s" % (job_id, err))
+                    with log_cursors_lock:
+                        log_cursors[job_container.id] = None
+                    cursor = None
+            if cursor is None:
+                data, next_offset = stream_log_chunk(job_container, offset, max_bytes, tail)
+    except APIError as err:
+        raise xmlrpc.client.Fault(2, str(err))
+    chunk = {}
+    chunk['data'] = data
+    chunk['offset'] = next_offset
+    chunk['complete'] = finished and (tail is not None or len(data) < max_bytes)
+    return chunk
+
+
 def rpc_kill_job(job_id):
-    if job_id not in agent_jobs:
-        raise xmlrpc.client.Fault(1, 'job not exist')
-    if agent_jobs[job_id].status != "exited":
+    job_container = get_job_container(job_id)
+    with agent_jobs_lock:
+        job_status = job_states[job_id]['status']
+    if job_status not in ['end', 'fail']:
         try:
-            agent_jobs[job_id].kill()
+            job_container.kill()
+            with agent_jobs_lock:
+                if agent_jobs.get(job_id) is job_container:
+                    killed_jobs.add(job_id)
             return True
         except docker.errors.APIError as err:
             print(err)
@@ -136,21 +677,57 @@ def valid_url(input_url):
     return re.match(url_regex, input_url) is not None
 
 
-def start_agent_rpc_server():
-    rpc_server = xmlrpc.server.SimpleXMLRPCServer((AGENT_IP, AGENT_PORT), allow_none=True)
-    print("agent rpc server listening on port", AGENT_PORT)
-    # register rpc methods
+def rpc_get_metrics():
+    metrics = {}
+    metrics['job_start'] = get_job_start_stats()
+    metrics['cores'] = core_allocator.get_stats()
+    # counters, gauges and histograms also served on GET /metrics
+    metrics['registry'] = registry.snapshot()
+    return metrics
+
+
+def register_rpc_functions(rpc_server):
     rpc_server.register_function(rpc_heartbeat, "heartbeat")
     rpc_server.register_function(rpc_submit_job, "submit_job")
     rpc_server.register_function(rpc_stream_output, "stream_output")
+    rpc_server.register_function(rpc_stream_output_chunk, "stream_output_chunk")
     rpc_server.register_function(rpc_kill_job, "kill_job")
+    rpc_server.register_function(rpc_prepull_image, "prepull_image")
+    rpc_server.register_function(rpc_get_metrics, "get_metrics")
     rpc_server.register_introspection_functions()
+    rpc_server.register_multicall_functions()
+    instrument_rpc_server(rpc_server)
+
+
+def start_agent_rpc_server():
+    if RPC_SERVER_MODE == 'threaded':
+        rpc_server = PooledXMLRPCServer((AGENT_IP, AGENT_PORT), RPC_WORKERS, RPC_REQUEST_TIMEOUT, RPC_KEEPALIVE_TIMEOUT, allow_none=True)
+    else:
+        rpc_server = xmlrpc.server.SimpleXMLRPCServer((AGENT_IP, AGENT_PORT), requestHandler=MetricsRequestHandler, allow_none=True)
+    print("agent rpc server listening on port", AGENT_PORT)
+    register_rpc_functions(rpc_server)
     rpc_server_thread = Thread(target=lambda server : server.serve_forever(), args=(rpc_server,))
     rpc_server_thread.setDaemon(True)
     rpc_server_thread.start()
     return rpc_server_thread
 
 
+def start_msgpack_rpc_server():
+    # returns the port to advertise to the master, None when serving xml-rpc only
+    if RPC_TRANSPORT != 'msgpack':
+        return None
+    if not msgpack_rpc.available:
+        print("msgpack is not installed, serving xml-rpc only")
+        return None
+    msgpack_server = msgpack_rpc.MsgpackRPCServer((AGENT_IP, MSGPACK_PORT), RPC_KEEPALIVE_TIMEOUT)
+    register_rpc_functions(msgpack_server)
+    msgpack_thread = Thread(target=msgpack_server.serve_forever)
+    msgpack_thread.setDaemon(True)
+    msgpack_thread.start()
+    print("agent msgpack rpc server listening on port", MSGPACK_PORT)
+    return MSGPACK_PORT
+
+
 if __name__ == '__main__':
     parser = get_parser()
     args = parser.parse_args()
@@ -158,15 +735,25 @@ if __name__ == '__main__':
     if not valid_url(master_url):
         print("invalid master url")
         quit()
+    refresh_images()
+    start_warm_pool()
+    start_events_watcher()
+    start_resource_sampler()
     rpc_server_thread = start_agent_rpc_server()
+    msgpack_port = start_msgpack_rpc_server()
     # register node to master
-    with xmlrpc.client.ServerProxy(master_url) as master:
+    with xmlrpc.client.ServerProxy(master_url, allow_none=True) as master:
         try:
             agent_dict = {}
             agent_dict["url"] = "http://"+AGENT_IP+":"+str(AGENT_PORT)
             agent_dict["cpu"] = agent_cpu
             agent_dict["memory"] = agent_memory # gigabytes
-            master.register_agent(agent_dict)
+            if msgpack_port is not None:
+                agent_dict["msgpack_port"] = msgpack_port
+            with images_lock:
+                agent_dict["images"] = local_images
+                agent_dict["images_version"] = images_version
+            agent_id = master.register_agent(agent_dict)
         except xmlrpc.client.ProtocolError as err:
             print("xmlrpc.client.ProtocalError: %s" % err.errmsg)
             quit()
@@ -176,6 +763,8 @@ if __name__ == '__main__':
         except ConnectionRefusedError as err:
             print("ConnectionRefusedError: connection refused...")
             quit()
+    master_proxy = xmlrpc.client.ServerProxy(master_url, allow_none=True)
+    start_state_pusher()
     # wait 
     while True:
         try:
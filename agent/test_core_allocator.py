@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+import unittest
+import core_allocator
+from core_allocator import CoreAllocator, parse_cpulist, numa_nodes, cpuset_str
+
+# usage (from agent/): python -m pytest -q test_core_allocator.py
+
+
+class TestTopology(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.node_glob = core_allocator.NODE_CPULIST_GLOB
+        core_allocator.NODE_CPULIST_GLOB = os.path.join(self.directory, 'node*', 'cpulist')
+
+    def tearDown(self):
+        core_allocator.NODE_CPULIST_GLOB = self.node_glob
+        shutil.rmtree(self.directory)
+
+    def add_node(self, node, cpulist):
+        os.makedirs(os.path.join(self.directory, 'node%d' % node))
+        with open(os.path.join(self.directory, 'node%d' % node, 'cpulist'), 'w') as cpulist_file:
+            cpulist_file.write(cpulist + '\n')
+
+    def test_parse_cpulist(self):
+        self.assertEqual(parse_cpulist('0-3,8-11\n'), [0, 1, 2, 3, 8, 9, 10, 11])
+        self.assertEqual(parse_cpulist('5'), [5])
+        self.assertEqual(parse_cpulist(''), [])
+
+    def test_numa_nodes(self):
+        # node10 sorts after node2
+        self.add_node(10, '6-7')
+        self.add_node(2, '2-3')
+        self.add_node(0, '0-1')
+        self.assertEqual(numa_nodes(8), [[0, 1], [2, 3], [6, 7], [4, 5]])
+        # cores beyond the physical core count are left out
+        self.assertEqual(numa_nodes(4), [[0, 1], [2, 3]])
+
+    def test_without_topology(self):
+        self.assertEqual(numa_nodes(4), [[0, 1, 2, 3]])
+
+
+class TestCoreAllocator(unittest.TestCase):
+    def test_least_loaded_cores_on_one_node(self):
+        allocator = CoreAllocator([[0, 1, 2, 3], [4, 5, 6, 7]])
+        self.assertEqual(allocator.allocate('j1', 2), [0, 1])
+        # node 1 carries less load now
+        self.assertEqual(allocator.allocate('j2', 3), [4, 5, 6])
+        self.assertEqual(allocator.allocate('j3', 2), [2, 3])
+        self.assertEqual(allocator.get_stats()['node_loads'], [4, 3])
+        self.assertEqual(allocator.get_stats()['spanning'], 0)
+
+    def test_allocate_is_idempotent(self):
+        allocator = CoreAllocator([[0, 1, 2, 3]])
+        cpus = allocator.allocate('j1', 2)
+        self.assertEqual(allocator.allocate('j1', 2), cpus)
+        self.assertEqual(allocator.get_stats()['allocations'], 1)
+
+    def test_spanning_and_oversubscription(self):
+        allocator = CoreAllocator([[0, 1], [2, 3]])
+        self.assertEqual(allocator.allocate('j1', 3), [0, 1, 2])
+        self.assertEqual(allocator.allocate('j2', 8), [0, 1, 2, 3])
+        stats = allocator.get_stats()
+        self.assertEqual((stats['spanning'], stats['oversubscribed'], stats['max_core_load']), (2, 1, 2))
+
+    def test_release_and_hold(self):
+        allocator = CoreAllocator([[0, 1, 2, 3]])
+        allocator.allocate('j1', 4)
+        allocator.release('j1')
+        allocator.release('j1')
+        self.assertEqual(allocator.get_stats()['max_core_load'], 0)
+        # a restarted container keeps its cores, unknown ones are ignored
+        allocator.hold('j1', [2, 3, 9])
+        self.assertEqual(allocator.allocate('j2', 2), [0, 1])
+        self.assertEqual(allocator.holders['j1'], [2, 3])
+        self.assertEqual(allocator.get_stats()['releases'], 1)
+
+    def test_cpuset_str(self):
+        self.assertEqual(cpuset_str([0, 2, 5]), '0,2,5')
+
+
+if __name__ == '__main__':
+    unittest.main()
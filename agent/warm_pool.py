@@ -0,0 +1,102 @@
+from threading import Thread, Lock, Event
+from collections import OrderedDict, deque
+from docker.errors import APIError, ImageNotFound, NotFound
+
+# Pre-created (not started) containers for the images jobs were recently submitted with,
+# so that a submit only has to set the job's cpuset and start one.
+# A pool key is (image, mem_limit, max restart count), everything else about a job container
+# is set at handout. Only the max_images most recently used keys are kept warm.
+
+POOL_LABEL = 'ddjs.warm_pool' # set on every pooled container at create and kept after handout
+
+
+class WarmPool:
+    def __init__(self, docker_client, size, max_images, cpuset_cpus):
+        self.docker_client = docker_client
+        self.size = size
+        self.max_images = max_images
+        self.cpuset_cpus = cpuset_cpus # cpuset of idle pooled containers, replaced at handout
+        self.lock = Lock()
+        self.pools = OrderedDict() # key -> deque of created containers, most recently used key last
+        self.refill_needed = Event()
+        self.stats = {'hits': 0, 'misses': 0, 'created': 0, 'discarded': 0}
+
+    def take(self, key):
+        # an idle container for key or None; either way the key becomes hot and is refilled
+        evicted = []
+        with self.lock:
+            if key in self.pools:
+                self.pools.move_to_end(key)
+            else:
+                self.pools[key] = deque()
+                while len(self.pools) > self.max_images:
+                    evicted.extend(self.pools.popitem(last=False)[1])
+            pool = self.pools[key]
+            container = pool.popleft() if len(pool) > 0 else None
+            self.stats['hits' if container is not None else 'misses'] += 1
+        self.discard(evicted)
+        self.refill_needed.set()
+        return container
+
+    def discard(self, containers):
+        for container in containers:
+            try:
+                container.remove(force=True)
+            except (APIError, NotFound):
+                pass
+        if len(containers) > 0:
+            with self.lock:
+                self.stats['discarded'] += len(containers)
+
+    def create(self, key):
+        image, mem_limit, max_restarts = key
+        restart_policy = {'Name': 'on-failure', 'MaximumRetryCount': max_restarts} if max_restarts > 0 else None
+        return self.docker_client.containers.create(image, cpuset_cpus=self.cpuset_cpus, mem_limit=mem_limit,
+                                                    restart_policy=restart_policy, labels={POOL_LABEL: 'idle'})
+
+    def refill(self):
+        while True:
+            self.refill_needed.wait()
+            self.refill_needed.clear()
+            with self.lock:
+                keys = list(self.pools)
+            for key in keys:
+                while True:
+                    with self.lock:
+                        if key not in self.pools or len(self.pools[key]) >= self.size:
+                            break
+                    try:
+                        container = self.create(key)
+                    except ImageNotFound:
+                        with self.lock:
+                            self.pools.pop(key, None)
+                        break
+                    except APIError as err:
+                        print("warm pool refill error:", str(err))
+                        break
+                    with self.lock:
+                        self.stats['created'] += 1
+                        if key in self.pools:
+                            self.pools[key].append(container)
+                            container = None
+                    if container is not None:
+                        # key evicted while the container was being created
+                        self.discard([container])
+
+    def start(self):
+        # remove pooled containers left over by an earlier run, then keep the pools filled.
+        # labels cannot change after create, so the ones handed out to jobs still carry the label;
+        # only those never started are idle
+        self.discard(self.docker_client.containers.list(all=True, filters={'label': POOL_LABEL + '=idle', 'status': 'created'}))
+        refill_thread = Thread(target=self.refill)
+        refill_thread.setDaemon(True)
+        refill_thread.start()
+        return refill_thread
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['idle'] = {'%s %s restarts=%d' % key: len(pool) for key, pool in self.pools.items()}
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups > 0 else 0.0
+        return stats
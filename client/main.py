@@ -1,10 +1,20 @@
 import xmlrpc.client
 import yaml
 import os
+import glob
+import time
 import socket
+import msgpack_rpc
 from tabulate import tabulate
 
 proxy = None
+SUBMIT_BATCH_SIZE = 500 # job dicts sent per submit_jobs call
+LOG_CHUNK_SIZE = 1024 * 1024 # bytes requested per output_chunk call
+FOLLOW_INTERVAL = 2 # seconds between polls while following a job's output
+STATUS_BATCH_SIZE = 1000 # job ids sent per get_statuses call
+MULTICALL_BATCH_SIZE = 500 # calls bundled per system.multicall round trip
+ARRAY_TASKS_LIMIT = 1000 # tasks per get_array_status page when drilling down into an array
+RPC_TRANSPORT = 'xmlrpc' # 'msgpack' switches to the master's msgpack endpoint when it offers one, else stays on xml-rpc
 
 class JobDictFormatError(Exception):
     def __init__(self):
@@ -12,7 +22,7 @@ class JobDictFormatError(Exception):
 
 def run(input_master_url):
     global proxy
-    proxy = xmlrpc.client.ServerProxy("http://" + master_url)
+    proxy = xmlrpc.client.ServerProxy("http://" + master_url, allow_none=True)
     try:
         proxy.is_even(0)                     
     except xmlrpc.client.ProtocolError as err:
@@ -31,8 +41,29 @@ def run(input_master_url):
         if not os.path.exists("./tickets/tickets.txt"):
             os.mknod("./tickets/tickets.txt")
         print("ticket file created...")
+        if RPC_TRANSPORT == 'msgpack':
+            upgrade_transport(master_url)
         return True
 
+def upgrade_transport(master_url):
+    # switch to msgpack frames if both sides support it, otherwise keep using xml-rpc
+    global proxy
+    if not msgpack_rpc.available:
+        print("msgpack is not installed, using xml-rpc")
+        return
+    try:
+        msgpack_port = proxy.get_transports()['msgpack_port']
+        if msgpack_port is None:
+            print("master does not serve msgpack, using xml-rpc")
+            return
+        msgpack_proxy = msgpack_rpc.MsgpackServerProxy(master_url.rsplit(":", 1)[0], msgpack_port)
+        msgpack_proxy.is_even(0)
+    except (xmlrpc.client.ProtocolError, xmlrpc.client.Fault, OSError) as err:
+        print("msgpack unavailable (%s), using xml-rpc" % err)
+    else:
+        proxy = msgpack_proxy
+        print("using msgpack transport")
+
 def job_dict_valid(job_dict):
     return ("img_url" in job_dict 
             and "resource_requirement" in job_dict 
@@ -44,6 +75,14 @@ def job_dict_valid(job_dict):
             and "restart" in job_dict
             and "restart_times" in job_dict)
 
+def array_dict_valid(array_dict):
+    # a job dict plus array: {param: name, values: [...]} or {param: name, range: [start, stop(, step)]}
+    array = array_dict.get("array")
+    return (job_dict_valid(array_dict)
+            and isinstance(array, dict)
+            and isinstance(array.get("param"), str)
+            and (isinstance(array.get("values"), list) != isinstance(array.get("range"), list)))
+
 def load_tickets():
     tickets = []
     if os.path.exists("./tickets/tickets.txt"):
@@ -59,6 +98,28 @@ def insert_ticket(job_id):
     ticket_file.write("%s\n" % job_id)
     ticket_file.close()
 
+def insert_tickets(job_ids):
+    ticket_file = open("./tickets/tickets.txt", 'a+')
+    for job_id in job_ids:
+        ticket_file.write("%s\n" % job_id)
+    ticket_file.close()
+
+def load_array_tickets():
+    if not os.path.exists("./tickets/arrays.txt"):
+        return []
+    with open("./tickets/arrays.txt") as ticket_file:
+        return [line.rstrip('\n') for line in ticket_file.readlines()]
+
+def insert_array_ticket(array_id):
+    with open("./tickets/arrays.txt", 'a+') as ticket_file:
+        ticket_file.write("%s\n" % array_id)
+
+def delete_tickets(job_ids):
+    job_ids = set(job_ids)
+    tickets = [ticket for ticket in load_tickets() if ticket not in job_ids]
+    open('./tickets/tickets.txt', 'w').close()
+    insert_tickets(tickets)
+
 def delete_ticket(job_id):
     tickets = load_tickets()
     if job_id in tickets:
@@ -86,6 +147,45 @@ def kill_job(job_id):
     else:
         print("job_id invalid")
 
+def batch_call(calls):
+    # run (method_name, args) calls through system.multicall, MULTICALL_BATCH_SIZE per round trip.
+    # returns one entry per call, either its result or the xmlrpc.client.Fault it raised
+    global proxy
+    results = []
+    for start in range(0, len(calls), MULTICALL_BATCH_SIZE):
+        multicall = xmlrpc.client.MultiCall(proxy)
+        for method_name, args in calls[start:start + MULTICALL_BATCH_SIZE]:
+            getattr(multicall, method_name)(*args)
+        batch_results = multicall()
+        for i in range(len(calls[start:start + MULTICALL_BATCH_SIZE])):
+            try:
+                results.append(batch_results[i])
+            except xmlrpc.client.Fault as err:
+                results.append(err)
+    return results
+
+def kill_jobs(job_ids):
+    tickets = set(load_tickets())
+    for job_id in job_ids:
+        if job_id not in tickets:
+            print("%s: job_id invalid" % job_id)
+    job_ids = [job_id for job_id in job_ids if job_id in tickets]
+    try:
+        results = batch_call([("kill_job", (job_id,)) for job_id in job_ids])
+    except xmlrpc.client.ProtocolError as err:
+        print("xmlrpc.client.ProtocalError: %s" % err.errmsg)
+        return
+    killed = []
+    for job_id, result in zip(job_ids, results):
+        if isinstance(result, xmlrpc.client.Fault):
+            print("%s: xmlrpc.client.Fault: %s" % (job_id, result.faultString))
+        elif result:
+            killed.append(job_id)
+        else:
+            print("%s: master unable to kill the job" % job_id)
+    delete_tickets(killed)
+    print("%d of %d jobs killed..." % (len(killed), len(job_ids)))
+
 def get_status(job_id):
     status = ""
     try:
@@ -98,29 +198,79 @@ def get_status(job_id):
     finally:
         return status
 
+def get_statuses(job_ids):
+    # statuses of many jobs, STATUS_BATCH_SIZE per round trip
+    statuses = {}
+    try:
+        global proxy
+        for start in range(0, len(job_ids), STATUS_BATCH_SIZE):
+            statuses.update(proxy.get_statuses(job_ids[start:start + STATUS_BATCH_SIZE]))
+    except xmlrpc.client.ProtocolError as err:
+        print("xmlrpc.client.ProtocalError: %s" % err.errmsg)
+    except xmlrpc.client.Fault as err:
+        print("xmlrpc.client.Fault: %s" % err.faultString)
+    return statuses
+
 def list_jobs():
     tickets = load_tickets()
+    statuses = get_statuses(tickets)
     table = []
     for ticket in tickets:
-        status = get_status(ticket)
-        table.append([ticket, status])
+        table.append([ticket, statuses.get(ticket, "")])
     print("")
     print(tabulate(table, headers=['Job ID', 'Status'], tablefmt='orgtbl'))
 
+def output_file_path(job_id):
+    return "./job_output/job_" + job_id + "_output.txt"
+
+def fetch_output(job_id, output_file, offset):
+    # append chunks from offset until the log is caught up, returns (new offset, job complete)
+    global proxy
+    while True:
+        chunk = proxy.output_chunk(job_id, offset, LOG_CHUNK_SIZE)
+        output_file.write(chunk['data'].data)
+        output_file.flush()
+        offset = chunk['offset']
+        if chunk['complete'] or len(chunk['data'].data) < LOG_CHUNK_SIZE:
+            return offset, chunk['complete']
+
 def stream_output(job_id):
     tickets = load_tickets()
     if job_id in tickets:
-        global proxy
+        os.makedirs("./job_output", exist_ok=True)
         try:
-            output = proxy.output_request(job_id)
+            with open(output_file_path(job_id), 'wb') as output_file:
+                fetch_output(job_id, output_file, 0)
         except xmlrpc.client.ProtocolError as err:
             print("xmlrpc.client.ProtocalError: %s" % err.errmsg)
         except xmlrpc.client.Fault as err:
             print("xmlrpc.client.Fault: %s" % err.faultString)
         else:
-            output_file = open("./job_output/job_" + job_id + "_output.txt", 'wb+')
-            output_file.write(output.data)
-            print("output streamed to '%s'" % "./job_output/job_" + job_id + "_output.txt")
+            print("output streamed to '%s'" % output_file_path(job_id))
+    else:
+        print("job_id invalid")
+
+def follow_output(job_id):
+    # keep appending new output to the job's output file until the job finishes or ctrl-c
+    tickets = load_tickets()
+    if job_id in tickets:
+        os.makedirs("./job_output", exist_ok=True)
+        try:
+            with open(output_file_path(job_id), 'ab') as output_file:
+                offset = output_file.tell()
+                print("following output of job %s into '%s', ctrl-c to stop" % (job_id, output_file_path(job_id)))
+                while True:
+                    offset, complete = fetch_output(job_id, output_file, offset)
+                    if complete:
+                        print("job finished, output complete")
+                        break
+                    time.sleep(FOLLOW_INTERVAL)
+        except xmlrpc.client.ProtocolError as err:
+            print("xmlrpc.client.ProtocalError: %s" % err.errmsg)
+        except xmlrpc.client.Fault as err:
+            print("xmlrpc.client.Fault: %s" % err.faultString)
+        except KeyboardInterrupt:
+            print("stopped following")
     else:
         print("job_id invalid")
 
@@ -144,6 +294,124 @@ def submit_job(job_file_path):
         print("submission succeeded. job id : %s" % job_id)
         insert_ticket(job_id)
 
+def find_job_files(path_pattern):
+    if os.path.isdir(path_pattern):
+        return sorted(glob.glob(os.path.join(path_pattern, "*.yaml")) + glob.glob(os.path.join(path_pattern, "*.yml")))
+    return sorted(glob.glob(path_pattern))
+
+def submit_jobs(path_pattern):
+    # submit every job file in a directory or matching a glob, SUBMIT_BATCH_SIZE jobs per round trip
+    job_file_paths = find_job_files(path_pattern)
+    if len(job_file_paths) == 0:
+        print("No job file matches '%s'" % path_pattern)
+        return
+    job_file_batch = []
+    job_dict_batch = []
+    for job_file_path in job_file_paths:
+        try:
+            with open(job_file_path) as job_file:
+                job_dict = yaml.safe_load(job_file)
+        except yaml.YAMLError as err:
+            print("%s: yaml error" % job_file_path)
+            continue
+        if not isinstance(job_dict, dict) or not job_dict_valid(job_dict):
+            print("%s: job dict format error" % job_file_path)
+            continue
+        job_file_batch.append(job_file_path)
+        job_dict_batch.append(job_dict)
+    submitted_job_ids = []
+    for start in range(0, len(job_dict_batch), SUBMIT_BATCH_SIZE):
+        try:
+            global proxy
+            results = proxy.submit_jobs(job_dict_batch[start:start + SUBMIT_BATCH_SIZE])
+        except xmlrpc.client.ProtocolError as err:
+            print("xmlrpc.client.ProtocalError: %s" % err.errmsg)
+            break
+        except xmlrpc.client.Fault as err:
+            print("xmlrpc.client.Fault: %s" % err.faultString)
+            break
+        for job_file_path, result in zip(job_file_batch[start:start + SUBMIT_BATCH_SIZE], results):
+            if 'error' in result:
+                print("%s: %s" % (job_file_path, result['error']))
+            else:
+                submitted_job_ids.append(result['job_id'])
+    insert_tickets(submitted_job_ids)
+    print("%d of %d jobs submitted" % (len(submitted_job_ids), len(job_file_paths)))
+
+def submit_array(array_file_path):
+    # one spec expanded by the master into one task per parameter value
+    try:
+        global proxy
+        with open(array_file_path) as array_file:
+            array_dict = yaml.safe_load(array_file)
+        if not isinstance(array_dict, dict) or not array_dict_valid(array_dict):
+            raise JobDictFormatError
+        array_id = proxy.submit_array(array_dict)
+    except FileNotFoundError as err:
+        print("No such file '%s'" % array_file_path)
+    except xmlrpc.client.ProtocolError as err:
+        print("xmlrpc.client.ProtocalError: %s" % err.errmsg)
+    except xmlrpc.client.Fault as err:
+        print("xmlrpc.client.Fault: %s" % err.faultString)
+    except JobDictFormatError as err:
+        print("array dict format error")
+    else:
+        print("submission succeeded. array id : %s" % array_id)
+        insert_array_ticket(array_id)
+
+def array_status(array_id, task_status=None):
+    # task counts per status, with task_status also every task in that status
+    try:
+        global proxy
+        if task_status is None:
+            result = proxy.get_array_status(array_id)
+            tasks = []
+        else:
+            result = proxy.get_array_status(array_id, task_status, None, ARRAY_TASKS_LIMIT)
+            tasks = result['tasks']
+            while result['cursor'] is not None:
+                result = proxy.get_array_status(array_id, task_status, result['cursor'], ARRAY_TASKS_LIMIT)
+                tasks.extend(result['tasks'])
+    except xmlrpc.client.ProtocolError as err:
+        print("xmlrpc.client.ProtocalError: %s" % err.errmsg)
+        return
+    except xmlrpc.client.Fault as err:
+        print("xmlrpc.client.Fault: %s" % err.faultString)
+        return
+    print("array %s: %d tasks%s" % (array_id, result['size'], ", killed" if result['killed'] else ""))
+    print(tabulate([[status, count] for status, count in result['counts'].items()], headers=['Status', 'Tasks'], tablefmt='orgtbl'))
+    if task_status is not None:
+        print("")
+        print(tabulate([[task['job_id'], task['value'], task['status']] for task in tasks], headers=['Job ID', 'Value', 'Status'], tablefmt='orgtbl'))
+
+def list_arrays():
+    table = []
+    for array_id in load_array_tickets():
+        try:
+            global proxy
+            result = proxy.get_array_status(array_id)
+        except xmlrpc.client.ProtocolError as err:
+            print("xmlrpc.client.ProtocalError: %s" % err.errmsg)
+            return
+        except xmlrpc.client.Fault as err:
+            table.append([array_id, "", ""])
+            continue
+        counts = result['counts']
+        table.append([array_id, result['size'], ", ".join("%s %d" % (status, count) for status, count in counts.items() if count > 0)])
+    print("")
+    print(tabulate(table, headers=['Array ID', 'Tasks', 'Status'], tablefmt='orgtbl'))
+
+def kill_array(array_id):
+    try:
+        global proxy
+        proxy.kill_array(array_id)
+    except xmlrpc.client.ProtocolError as err:
+        print("xmlrpc.client.ProtocalError: %s" % err.errmsg)
+    except xmlrpc.client.Fault as err:
+        print("xmlrpc.client.Fault: %s" % err.faultString)
+    else:
+        print("array killed...")
+
 def cmd_switch(cmd):
     if cmd[0] == "submit_job":
         try:
@@ -152,6 +420,36 @@ def cmd_switch(cmd):
             print("Error: missing argument")
         else:
             submit_job(job_file_path)
+    elif cmd[0] == "submit_jobs":
+        try:
+            path_pattern = cmd[1]
+        except IndexError:
+            print("Error: missing argument")
+        else:
+            submit_jobs(path_pattern)
+    elif cmd[0] == "submit_array":
+        try:
+            array_file_path = cmd[1]
+        except IndexError:
+            print("Error: missing argument")
+        else:
+            submit_array(array_file_path)
+    elif cmd[0] == "array_status":
+        try:
+            array_id = cmd[1]
+        except IndexError:
+            print("Error: missing argument")
+        else:
+            array_status(array_id, cmd[2] if len(cmd) > 2 else None)
+    elif cmd[0] == "list_arrays":
+        list_arrays()
+    elif cmd[0] == "kill_array":
+        try:
+            array_id = cmd[1]
+        except IndexError:
+            print("Error: missing argument")
+        else:
+            kill_array(array_id)
     elif cmd[0] == "list_jobs":
         list_jobs()
     elif cmd[0] == "stream_output":
@@ -161,13 +459,23 @@ def cmd_switch(cmd):
             print("Error: missing argument")
         else:
             stream_output(job_id)
+    elif cmd[0] == "follow":
+        try:
+            job_id = cmd[1]
+        except IndexError:
+            print("Error: missing argument")
+        else:
+            follow_output(job_id)
     elif cmd[0] == "kill_job":
         try:
             job_id= cmd[1]
         except IndexError:
             print("Error: missing argument")
         else:
-            kill_job(job_id)
+            if len(cmd) > 2:
+                kill_jobs(cmd[1:])
+            else:
+                kill_job(job_id)
     else:
         print("%s : command not found..." % cmd[0])
 
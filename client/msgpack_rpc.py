@@ -0,0 +1,221 @@
+import struct
+import socket
+import socketserver
+import xmlrpc.client
+from threading import Lock
+
+# Binary alternative to xml-rpc: length-prefixed msgpack frames over long-lived tcp connections.
+# Same method surface as the xml-rpc servers, including system.listMethods and system.multicall,
+# and faults are raised as xmlrpc.client.Fault so callers handle both transports alike.
+# This file is kept identical in master/, agent/ and client/.
+#
+# frame: 4 byte big-endian body length, then a msgpack body
+# request: [method_name, params]
+# response: [None, result] or [[fault_code, fault_string], None]
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+available = msgpack is not None
+MAX_FRAME_SIZE = 64 * 1024 * 1024 # bytes, larger frames are a protocol error
+BINARY_EXT_TYPE = 1 # msgpack extension type carrying an xmlrpc.client.Binary
+HEADER = struct.Struct('>I')
+
+
+def encode_default(value):
+    if isinstance(value, xmlrpc.client.Binary):
+        return msgpack.ExtType(BINARY_EXT_TYPE, value.data)
+    raise TypeError('cannot serialize %r' % type(value))
+
+
+def decode_ext(code, data):
+    if code == BINARY_EXT_TYPE:
+        return xmlrpc.client.Binary(data)
+    return msgpack.ExtType(code, data)
+
+
+def wrap_binary(value):
+    # bytes arrive as xmlrpc.client.Binary, as they do over xml-rpc
+    return xmlrpc.client.Binary(value) if isinstance(value, bytes) else value
+
+
+def decode_map(value):
+    for key, item in value.items():
+        if isinstance(item, bytes):
+            value[key] = xmlrpc.client.Binary(item)
+    return value
+
+
+def decode_list(value):
+    return [wrap_binary(item) for item in value]
+
+
+def pack(value):
+    return msgpack.packb(value, default=encode_default, use_bin_type=True)
+
+
+def unpack(body):
+    return wrap_binary(msgpack.unpackb(body, ext_hook=decode_ext, object_hook=decode_map, list_hook=decode_list, raw=False, strict_map_key=False))
+
+
+def read_exactly(sock_file, size):
+    data = sock_file.read(size)
+    if len(data) < size:
+        raise EOFError('connection closed')
+    return data
+
+
+def read_frame(sock_file):
+    size = HEADER.unpack(read_exactly(sock_file, HEADER.size))[0]
+    if size > MAX_FRAME_SIZE:
+        raise xmlrpc.client.ProtocolError('', 0, 'frame of %d bytes exceeds MAX_FRAME_SIZE' % size, {})
+    body = read_exactly(sock_file, size)
+    try:
+        return unpack(body)
+    except (ValueError, msgpack.UnpackException) as err:
+        raise xmlrpc.client.ProtocolError('', 0, 'malformed frame: %s' % err, {})
+
+
+def write_frame(sock, value):
+    body = pack(value)
+    sock.sendall(HEADER.pack(len(body)) + body)
+
+
+class MsgpackRequestHandler(socketserver.StreamRequestHandler):
+    # serves requests on one connection until the client closes it or it idles for keepalive_timeout
+    def setup(self):
+        self.request.settimeout(self.server.keepalive_timeout)
+        super().setup()
+
+    def handle(self):
+        while True:
+            try:
+                method_name, params = read_frame(self.rfile)
+            except (EOFError, OSError, xmlrpc.client.ProtocolError):
+                return
+            response = self.server.dispatch(method_name, params)
+            try:
+                write_frame(self.request, response)
+            except TypeError as err:
+                write_frame(self.request, [[1, 'cannot marshal result: %s' % err], None])
+            except OSError:
+                return
+
+
+class MsgpackRPCServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, addr, keepalive_timeout):
+        if not available:
+            raise RuntimeError('msgpack is not installed')
+        super().__init__(addr, MsgpackRequestHandler)
+        self.keepalive_timeout = keepalive_timeout
+        self.funcs = {}
+
+    def register_function(self, function, name):
+        self.funcs[name] = function
+
+    def register_introspection_functions(self):
+        self.funcs['system.listMethods'] = lambda: sorted(self.funcs)
+
+    def register_multicall_functions(self):
+        self.funcs['system.multicall'] = self.system_multicall
+
+    def system_multicall(self, call_list):
+        # same result shape as xml-rpc's system.multicall, so xmlrpc.client.MultiCall works on top
+        results = []
+        for call in call_list:
+            response = self.dispatch(call['methodName'], call['params'])
+            if response[0] is None:
+                results.append([response[1]])
+            else:
+                results.append({'faultCode': response[0][0], 'faultString': response[0][1]})
+        return results
+
+    def dispatch(self, method_name, params):
+        function = self.funcs.get(method_name)
+        if function is None:
+            return [[1, 'method "%s" is not supported' % method_name], None]
+        try:
+            return [None, function(*params)]
+        except xmlrpc.client.Fault as fault:
+            return [[fault.faultCode, fault.faultString], None]
+        except Exception as err:
+            return [[1, '%s:%s' % (type(err), err)], None]
+
+
+class MsgpackMethod:
+    def __init__(self, proxy, name):
+        self.proxy = proxy
+        self.name = name
+
+    def __getattr__(self, name):
+        return MsgpackMethod(self.proxy, '%s.%s' % (self.name, name))
+
+    def __call__(self, *params):
+        return self.proxy.request(self.name, params)
+
+
+class MsgpackServerProxy:
+    # client side of one persistent connection, used like xmlrpc.client.ServerProxy.
+    # calls on one proxy are serialized, use one proxy per thread for parallel calls
+    def __init__(self, host, port, timeout=None):
+        if not available:
+            raise RuntimeError('msgpack is not installed')
+        self.address = (host, port)
+        self.timeout = timeout
+        self.lock = Lock()
+        self.sock = None
+        self.sock_file = None
+
+    def connect(self):
+        self.sock = socket.create_connection(self.address, self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock_file = self.sock.makefile('rb')
+
+    def close(self):
+        if self.sock is not None:
+            self.sock_file.close()
+            self.sock.close()
+            self.sock = None
+            self.sock_file = None
+
+    def request(self, method_name, params):
+        with self.lock:
+            # retry once on a fresh connection when the server dropped an idle one, like xmlrpc.client does
+            for attempt in (0, 1):
+                reused = self.sock is not None
+                try:
+                    if not reused:
+                        self.connect()
+                    write_frame(self.sock, [method_name, list(params)])
+                    fault, result = read_frame(self.sock_file)
+                    break
+                except (EOFError, ConnectionResetError, BrokenPipeError) as err:
+                    self.close()
+                    if attempt == 1 or not reused:
+                        raise ConnectionResetError(str(err))
+                except Exception:
+                    self.close()
+                    raise
+        if fault is not None:
+            raise xmlrpc.client.Fault(fault[0], fault[1])
+        return result
+
+    def __getattr__(self, name):
+        return MsgpackMethod(self, name)
+
+    def __call__(self, attr):
+        # same escape hatch as xmlrpc.client.ServerProxy: proxy('close')()
+        if attr == 'close':
+            return self.close
+        raise AttributeError('attribute %r not found' % attr)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,209 @@
+import io
+import time
+import argparse
+import contextlib
+import xmlrpc.client
+import multiprocessing
+from threading import Thread
+import main
+from job_table import PENDING, TERMINAL_STATUSES
+from rpc_server import PooledXMLRPCServer
+from fake_agent import FakeAgentHost, FAKE_IMAGE, DEFAULT_MODEL, model_from_args
+
+# Runs an in-process master against fake agents (fake_agent.py, no docker) spread over --hosts
+# processes and reports, per cluster size: submit throughput, placement latency percentiles
+# (submit_jobs call until the job reaches its agent), heartbeat sweep time and failover time
+# (one loaded agent crashes until all of its jobs run elsewhere, which waits for free capacity on a full cluster).
+# failover is split into detect (crash until the agent is dead) and redeploy (the master's own
+# failover_jobs time), recover is crash until every orphaned job is launched again.
+# usage: python cluster_bench.py [--sizes 10,100,1000] [--jobs 10000] [--hosts 4] [--job_duration 30]
+# a 500-job agent loss: python cluster_bench.py --sizes 20 --cpu 500 --memory 1000 --jobs 5000 --job_duration 0
+
+JOB_DICT = {
+    'img_url': FAKE_IMAGE,
+    'resource_requirement': {'cpu': 1, 'memory': 1},
+    'resource_limit': {'cpu': 1, 'memory': 1},
+    'restart': False,
+    'restart_times': 0
+}
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+def run_host(port, agent_count, args, master_url, ready):
+    host = FakeAgentHost(('localhost', port), batch_pushes=args.batch_pushes)
+    for i in range(agent_count):
+        host.add_agent(args.cpu, args.memory, model_from_args(args))
+    host.start()
+    host.register(master_url)
+    ready.put(port)
+    while True:
+        time.sleep(1)
+
+
+def start_master(port, args):
+    # read when agents register
+    main.HEARTBEAT_RATE = args.heartbeat_rate
+    main.PHI_ACCEPTABLE_PAUSE = args.acceptable_pause
+    heartbeat_thread = Thread(target=main.heartbeat, args=(args.heartbeat_rate,))
+    heartbeat_thread.setDaemon(True)
+    heartbeat_thread.start()
+    supervisor_thread = Thread(target=main.supervise_agents, args=(main.SUPERVISOR_INTERVAL,))
+    supervisor_thread.setDaemon(True)
+    supervisor_thread.start()
+    main.start_deploy_workers()
+    rpc_server = PooledXMLRPCServer(('localhost', port), main.RPC_WORKERS, main.RPC_REQUEST_TIMEOUT, main.RPC_KEEPALIVE_TIMEOUT, allow_none=True, logRequests=False)
+    main.register_rpc_functions(rpc_server)
+    rpc_thread = Thread(target=rpc_server.serve_forever)
+    rpc_thread.setDaemon(True)
+    rpc_thread.start()
+
+
+def wait_for(condition, timeout, interval=0.05):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(interval)
+    return True
+
+
+def count_jobs(predicate):
+    with main.jobs_lock:
+        return sum(1 for job in main.jobs.values() if predicate(job))
+
+
+def submit(master_url, job_count, batch):
+    # returns job_id -> time its submit_jobs call started
+    submitted = {}
+    with xmlrpc.client.ServerProxy(master_url) as master:
+        for start in range(0, job_count, batch):
+            batch_start = time.time()
+            for result in master.submit_jobs([dict(JOB_DICT) for i in range(start, min(start + batch, job_count))]):
+                if 'job_id' in result:
+                    submitted[result['job_id']] = batch_start
+    return submitted
+
+
+def bench_failover(host_urls, host_agent_ids, timeout):
+    # crash the agent holding the most live jobs, returns (jobs it held, seconds to detect, seconds to recover)
+    with main.jobs_lock:
+        live = {}
+        for job in main.jobs.values():
+            if job.agent_id is not None and job.status not in TERMINAL_STATUSES and job.status != PENDING:
+                live.setdefault(job.agent_id, []).append(job.job_id)
+    if len(live) == 0:
+        return 0, None, None, None
+    agent_id = max(live, key=lambda agent_id: len(live[agent_id]))
+    for host_url, agent_ids in zip(host_urls, host_agent_ids):
+        if agent_id in agent_ids:
+            with xmlrpc.client.ServerProxy(host_url + '/control') as control:
+                control.crash(agent_ids.index(agent_id))
+    crash_time = time.time()
+    detected = wait_for(lambda: main.agents[agent_id]['status'] == 'dead', timeout)
+    detect_time = time.time() - crash_time if detected else None
+    orphans = live[agent_id]
+
+    def recovered():
+        with main.jobs_lock:
+            return all(main.jobs[job_id].agent_id != agent_id and main.jobs[job_id].status != PENDING
+                       for job_id in orphans if job_id in main.jobs and main.jobs[job_id].status not in TERMINAL_STATUSES)
+    recovered_in_time = detected and wait_for(recovered, timeout - detect_time)
+    recover_time = time.time() - crash_time if recovered_in_time else None
+    with main.stats_lock:
+        redeploy_time = main.failover_stats['last_recover_duration'] if main.failover_stats['failovers'] > 0 else None
+    return len(orphans), detect_time, redeploy_time, recover_time
+
+
+def bench_cluster(agent_count, args, results):
+    master_port = args.port
+    master_url = 'http://localhost:%d' % master_port
+    start_master(master_port, args)
+    # hosts are spawned, not forked from a process that already runs master threads
+    spawn = multiprocessing.get_context('spawn')
+    ready = spawn.Queue()
+    host_count = min(args.hosts, agent_count)
+    host_ports = [master_port + 1 + i for i in range(host_count)]
+    register_start = time.time()
+    for i, port in enumerate(host_ports):
+        host_agents = agent_count // host_count + (1 if i < agent_count % host_count else 0)
+        process = spawn.Process(target=run_host, args=(port, host_agents, args, master_url, ready))
+        process.daemon = True
+        process.start()
+    # the master prints one line per registered agent
+    with contextlib.redirect_stdout(io.StringIO()):
+        for port in host_ports:
+            ready.get()
+    register_duration = time.time() - register_start
+    host_urls = ['http://localhost:%d' % port for port in host_ports]
+    host_agent_ids = []
+    for host_url in host_urls:
+        with xmlrpc.client.ServerProxy(host_url + '/control') as control:
+            host_agent_ids.append(control.agent_ids())
+
+    submit_start = time.time()
+    submitted = submit(master_url, args.jobs, args.batch)
+    submit_duration = time.time() - submit_start
+    wait_for(lambda: count_jobs(lambda job: job.status == PENDING) == 0 or len(main.pending_queue) > 0 and main.deploy_queue.qsize() == 0, args.timeout)
+    received = {}
+    for host_url in host_urls:
+        with xmlrpc.client.ServerProxy(host_url + '/control') as control:
+            received.update(control.received())
+    latencies = [received[job_id] - submit_time for job_id, submit_time in submitted.items() if job_id in received]
+
+    # a few sweeps with the cluster loaded
+    sweep_count = main.heartbeat_stats['sweep_count']
+    wait_for(lambda: main.heartbeat_stats['sweep_count'] >= sweep_count + 3, args.timeout)
+    with main.stats_lock:
+        heartbeat_stats = dict(main.heartbeat_stats)
+
+    failover = bench_failover(host_urls, host_agent_ids, args.timeout)
+    result = {
+        'agents': agent_count,
+        'register_duration': register_duration,
+        'submit_rate': len(submitted) / submit_duration,
+        'placed': len(latencies),
+        'latency': [percentile(latencies, p) for p in [50, 90, 99, 100]] if latencies else None,
+        'sweep': (heartbeat_stats['last_sweep_duration'], heartbeat_stats['max_sweep_duration']),
+        # every agent is healthy until the failover phase, any suspicion before it is a false positive
+        'suspected': heartbeat_stats['suspected'],
+        'failover': failover,
+    }
+    results.put(result)
+
+
+def format_seconds(value):
+    return '%.3f' % value if value is not None else 'timeout'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='master benchmark against fake agents')
+    parser.add_argument('--sizes', default='10,100,1000', type=str, help='comma separated agent counts')
+    parser.add_argument('--jobs', default=10000, type=int)
+    parser.add_argument('--batch', default=500, type=int, help='jobs per submit_jobs call')
+    parser.add_argument('--hosts', default=4, type=int, help='processes serving fake agents')
+    parser.add_argument('--port', default=9100, type=int, help='master port, fake agent hosts use the ports after it')
+    parser.add_argument('--cpu', default=32, type=int, help='cores per fake agent')
+    parser.add_argument('--memory', default=64, type=int, help='gigabytes per fake agent')
+    parser.add_argument('--heartbeat_rate', default=1, type=float)
+    parser.add_argument('--acceptable_pause', default=1, type=float, help='PHI_ACCEPTABLE_PAUSE of the master, seconds')
+    parser.add_argument('--batch_pushes', action='store_true', help='fake agents of a host push in one multicall, see fake_agent.py')
+    parser.add_argument('--timeout', default=120, type=float, help='seconds any one phase may take')
+    for key, value in DEFAULT_MODEL.items():
+        parser.add_argument('--' + key, default=value, type=float)
+    args = parser.parse_args()
+    print('%6s %9s %10s %28s %16s %10s %38s' % ('agents', 'register', 'submit/s', 'placement p50/p90/p99/max', 'sweep last/max', 'suspected', 'failover jobs/detect/redeploy/recover'))
+    for agent_count in [int(size) for size in args.sizes.split(',')]:
+        # a fresh master per size, its state lives in module globals
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=bench_cluster, args=(agent_count, args, results))
+        process.start()
+        result = results.get()
+        process.join()
+        latency = '/'.join('%.3f' % value for value in result['latency']) if result['latency'] else '-'
+        failover = '%d/%s' % (result['failover'][0], '/'.join(format_seconds(value) for value in result['failover'][1:]))
+        print('%6d %8.2fs %10.0f %28s %16s %10d %38s' % (agent_count, result['register_duration'], result['submit_rate'], latency,
+                                                       '%.3f/%.3f' % result['sweep'], result['suspected'], failover))
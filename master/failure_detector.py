@@ -0,0 +1,55 @@
+import math
+from collections import deque
+from threading import Lock
+
+# Phi accrual failure detector (Hayashibara et al., as used by Akka and Cassandra).
+# Instead of a fixed timeout it reports a suspicion level phi that grows with the time since
+# the last heartbeat, scaled by the mean and deviation of recent heartbeat inter-arrival times:
+# phi = 1 means about a 10% chance that the agent is merely late, phi = 2 about 1%, and so on.
+# Slow sweeps under load stretch the learnt intervals, so a loaded master does not suspect
+# agents just because it got to them late.
+
+
+class PhiAccrualDetector:
+    def __init__(self, expected_interval, window, min_std_deviation, acceptable_pause, now):
+        self.lock = Lock()
+        self.min_std_deviation = min_std_deviation
+        self.acceptable_pause = acceptable_pause # seconds added to the mean, e.g. the heartbeat timeout
+        # bootstrapped with the configured interval until real samples arrive
+        self.intervals = deque([expected_interval], maxlen=window)
+        self.total = expected_interval
+        self.squares = expected_interval ** 2
+        self.last_sample = now # last arrival that went into intervals
+        self.last_seen = now # last sign of life of any kind
+
+    def heartbeat(self, now, sample=True):
+        # sample=False only proves liveness (e.g. a pushed report), it does not enter the interval history
+        with self.lock:
+            if sample:
+                interval = now - self.last_sample
+                if len(self.intervals) == self.intervals.maxlen:
+                    evicted = self.intervals[0]
+                    self.total -= evicted
+                    self.squares -= evicted ** 2
+                self.intervals.append(interval)
+                self.total += interval
+                self.squares += interval ** 2
+                self.last_sample = now
+            self.last_seen = max(self.last_seen, now)
+
+    def phi(self, now):
+        with self.lock:
+            count = len(self.intervals)
+            mean = self.total / count
+            variance = max(0.0, self.squares / count - mean ** 2)
+            elapsed = now - self.last_seen
+        std_deviation = max(math.sqrt(variance), self.min_std_deviation)
+        mean += self.acceptable_pause
+        # logistic approximation of the normal cdf, as in Akka
+        y = (elapsed - mean) / std_deviation
+        e = math.exp(min(700.0, -y * (1.5976 + 0.070566 * y * y)))
+        if elapsed > mean:
+            p_later = e / (1.0 + e)
+        else:
+            p_later = 1.0 - 1.0 / (1.0 + e)
+        return -math.log10(max(p_later, 1e-300))
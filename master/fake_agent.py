@@ -0,0 +1,392 @@
+import time
+import uuid
+import heapq
+import itertools
+import random
+import argparse
+import http.client
+import socketserver
+import xmlrpc.client
+import xmlrpc.server
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from rpc_server import KeepAliveRequestHandler
+
+# Docker-free stand-in for agent/main.py with the same rpc surface (heartbeat, submit_job, stream_output,
+# stream_output_chunk, kill_job, prepull_image, system.multicall) and the same delta heartbeat and
+# pushed job state reports, so the master cannot tell it from a real agent.
+# One FakeAgentHost serves many fake agents on one port, agent i at http://host:port/agent/i,
+# and a /control endpoint for benchmarks (crash, revive, received).
+# usage: python fake_agent.py --master_url http://localhost:8888 [--agents 100] [--port 9000] [--job_duration 30]
+
+FAKE_IMAGE = 'fake/busybox:latest'
+TICK = 0.05 # seconds between job state advances and pushes of a host
+KEEPALIVE_TIMEOUT = 2 # seconds an idle master connection is held open
+PUSH_WORKERS = 64 # agents of a host pushing their job states at the same time
+LOG_LINE = b'fake output line\n'
+# latency: mean seconds added to every request (exponential), submit_failure: probability submit_job
+# raises a docker server error, start_delay: seconds a job is deploying, job_duration: mean seconds
+# a job runs (exponential, 0 runs until killed), job_failure: probability a job ends in fail,
+# kill_delay: seconds a killed job takes to exit, like a container that gets a die event after kill
+DEFAULT_MODEL = {'latency': 0.0, 'submit_failure': 0.0, 'start_delay': 0.1, 'job_duration': 30.0, 'job_failure': 0.0, 'kill_delay': 0.1}
+
+
+class FakeAgent(xmlrpc.server.SimpleXMLRPCDispatcher):
+    def __init__(self, cpu, memory, model):
+        super().__init__(allow_none=True, encoding=None)
+        self.cpu = cpu
+        self.memory = memory
+        self.model = dict(DEFAULT_MODEL, **model)
+        self.alive = True # a crashed agent answers every request with http 503
+        self.agent_id = None
+        self.lock = Lock()
+        self.jobs = {} # job_id -> resource limit of jobs not yet finished
+        self.job_states = OrderedDict() # job_id -> {'status', 'restart_count', 'seq'}, ordered by seq
+        self.state_seq = 0
+        self.epoch = str(uuid.uuid4())
+        self.acked_seq = None
+        self.master_proxy = None # own connection for pushed reports, like a real agent
+        self.events = [] # heap of (due time, tie breaker, job_id, container, from status or None for any live one, to status)
+        self.event_order = itertools.count()
+        self.containers = {} # job_id -> number of its current container, events of older ones are void
+        self.killed = set() # job ids whose container was killed but has not exited yet
+        self.received = {} # job_id -> time its first submit_job arrived
+        self.images = [{'refs': [FAKE_IMAGE], 'id': 'sha256:' + uuid.uuid4().hex, 'size': 0}]
+        self.images_version = str(uuid.uuid4())
+        self.register_function(self.heartbeat, 'heartbeat')
+        self.register_function(self.submit_job, 'submit_job')
+        self.register_function(self.stream_output, 'stream_output')
+        self.register_function(self.stream_output_chunk, 'stream_output_chunk')
+        self.register_function(self.kill_job, 'kill_job')
+        self.register_function(self.prepull_image, 'prepull_image')
+        self.register_introspection_functions()
+        self.register_multicall_functions()
+
+    def _marshaled_dispatch(self, data, dispatch_method=None, path=None):
+        if self.model['latency'] > 0:
+            time.sleep(random.expovariate(1 / self.model['latency']))
+        return super()._marshaled_dispatch(data, dispatch_method, path)
+
+    def set_state(self, job_id, status):
+        # self.lock held
+        self.state_seq += 1
+        self.job_states[job_id] = {'status': status, 'restart_count': 0, 'seq': self.state_seq}
+        self.job_states.move_to_end(job_id)
+        if status in ['end', 'fail']:
+            self.jobs.pop(job_id, None)
+            self.killed.discard(job_id)
+
+    def restart(self):
+        # a new agent run: its containers and job states are gone, the master gets a full report of the new epoch
+        with self.lock:
+            self.jobs = {}
+            self.job_states = OrderedDict()
+            self.state_seq = 0
+            self.epoch = str(uuid.uuid4())
+            self.acked_seq = None
+            self.events = []
+            self.containers = {}
+            self.killed = set()
+
+    def schedule(self, due, job_id, from_status, to_status):
+        # self.lock held
+        heapq.heappush(self.events, (due, next(self.event_order), job_id, self.containers[job_id], from_status, to_status))
+
+    def advance(self, now):
+        # apply the job state transitions due by now, returns whether any happened
+        changed = False
+        with self.lock:
+            while len(self.events) > 0 and self.events[0][0] <= now:
+                due, order, job_id, container, from_status, to_status = heapq.heappop(self.events)
+                status = self.job_states[job_id]['status']
+                if container != self.containers[job_id] or status in ['end', 'fail'] or from_status not in [None, status]:
+                    continue # killed or replaced meanwhile
+                self.set_state(job_id, to_status)
+                changed = True
+                if to_status == 'running' and self.model['job_duration'] > 0:
+                    end_status = 'fail' if random.random() < self.model['job_failure'] else 'end'
+                    self.schedule(due + random.expovariate(1 / self.model['job_duration']), job_id, 'running', end_status)
+        return changed
+
+    def state_changes(self, since_seq, epoch):
+        # same contract as job_state_changes of the real agent
+        with self.lock:
+            full = since_seq is None or epoch != self.epoch or since_seq > self.state_seq
+            job_attrs_list = []
+            for job_id in reversed(self.job_states):
+                job_state = self.job_states[job_id]
+                if not full and job_state['seq'] <= since_seq:
+                    break
+                job_attrs_list.append({'job_id': job_id, 'status': job_state['status'], 'restart_count': job_state['restart_count']})
+            return job_attrs_list, self.state_seq, full
+
+    def report(self):
+        # unacknowledged state changes as a report_job_states report, None when there are none
+        job_attrs_list, seq, full = self.state_changes(self.acked_seq, self.epoch)
+        if not full and len(job_attrs_list) == 0:
+            return None
+        return {'epoch': self.epoch, 'since_seq': None if full else self.acked_seq, 'seq': seq, 'full': full, 'job_attrs_list': job_attrs_list}
+
+    def push_job_states(self):
+        # like push_job_states of the real agent, over this agent's own master connection
+        report = self.report()
+        if report is None:
+            return
+        try:
+            ack = self.master_proxy.report_job_states(self.agent_id, report)
+        except xmlrpc.client.Fault:
+            # e.g. the master declared the agent dead
+            return
+        except (xmlrpc.client.ProtocolError, http.client.HTTPException, OSError) as err:
+            print("state push error:", str(err))
+            return
+        self.acked_seq = ack['acked_seq'] if ack['epoch'] == self.epoch else None
+
+    def usage(self):
+        with self.lock:
+            cpu = sum(limit['cpu'] for limit in self.jobs.values())
+            memory = sum(limit['memory'] for limit in self.jobs.values())
+        return min(100.0, 100.0 * cpu / self.cpu), min(100.0, 100.0 * memory / self.memory)
+
+    def job_usage(self):
+        # every running job uses its whole limit, in docker stats terms
+        with self.lock:
+            running = [(job_id, limit) for job_id, limit in self.jobs.items() if self.job_states[job_id]['status'] == 'running']
+        return {job_id: {'cpu': 100.0 * limit['cpu'], 'memory': 100.0, 'cpu_peak': 100.0 * limit['cpu'], 'memory_peak': 100.0} for job_id, limit in running}
+
+    def heartbeat(self, since_seq=None, epoch=None, known_images_version=None):
+        self.advance(time.time())
+        job_attrs_list, current_seq, full = self.state_changes(since_seq, epoch)
+        cpu_usage, memory_usage = self.usage()
+        pulse_data = {'cpu_usage': cpu_usage, 'memory_usage': memory_usage, 'cpu_peak': cpu_usage, 'memory_peak': memory_usage, 'job_usage': self.job_usage()}
+        pulse_data['job_attrs_list'] = job_attrs_list
+        pulse_data['epoch'] = self.epoch
+        pulse_data['since_seq'] = None if full else since_seq
+        pulse_data['seq'] = current_seq
+        pulse_data['full'] = full
+        pulse_data['images_version'] = self.images_version
+        if known_images_version != self.images_version:
+            pulse_data['images'] = self.images
+        return pulse_data
+
+    def submit_job(self, job_dict):
+        # same known job id rules as rpc_submit_job of the real agent: a live job is not started
+        # twice, one that finished or was killed gets a new container
+        now = time.time()
+        job_id = job_dict['job_id']
+        with self.lock:
+            if job_id in self.job_states and self.job_states[job_id]['status'] not in ['end', 'fail'] and job_id not in self.killed:
+                return True
+        if random.random() < self.model['submit_failure']:
+            raise xmlrpc.client.Fault(2, 'docker server error')
+        with self.lock:
+            self.received.setdefault(job_id, now)
+            self.jobs[job_id] = job_dict['resource_limit']
+            self.containers[job_id] = self.containers.get(job_id, 0) + 1
+            self.killed.discard(job_id)
+            self.set_state(job_id, 'deploying')
+            self.schedule(now + self.model['start_delay'], job_id, 'deploying', 'running')
+        return True
+
+    def job_status(self, job_id):
+        with self.lock:
+            if job_id not in self.job_states:
+                raise xmlrpc.client.Fault(1, 'job not exist')
+            return self.job_states[job_id]['status']
+
+    def stream_output(self, job_id):
+        self.job_status(job_id)
+        return LOG_LINE
+
+    def stream_output_chunk(self, job_id, offset=0, max_bytes=1024 * 1024, tail=None):
+        finished = self.job_status(job_id) in ['end', 'fail']
+        data = LOG_LINE[offset:offset + max_bytes] if tail is None else LOG_LINE[-tail:] if tail > 0 else b''
+        next_offset = len(LOG_LINE) if tail is not None else offset + len(data)
+        return {'data': data, 'offset': next_offset, 'complete': finished}
+
+    def kill_job(self, job_id):
+        # the job is reported failed once it exited, kill_delay later
+        if self.job_status(job_id) not in ['end', 'fail']:
+            with self.lock:
+                self.killed.add(job_id)
+                self.schedule(time.time() + self.model['kill_delay'], job_id, None, 'fail')
+        return True
+
+    def prepull_image(self, img_url):
+        image = {'refs': [img_url], 'id': 'sha256:' + uuid.uuid4().hex, 'size': 0}
+        with self.lock:
+            if all(img_url not in known['refs'] for known in self.images):
+                self.images = self.images + [image]
+                self.images_version = str(uuid.uuid4())
+        return image
+
+    def agent_dict(self, url):
+        return {'url': url, 'cpu': self.cpu, 'memory': self.memory, 'images': self.images, 'images_version': self.images_version}
+
+
+class FakeAgentRequestHandler(KeepAliveRequestHandler):
+    rpc_paths = () # every path, the host routes it to an agent
+
+    def do_POST(self):
+        agent = self.server.dispatchers.get(self.path)
+        if isinstance(agent, FakeAgent) and not agent.alive:
+            self.send_error(503, 'agent crashed')
+            return
+        super().do_POST()
+
+    def log_error(self, format, *args):
+        # every request to a crashed agent is a 503, not worth a line each
+        pass
+
+
+class FakeAgentHost(socketserver.ThreadingMixIn, xmlrpc.server.MultiPathXMLRPCServer):
+    # thread per connection: idle keep-alive connections of a thousand agents must not starve a worker pool
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, addr, keepalive_timeout=KEEPALIVE_TIMEOUT, batch_pushes=False):
+        super().__init__(addr, requestHandler=FakeAgentRequestHandler, logRequests=False, allow_none=True)
+        self.keepalive_timeout = keepalive_timeout
+        # pushes from every agent in one multicall over one connection instead of one connection
+        # per agent; lighter on the master than real agents are, only for very large fake clusters
+        self.batch_pushes = batch_pushes
+        self.agents = []
+        self.master_proxy = None
+        self.push_executor = ThreadPoolExecutor(max_workers=PUSH_WORKERS)
+        self.stopped = False
+        control = xmlrpc.server.SimpleXMLRPCDispatcher(allow_none=True, encoding=None)
+        control.register_function(self.crash, 'crash')
+        control.register_function(self.revive, 'revive')
+        control.register_function(self.restart, 'restart')
+        control.register_function(self.received, 'received')
+        control.register_function(lambda: [agent.agent_id for agent in self.agents], 'agent_ids')
+        self.add_dispatcher('/control', control)
+
+    def agent_url(self, index):
+        return 'http://%s:%d/agent/%d' % (self.server_address[0], self.server_address[1], index)
+
+    def add_agent(self, cpu, memory, model):
+        agent = FakeAgent(cpu, memory, model)
+        self.add_dispatcher('/agent/%d' % len(self.agents), agent)
+        self.agents.append(agent)
+        return agent
+
+    def crash(self, index):
+        self.agents[index].alive = False
+        return True
+
+    def revive(self, index):
+        self.agents[index].alive = True
+        return True
+
+    def restart(self, index):
+        self.agents[index].restart()
+        return True
+
+    def received(self):
+        # job_id -> time its first submit_job reached any agent of this host
+        received = {}
+        for agent in self.agents:
+            with agent.lock:
+                received.update(agent.received)
+        return received
+
+    def register(self, master_url):
+        with xmlrpc.client.ServerProxy(master_url, allow_none=True) as master:
+            for index, agent in enumerate(self.agents):
+                agent.agent_id = master.register_agent(agent.agent_dict(self.agent_url(index)))
+                agent.master_proxy = xmlrpc.client.ServerProxy(master_url, allow_none=True)
+        self.master_proxy = xmlrpc.client.ServerProxy(master_url, allow_none=True)
+
+    def push_job_states(self):
+        pushing = [agent for agent in self.agents if agent.alive and agent.agent_id is not None]
+        if self.batch_pushes:
+            self.push_batch(pushing)
+        else:
+            # agents push concurrently, each over its own connection
+            list(self.push_executor.map(FakeAgent.push_job_states, pushing))
+
+    def push_batch(self, agents):
+        # reports of every agent with unacknowledged changes in one multicall
+        pushing = []
+        batch_call = xmlrpc.client.MultiCall(self.master_proxy)
+        for agent in agents:
+            report = agent.report()
+            if report is None:
+                continue
+            batch_call.report_job_states(agent.agent_id, report)
+            pushing.append(agent)
+        if len(pushing) == 0:
+            return
+        results = batch_call()
+        for i, agent in enumerate(pushing):
+            try:
+                ack = results[i]
+            except xmlrpc.client.Fault:
+                # e.g. the master already declared the agent dead
+                continue
+            agent.acked_seq = ack['acked_seq'] if ack['epoch'] == agent.epoch else None
+
+    def tick(self):
+        while not self.stopped:
+            time.sleep(TICK)
+            now = time.time()
+            for agent in self.agents:
+                if agent.alive:
+                    agent.advance(now)
+            if self.master_proxy is None:
+                continue
+            try:
+                self.push_job_states()
+            except (xmlrpc.client.Fault, xmlrpc.client.ProtocolError, http.client.HTTPException, OSError) as err:
+                print("state push error:", str(err))
+
+    def start(self):
+        self.threads = []
+        for target in [self.serve_forever, self.tick]:
+            thread = Thread(target=target)
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        # stop ticking and pushing before the process exits and its executors shut down
+        self.stopped = True
+        self.shutdown()
+        for thread in self.threads:
+            thread.join()
+        self.push_executor.shutdown()
+
+
+def model_from_args(args):
+    return {key: getattr(args, key) for key in DEFAULT_MODEL}
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='docker-free fake agents')
+    parser.add_argument('--master_url', default='http://localhost:8888', type=str)
+    parser.add_argument('--agents', default=100, type=int)
+    parser.add_argument('--host', default='localhost', type=str)
+    parser.add_argument('--port', default=9000, type=int)
+    parser.add_argument('--cpu', default=32, type=int, help='cores per fake agent')
+    parser.add_argument('--memory', default=64, type=int, help='gigabytes per fake agent')
+    parser.add_argument('--batch_pushes', action='store_true', help='push every agent\'s job states in one multicall')
+    for key, value in DEFAULT_MODEL.items():
+        parser.add_argument('--' + key, default=value, type=float)
+    return parser
+
+
+if __name__ == '__main__':
+    args = get_parser().parse_args()
+    host = FakeAgentHost((args.host, args.port), batch_pushes=args.batch_pushes)
+    for i in range(args.agents):
+        host.add_agent(args.cpu, args.memory, model_from_args(args))
+    host.start()
+    host.register(args.master_url)
+    print('%d fake agents registered, serving on port %d' % (args.agents, args.port))
+    while True:
+        try:
+            time.sleep(1)
+        except KeyboardInterrupt:
+            quit()
@@ -0,0 +1,84 @@
+import json
+import sqlite3
+from threading import Lock
+from job_table import Job
+
+QUERY_BATCH_SIZE = 500 # job ids per IN (...) query, below sqlite's bound parameter limit
+
+# On-disk archive of finished jobs, so that the in-memory job table only holds live
+# and recently finished jobs. Backed by sqlite, lookups by job id go through its primary key.
+
+
+class JobArchive:
+    def __init__(self, path):
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'job_id TEXT PRIMARY KEY, agent_id TEXT, status TEXT, restart_count INTEGER, '
+            'finished_at REAL, job_dict TEXT)')
+        # pages filtered by status or agent are range scans on these
+        self.connection.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, job_id)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS jobs_agent ON jobs (agent_id, job_id)')
+        self.connection.commit()
+
+    def archive(self, archived_jobs):
+        # store a batch of Job objects in one transaction
+        rows = [(job.job_id, job.agent_id, job.status, job.restart_count, job.finished_at, json.dumps(job.spec)) for job in archived_jobs]
+        with self.lock:
+            self.connection.executemany('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?)', rows)
+            self.connection.commit()
+
+    def row_to_job(self, row):
+        job_id, agent_id, status, restart_count, finished_at, spec = row
+        job_dict = json.loads(spec)
+        job_dict['job_id'] = job_id
+        return Job(job_dict, agent_id, status, restart_count, finished_at)
+
+    def get(self, job_id):
+        # returns a detached copy of the archived Job (holding no spec table reference) or None
+        with self.lock:
+            row = self.connection.execute('SELECT * FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = self.row_to_job(row)
+        job.release_spec()
+        return job
+
+    def get_many(self, job_ids):
+        found = {}
+        for job_id in job_ids:
+            job = self.get(job_id)
+            if job is not None:
+                found[job_id] = job
+        return found
+
+    def get_statuses(self, job_ids):
+        # job_id -> status of the archived ones among job_ids
+        statuses = {}
+        job_ids = list(job_ids)
+        for start in range(0, len(job_ids), QUERY_BATCH_SIZE):
+            batch = job_ids[start:start + QUERY_BATCH_SIZE]
+            query = 'SELECT job_id, status FROM jobs WHERE job_id IN (%s)' % ', '.join('?' * len(batch))
+            with self.lock:
+                statuses.update(self.connection.execute(query, batch).fetchall())
+        return statuses
+
+    def page(self, status=None, agent_id=None, cursor=None, limit=100):
+        # up to limit (job_id, status, restart_count) rows after cursor in job id order
+        conditions = ['job_id > ?']
+        params = ['' if cursor is None else cursor]
+        if status is not None:
+            conditions.append('status = ?')
+            params.append(status)
+        if agent_id is not None:
+            conditions.append('agent_id = ?')
+            params.append(agent_id)
+        query = 'SELECT job_id, status, restart_count FROM jobs WHERE %s ORDER BY job_id LIMIT ?' % ' AND '.join(conditions)
+        params.append(limit)
+        with self.lock:
+            return self.connection.execute(query, params).fetchall()
+
+    def count(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM jobs').fetchone()[0]
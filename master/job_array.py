@@ -0,0 +1,130 @@
+import time
+from job_table import PENDING, DEPLOYING, RUNNING, END, FAIL, TERMINAL_STATUSES
+
+# Array jobs: one spec plus a parameter list or range, expanded into tasks lazily.
+# The array holds the spec template once and one status byte per task. A task only becomes a
+# Job in the job table (job id '<array_id>.<index>') when the master expands it for scheduling,
+# with '{<param>}' in every string of the spec replaced by the task's value.
+# Task statuses: 'queued' until expanded, then the status of its job. Counts per status are
+# kept as tasks change, so aggregate status does not walk the tasks.
+
+QUEUED = 'queued'
+TASK_STATUSES = (QUEUED, PENDING, DEPLOYING, RUNNING, END, FAIL) # index = status byte
+STATUS_CODES = {status: code for code, status in enumerate(TASK_STATUSES)}
+
+
+def task_array_id(job_id):
+    # array id of a task's job id, None for a plain job (uuids have no '.')
+    array_id, dot, index = job_id.rpartition('.')
+    return array_id if dot else None
+
+
+def task_index(job_id):
+    return int(job_id.rpartition('.')[2])
+
+
+def substitute(value, placeholder, text):
+    if isinstance(value, str):
+        return value.replace(placeholder, text)
+    if isinstance(value, list):
+        return [substitute(item, placeholder, text) for item in value]
+    if isinstance(value, dict):
+        return {key: substitute(item, placeholder, text) for key, item in value.items()}
+    return value
+
+
+def range_size(start, stop, step):
+    return max(0, (stop - start + step - (1 if step > 0 else -1)) // step)
+
+
+class JobArray:
+    def __init__(self, array_id, spec, param, values=None, value_range=None, next_index=0, killed=False, created_at=None):
+        # exactly one of values (list) and value_range ([start, stop, step]) is set
+        self.array_id = array_id
+        self.spec = spec # job dict template without 'array' and 'job_id'
+        self.param = param
+        self.values = values
+        self.value_range = value_range
+        if values is not None:
+            self.size = len(values)
+        else:
+            self.size = range_size(*value_range)
+        self.next_index = next_index # tasks below it are expanded
+        self.killed = killed
+        self.created_at = created_at if created_at is not None else time.time()
+        self.statuses = bytearray(self.size) # all QUEUED
+        self.counts = [0] * len(TASK_STATUSES)
+        self.counts[STATUS_CODES[QUEUED]] = self.size
+        self.live = set() # indexes of expanded tasks not known to be finished
+
+    def value(self, index):
+        if self.values is not None:
+            return self.values[index]
+        return self.value_range[0] + index * self.value_range[2]
+
+    def task_id(self, index):
+        return '%s.%d' % (self.array_id, index)
+
+    def task_dict(self, index):
+        job_dict = substitute(self.spec, '{%s}' % self.param, str(self.value(index)))
+        job_dict['job_id'] = self.task_id(index)
+        return job_dict
+
+    def set_status(self, index, status):
+        code = STATUS_CODES[status]
+        previous = self.statuses[index]
+        if previous == code:
+            return
+        self.counts[previous] -= 1
+        self.counts[code] += 1
+        self.statuses[index] = code
+        if status in TERMINAL_STATUSES:
+            self.live.discard(index)
+
+    def expanded(self, index):
+        # a new task left the queue as a pending job
+        self.set_status(index, PENDING)
+        self.live.add(index)
+        self.next_index = max(self.next_index, index + 1)
+
+    def kill_queued(self):
+        # tasks never expanded fail like a killed pending job, next_index stays where expansion stopped
+        self.killed = True
+        for index in range(self.next_index, self.size):
+            self.set_status(index, FAIL)
+
+    def active(self):
+        # tasks are left to expand
+        return not self.killed and self.next_index < self.size
+
+    def get_counts(self):
+        return {status: self.counts[code] for code, status in enumerate(TASK_STATUSES)}
+
+    def page(self, status=None, cursor=None, limit=100):
+        # up to limit (index, status) after task index cursor, optionally only tasks in status
+        code = STATUS_CODES.get(status) if status is not None else None
+        tasks = []
+        index = 0 if cursor is None else cursor + 1
+        while index < self.size and len(tasks) < limit:
+            if code is not None:
+                index = self.statuses.find(code, index)
+                if index < 0:
+                    break
+            tasks.append((index, TASK_STATUSES[self.statuses[index]]))
+            index += 1
+        return tasks
+
+    def to_record(self):
+        return {
+            'spec': self.spec,
+            'param': self.param,
+            'values': self.values,
+            'range': self.value_range,
+            'next_index': self.next_index,
+            'killed': self.killed,
+            'created_at': self.created_at
+        }
+
+    @classmethod
+    def from_record(cls, array_id, record):
+        return cls(array_id, record['spec'], record['param'], record['values'], record['range'], record['next_index'], record['killed'], record['created_at'])
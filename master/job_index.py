@@ -0,0 +1,87 @@
+from bisect import bisect_right, insort
+from threading import Lock
+
+# Secondary indexes over the in-memory job table, by status and by agent.
+# Every index is a list of job ids kept sorted, so a page starts with a bisect to the
+# cursor and its cost does not grow with the number of jobs in the table.
+
+
+def discard_sorted(job_ids, job_id):
+    del job_ids[bisect_right(job_ids, job_id) - 1]
+
+
+class JobIndex:
+    def __init__(self):
+        self.lock = Lock()
+        self.indexed = {} # job_id -> (status, agent_id) as last indexed
+        self.all_ids = []
+        self.by_status = {} # status -> sorted job ids
+        self.by_agent = {} # agent_id -> sorted job ids
+
+    def _insert(self, index, key, job_id):
+        if key not in index:
+            index[key] = []
+        insort(index[key], job_id)
+
+    def _remove(self, index, key, job_id):
+        job_ids = index[key]
+        discard_sorted(job_ids, job_id)
+        if len(job_ids) == 0:
+            del index[key]
+
+    def update(self, job):
+        # index a new job or re-index one whose status or agent changed
+        with self.lock:
+            previous = self.indexed.get(job.job_id)
+            if previous == (job.status, job.agent_id):
+                return
+            if previous is None:
+                insort(self.all_ids, job.job_id)
+            else:
+                if previous[0] != job.status:
+                    self._remove(self.by_status, previous[0], job.job_id)
+                if previous[1] != job.agent_id and previous[1] is not None:
+                    self._remove(self.by_agent, previous[1], job.job_id)
+            if previous is None or previous[0] != job.status:
+                self._insert(self.by_status, job.status, job.job_id)
+            if (previous is None or previous[1] != job.agent_id) and job.agent_id is not None:
+                self._insert(self.by_agent, job.agent_id, job.job_id)
+            self.indexed[job.job_id] = (job.status, job.agent_id)
+
+    def remove(self, job_id):
+        with self.lock:
+            previous = self.indexed.pop(job_id, None)
+            if previous is None:
+                return
+            discard_sorted(self.all_ids, job_id)
+            self._remove(self.by_status, previous[0], job_id)
+            if previous[1] is not None:
+                self._remove(self.by_agent, previous[1], job_id)
+
+    def page(self, status=None, agent_id=None, cursor=None, limit=100):
+        # up to limit job ids after cursor in job id order
+        with self.lock:
+            candidates = [self.all_ids]
+            if status is not None:
+                candidates.append(self.by_status.get(status, []))
+            if agent_id is not None:
+                candidates.append(self.by_agent.get(agent_id, []))
+            # walk the most selective index, check the other filter on the indexed values
+            job_ids = min(candidates, key=len)
+            start = 0 if cursor is None else bisect_right(job_ids, cursor)
+            results = []
+            for i in range(start, len(job_ids)):
+                job_status, job_agent_id = self.indexed[job_ids[i]]
+                if (status is None or job_status == status) and (agent_id is None or job_agent_id == agent_id):
+                    results.append(job_ids[i])
+                    if len(results) == limit:
+                        break
+            return results
+
+    def agent_job_ids(self, agent_id):
+        # every indexed job placed on agent_id, whatever its status
+        with self.lock:
+            return list(self.by_agent.get(agent_id, []))
+
+    def __len__(self):
+        return len(self.indexed)
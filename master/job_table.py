@@ -0,0 +1,100 @@
+import json
+import time
+from threading import Lock
+
+# Compact in-memory job representation.
+# - Job uses __slots__, no per-instance __dict__
+# - statuses are shared string constants, statuses decoded from rpc replies are mapped back onto them
+# - the submitted job dict (minus job_id) is interned: identical submissions share one spec
+
+# job status: pending, deploying, running, end, fail
+PENDING = 'pending'
+DEPLOYING = 'deploying'
+RUNNING = 'running'
+END = 'end'
+FAIL = 'fail'
+STATUSES = {status: status for status in [PENDING, DEPLOYING, RUNNING, END, FAIL]}
+TERMINAL_STATUSES = (END, FAIL)
+
+
+def intern_status(status):
+    return STATUSES.get(status, status)
+
+
+class SpecTable:
+    # refcounted table of job specs keyed by their canonical json
+    def __init__(self):
+        self.lock = Lock()
+        self.specs = {} # key -> [spec, refcount]
+
+    def acquire(self, job_dict):
+        spec = {key: value for key, value in job_dict.items() if key != 'job_id'}
+        key = json.dumps(spec, sort_keys=True)
+        with self.lock:
+            entry = self.specs.get(key)
+            if entry is None:
+                entry = self.specs[key] = [spec, 0]
+            entry[1] += 1
+            return key, entry[0]
+
+    def release(self, key):
+        with self.lock:
+            entry = self.specs[key]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.specs[key]
+
+    def __len__(self):
+        return len(self.specs)
+
+
+spec_table = SpecTable()
+
+
+class Job:
+    __slots__ = ('job_id', 'spec_key', 'spec', 'agent_id', 'status', 'restart_count', 'finished_at')
+
+    def __init__(self, job_dict, agent_id=None, status=PENDING, restart_count=0, finished_at=None):
+        self.job_id = job_dict['job_id']
+        self.spec_key, self.spec = spec_table.acquire(job_dict)
+        self.agent_id = agent_id
+        self.status = intern_status(status)
+        self.restart_count = restart_count
+        self.finished_at = finished_at
+        if self.finished_at is None and self.status in TERMINAL_STATUSES:
+            self.finished_at = time.time()
+
+    @property
+    def job_dict(self):
+        job_dict = dict(self.spec)
+        job_dict['job_id'] = self.job_id
+        return job_dict
+
+    @property
+    def resource_requirement(self):
+        return self.spec['resource_requirement']
+
+    def set_status(self, status):
+        self.status = intern_status(status)
+        if self.status in TERMINAL_STATUSES:
+            if self.finished_at is None:
+                self.finished_at = time.time()
+        else:
+            self.finished_at = None
+
+    def release_spec(self):
+        # call once the job leaves the table
+        spec_table.release(self.spec_key)
+
+    def to_record(self):
+        return {
+            'job_dict': self.job_dict,
+            'agent_id': self.agent_id,
+            'status': self.status,
+            'restart_count': self.restart_count,
+            'finished_at': self.finished_at
+        }
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(record['job_dict'], record['agent_id'], record['status'], record['restart_count'], record.get('finished_at'))
@@ -0,0 +1,58 @@
+import uuid
+import argparse
+import tracemalloc
+from job_table import Job
+
+# Resident memory of the master job table per 100k jobs: the old dict-per-job layout
+# with a private copy of every job dict versus job_table.Job.
+# usage: python job_table_bench.py [--jobs 100000]
+
+JOB_DICT = {
+    'img_url': 'qizixi/barcode-generator:v0',
+    'resource_requirement': {'cpu': 1, 'memory': 1},
+    'resource_limit': {'cpu': 1, 'memory': 1},
+    'restart': True,
+    'restart_times': 5
+}
+
+
+def new_job_dict():
+    # a fresh copy, as decoded from every xmlrpc submission
+    job_dict = {key: (dict(value) if isinstance(value, dict) else value) for key, value in JOB_DICT.items()}
+    job_dict['job_id'] = str(uuid.uuid4())
+    return job_dict
+
+
+def dict_jobs(job_count):
+    jobs = {}
+    for i in range(job_count):
+        job_dict = new_job_dict()
+        jobs[job_dict['job_id']] = {'job_dict': job_dict, 'agent_id': None, 'status': 'running', 'restart_count': 0}
+    return jobs
+
+
+def slotted_jobs(job_count):
+    jobs = {}
+    for i in range(job_count):
+        job = Job(new_job_dict(), status='running')
+        jobs[job.job_id] = job
+    return jobs
+
+
+def measure(build, job_count):
+    tracemalloc.start()
+    jobs = build(job_count)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size, jobs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='job table memory benchmark')
+    parser.add_argument('--jobs', default=100000, type=int)
+    args = parser.parse_args()
+    per = 100000 / args.jobs
+    for name, build in [('dict per job', dict_jobs), ('job_table.Job', slotted_jobs)]:
+        size, jobs = measure(build, args.jobs)
+        print('%-14s %8.1f MiB per 100k jobs' % (name, size * per / 1024 / 1024))
+        del jobs
@@ -0,0 +1,39 @@
+import time
+import argparse
+import xmlrpc.client
+from multiprocessing import Pool
+
+# Hammers a running master with concurrent clients and reports throughput per client count.
+# usage: python load_test.py --master_url http://localhost:8888 --clients 1,2,4,8 --duration 10
+# run it against a master in 'threaded' and in 'serial' RPC_SERVER_MODE to compare.
+
+
+def run_client(args):
+    master_url, method, duration = args
+    proxy = xmlrpc.client.ServerProxy(master_url)
+    calls = 0
+    errors = 0
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        try:
+            getattr(proxy, method)()
+            calls += 1
+        except (xmlrpc.client.Error, OSError):
+            errors += 1
+    return calls, errors
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='master rpc load test')
+    parser.add_argument('--master_url', default='http://localhost:8888', type=str)
+    parser.add_argument('--method', default='get_metrics', type=str, help='argument-less master rpc to call')
+    parser.add_argument('--clients', default='1,2,4,8,16', type=str, help='comma separated client process counts')
+    parser.add_argument('--duration', default=10, type=float, help='seconds per client count')
+    args = parser.parse_args()
+    print('%8s %12s %10s' % ('clients', 'calls/sec', 'errors'))
+    for client_count in [int(c) for c in args.clients.split(',')]:
+        with Pool(client_count) as pool:
+            results = pool.map(run_client, [(args.master_url, args.method, args.duration)] * client_count)
+        calls = sum(result[0] for result in results)
+        errors = sum(result[1] for result in results)
+        print('%8d %12.1f %10d' % (client_count, calls / args.duration, errors))
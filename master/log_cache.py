@@ -0,0 +1,51 @@
+from threading import Lock
+from collections import OrderedDict
+
+# LRU cache of job log chunks, bounded by the total number of cached log bytes.
+# Only immutable chunks belong here: a full chunk (its bytes never change once written)
+# or any chunk of a job that reached end/fail. Those stay valid until evicted.
+
+
+class LogChunkCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        self.entries = OrderedDict() # key -> (value, size), least recently used first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                evicted_key, (evicted_value, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
@@ -2,10 +2,26 @@ import re
 import time
 import uuid
 import http
+import queue
 import random
+import urllib.parse
 import xmlrpc.client
 import xmlrpc.server
-from threading import Thread, Lock
+import msgpack_rpc
+from threading import Thread, Lock, Event, Semaphore
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from scheduler import Scheduler
+from log_cache import LogChunkCache
+from state_store import StateStore
+from job_table import Job, PENDING, DEPLOYING, RUNNING, FAIL, TERMINAL_STATUSES, spec_table
+from job_array import JobArray, TASK_STATUSES, STATUS_CODES, QUEUED, task_array_id, task_index, range_size
+from job_archive import JobArchive
+from job_index import JobIndex
+from pending_queue import PendingQueue
+from failure_detector import PhiAccrualDetector
+from metrics import registry, TimedLock, MetricsRequestHandler, instrument_rpc_server, lock_wait
+from rpc_server import PooledXMLRPCServer
 
 class ImageNotFoundError(Exception):
     def __init__(self):
@@ -15,29 +31,172 @@ class ImageNotFoundError(Exception):
 MASTER_PORT = 8888
 MASTER_IP = 'localhost'
 HEARTBEAT_RATE = 10 # seconds
-CPR_PERIODS = [10, 30, 60] # reconnection time periods
+HEARTBEAT_WORKERS = 32 # max agents checked concurrently in one sweep
+HEARTBEAT_TIMEOUT = 5 # seconds, deadline for a single agent to answer a heartbeat
+# failure detection, see failure_detector.py. with regular heartbeats an agent that stops answering
+# goes to icu about HEARTBEAT_RATE + PHI_ACCEPTABLE_PAUSE + 1.3 deviations after its last heartbeat
+# and is declared dead (its jobs redeployed) about 5 deviations after it, deviations at least PHI_MIN_STD,
+# but never before it missed DEAD_MISSED_HEARTBEATS heartbeats in a row
+PHI_SUSPECT = 1 # suspicion level at which an agent goes to icu: no new jobs, still probed by heartbeats
+PHI_DEAD = 8 # suspicion level at which an agent is declared dead and its jobs are redeployed
+PHI_WINDOW = 100 # recent heartbeat inter-arrival times the detector learns from
+PHI_MIN_STD = 0.5 # seconds, floor of the inter-arrival deviation so that a small delay of a very regular agent is not fatal
+PHI_ACCEPTABLE_PAUSE = HEARTBEAT_TIMEOUT # seconds added to the expected interval, a heartbeat may take this long to answer
+DEAD_MISSED_HEARTBEATS = 2 # consecutive failed heartbeats before an agent can be declared dead, one timed out heartbeat is not fatal
+DEAD_PROBE_INTERVAL = 60 # seconds between heartbeats to a dead agent, one that answers again rejoins the cluster
+SUPERVISOR_INTERVAL = 0.5 # seconds between two evaluations of every agent's suspicion level
+SCHEDULING_POLICY = 'least_loaded' # one of scheduler.POLICIES: least_loaded, bin_packing, spread
+IMAGE_LOCALITY = True # prefer agents that already hold a job's image
+USAGE_AWARE_PLACEMENT = True # also keep capacity an agent measures as busy out of placement: cpu moving average, memory peak
+PREPULL_WORKERS = 16 # agents pulling an image in parallel for one prepull_image call
+SUBMIT_WORKERS = 16 # agents launched in parallel by one deploy batch
+FAILOVER_POLICY = 'spread' # placement policy for the jobs of a dead agent, spreads them over the survivors
+FAILOVER_WORKERS = 16 # agents launched in parallel when the jobs of a dead agent are redeployed
+DEPLOY_WORKERS = 4 # threads draining the deploy queue
+DEPLOY_BATCH_SIZE = 256 # max jobs a deploy worker places in one scheduling pass
+DEPLOY_QUEUE_SIZE = 10000 # max jobs waiting for deployment before submissions are rejected
+DEPLOY_QUEUE_TIMEOUT = 1 # seconds a submission waits for room in a full deploy queue
+ARRAY_BATCH_SIZE = 256 # max expanded tasks of one array waiting for an agent, more are expanded as these are placed
+MAX_ARRAY_SIZE = 1000000 # max tasks per array job
+LOG_CHUNK_SIZE = 1024 * 1024 # default bytes per output_chunk call
+MAX_LOG_CHUNK_SIZE = 8 * 1024 * 1024 # upper bound on max_bytes and tail of output_chunk
+LOG_CACHE_BYTES = 256 * 1024 * 1024 # byte budget of the master-side log chunk cache
+STATE_DIR = './master_state' # write-ahead log and snapshots of jobs and agents, None keeps state in memory only
+WAL_COMMIT_INTERVAL = 0.01 # seconds between group commits of the write-ahead log
+SNAPSHOT_INTERVAL = 300 # seconds between compacted snapshots of the master state
+ARCHIVE_PATH = './job_archive.db' # sqlite archive of finished jobs, None keeps every job in memory
+JOB_RETENTION = 3600 # seconds a finished job stays in memory before it is archived
+ARCHIVE_INTERVAL = 60 # seconds between archive sweeps
+RPC_SERVER_MODE = 'threaded' # 'threaded' serves requests on a worker pool, 'serial' one at a time
+RPC_WORKERS = 32 # max requests handled concurrently in threaded mode, idle keep-alive connections are parked and hold none
+RPC_REQUEST_TIMEOUT = 60 # seconds, socket timeout for reading a request and writing its response
+RPC_KEEPALIVE_TIMEOUT = 5 # seconds an idle keep-alive connection is held open in threaded mode
+AGENT_CONNECTIONS = 4 # keep-alive connections per agent for submit/kill/output calls, at most this many such calls to one agent at a time
+LIST_JOBS_LIMIT = 100 # default page size of list_jobs
+MAX_LIST_JOBS_LIMIT = 10000 # upper bound on the page size of list_jobs and on job ids per get_statuses call
+# 'msgpack' also serves the rpc methods as msgpack frames on MSGPACK_PORT and talks msgpack to agents
+# that offer it; everything falls back to xml-rpc when msgpack is not installed or not offered
+RPC_TRANSPORT = 'xmlrpc'
+MSGPACK_PORT = 8889
 
 # Global Variables
-# to maintain consistency, items shall not be deleted from agents and jobs
-agents = {} # agent_id -> {'proxy': xmlrpc.client.ServerProxy,'proxy_lock': Lock, 'cpu':int, 'cpu_usage': float, 'memory':float, 'memory_usage':float}
-agents_lock = Lock()
-jobs = {} # job_id -> {'status': str, 'agent_id': str, 'restart_count':int}
-jobs_lock = Lock()
+# to maintain consistency, items shall not be deleted from agents and jobs,
+# except finished jobs that move to the job archive after JOB_RETENTION
+agents = {} # agent_id -> {'proxy_pool': ProxyPool, 'msgpack_port': int or None, 'cpu':int, 'cpu_usage': float, 'cpu_peak': float, 'memory':float, 'memory_usage':float, 'memory_peak': float}
+agents_lock = TimedLock('agents_lock')
+jobs = {} # job_id -> job_table.Job
+job_index = JobIndex() # status and agent indexes over jobs, for list_jobs
+jobs_lock = TimedLock('jobs_lock')
+job_arrays = {} # array_id -> job_array.JobArray
+job_arrays_lock = TimedLock('job_arrays_lock') # also serializes task expansion, taken before jobs_lock
+scheduler = Scheduler(SCHEDULING_POLICY, IMAGE_LOCALITY, TimedLock('scheduler_lock'))
+log_cache = LogChunkCache(LOG_CACHE_BYTES)
+state_store = None # StateStore, opened at startup when STATE_DIR is set
+job_archive = None # JobArchive, opened at startup when ARCHIVE_PATH is set
+archive_stats = {'archived': 0, 'last_sweep_duration': 0.0}
+heartbeat_executor = ThreadPoolExecutor(max_workers=HEARTBEAT_WORKERS)
+submit_executor = ThreadPoolExecutor(max_workers=SUBMIT_WORKERS)
+prepull_executor = ThreadPoolExecutor(max_workers=PREPULL_WORKERS)
+failover_executor = ThreadPoolExecutor(max_workers=FAILOVER_WORKERS)
+# failovers run here one dead agent at a time, so supervise_agents never waits on one.
+# their launch batches go to failover_executor
+failover_runner = ThreadPoolExecutor(max_workers=1)
+deploy_queue = queue.Queue(maxsize=DEPLOY_QUEUE_SIZE) # job ids waiting to be placed and launched
+deploy_queued = set() # job ids currently in deploy_queue, so a job is never queued twice
+deploy_queued_lock = Lock()
+deploy_stats = {'enqueued': 0, 'rejected': 0, 'deployed': 0, 'failed': 0, 'unplaced': 0}
+pending_queue = PendingQueue() # jobs no agent has capacity for, retried when capacity changes
+capacity_changed = Event() # set whenever capacity may have been freed, wakes schedule_pending
+pending_stats = {'passes': 0, 'placed': 0, 'last_pass_duration': 0.0}
+failover_stats = {'failovers': 0, 'orphaned': 0, 'relaunched': 0, 'parked': 0, 'last_recover_duration': 0.0, 'max_recover_duration': 0.0}
+array_stats = {'submitted': 0, 'expanded': 0}
+stats_lock = Lock() # guards heartbeat_stats, deploy_stats, pending_stats, failover_stats and array_stats
+heartbeat_inflight = set() # agent ids whose heartbeat check has not returned yet
+heartbeat_inflight_lock = Lock()
+heartbeat_stats = {'sweep_count': 0, 'last_sweep_duration': 0.0, 'max_sweep_duration': 0.0, 'skipped_checks': 0, 'jobs_reported': 0, 'full_resyncs': 0, 'pushed_reports': 0, 'stale_reports': 0,
+                   'failed_checks': 0, 'suspected': 0, 'revived': 0, 'declared_dead': 0, 'rejoined': 0, 'lost_jobs': 0}
+# hot path timings for GET /metrics, the stats dicts above remain the get_metrics summary
+match_job_seconds = registry.histogram('match_job_seconds', 'match_job_to_agent, reserve and launch of one job')
+placement_pass_seconds = registry.histogram('placement_pass_seconds', 'scheduler pass placing one deploy batch')
+agent_launch_seconds = registry.histogram('agent_launch_seconds', 'submit_job multicall to one agent')
+heartbeat_check_seconds = registry.histogram('heartbeat_check_seconds', 'check_agent_heartbeat of one agent')
+heartbeat_sweep_seconds = registry.histogram('heartbeat_sweep_seconds', 'heartbeat sweep over all agents')
+failover_seconds = registry.histogram('failover_seconds', 'redeployment of the jobs of a dead agent')
+log_fetch_seconds = registry.histogram('log_fetch_seconds', 'log reads forwarded to an agent', ('kind',))
+proxy_pool_wait = lock_wait.labels('agent_proxy_pool')
+registry.gauge('deploy_queue_depth', 'jobs waiting in the deploy queue', lambda: deploy_queue.qsize())
+registry.gauge('pending_jobs', 'jobs waiting for capacity', lambda: len(pending_queue))
+registry.gauge('jobs_in_memory', 'jobs held in the job table', lambda: len(jobs))
+registry.gauge('agents_alive', 'agents in alive status', lambda: sum(1 for agent in list(agents.values()) if agent['status'] == 'alive'))
+registry.gauge('agents_icu', 'agents suspected by the failure detector', lambda: sum(1 for agent in list(agents.values()) if agent['status'] == 'icu'))
+
+
+class TimeoutTransport(xmlrpc.client.Transport):
+    # xmlrpc transport whose connections give up after `timeout` seconds
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        conn = super().make_connection(host)
+        conn.timeout = self.timeout
+        return conn
+
+
+class ProxyPool:
+    # up to `size` keep-alive connections to one server, each used by one thread at a time.
+    # both proxy types reconnect by themselves when the server has closed an idle connection
+    def __init__(self, new_proxy, size):
+        self.new_proxy = new_proxy
+        self.slots = Semaphore(size)
+        self.idle = queue.LifoQueue()
+
+    @contextmanager
+    def connection(self):
+        if not self.slots.acquire(False):
+            with proxy_pool_wait.time():
+                self.slots.acquire()
+        try:
+            try:
+                proxy = self.idle.get_nowait()
+            except queue.Empty:
+                proxy = self.new_proxy()
+            try:
+                yield proxy
+            finally:
+                self.idle.put(proxy)
+        finally:
+            self.slots.release()
+
+    def close(self):
+        while not self.idle.empty():
+            self.idle.get_nowait()('close')()
+
 
 # Internel Methods
 def get_id(id_type):
-    assert id_type in ['job', 'agent']
+    assert id_type in ['job', 'agent', 'array']
     if id_type == 'job':
         id = str(uuid.uuid4())
         while id in jobs:
             id = str(uuid.uuid4())
         return id
+    elif id_type == 'array':
+        id = str(uuid.uuid4())
+        while id in job_arrays:
+            id = str(uuid.uuid4())
+        return id
     else:
         id = str(uuid.uuid4())
         while id in agents:
             id = str(uuid.uuid4())
         return id
 
+def incr_stat(stats, key, amount=1):
+    with stats_lock:
+        stats[key] += amount
+
+
 def validate_url(input_url):
     url_regex = re.compile(
         r'^(?:http|ftp)s?://' # http:// or https://
@@ -49,15 +208,38 @@ def validate_url(input_url):
     return re.match(url_regex, input_url) is not None
 
 def validate_job(job_dict):
-    # client side has checked each field
-    if job_dict is not None:
-        return True
-    else:
+    # the fields the scheduler and the agents read, a batch entry failing this gets its own error
+    if not isinstance(job_dict, dict) or not isinstance(job_dict.get('img_url'), str) or 'restart' not in job_dict:
         return False
+    for key in ['resource_requirement', 'resource_limit']:
+        resources = job_dict.get(key)
+        if not isinstance(resources, dict):
+            return False
+        for name in ['cpu', 'memory']:
+            if not isinstance(resources.get(name), (int, float)) or isinstance(resources.get(name), bool):
+                return False
+    return True
+
+def validate_array(array_dict):
+    # returns (param, values, value_range) of a valid array dict, None otherwise
+    if not validate_job(array_dict) or not isinstance(array_dict.get('array'), dict):
+        return None
+    param = array_dict['array'].get('param')
+    values = array_dict['array'].get('values')
+    value_range = array_dict['array'].get('range')
+    if not isinstance(param, str) or len(param) == 0 or (values is None) == (value_range is None):
+        return None
+    if values is not None:
+        return (param, values, None) if isinstance(values, list) else None
+    if not isinstance(value_range, list) or len(value_range) not in [2, 3] or not all(isinstance(value, int) for value in value_range):
+        return None
+    if len(value_range) == 2:
+        value_range = value_range + [1]
+    return (param, None, value_range) if value_range[2] != 0 else None
 
 def validate_agent(agent_dict):
     if agent_dict is not None and 'cpu' in agent_dict and 'memory' in agent_dict and 'url' in agent_dict and validate_url(agent_dict['url']):
-        return True
+        return agent_dict.get('msgpack_port') is None or isinstance(agent_dict['msgpack_port'], int)
     else:
         return False    
 
@@ -68,7 +250,10 @@ def validate_proxy(agent_proxy):
         'heartbeat',
         'submit_job',
         'stream_output',
-        'kill_job'
+        'stream_output_chunk',
+        'kill_job',
+        'prepull_image',
+        'system.multicall'
     ]
     try:
         agent_methods = agent_proxy.system.listMethods()
@@ -87,96 +272,610 @@ def validate_proxy(agent_proxy):
         return False
 
 
+def use_msgpack(msgpack_port):
+    return RPC_TRANSPORT == 'msgpack' and msgpack_rpc.available and msgpack_port is not None
+
+
+def new_agent_proxy(url, msgpack_port, timeout=None):
+    # allow_none: agent rpcs take optional arguments, e.g. stream_output_chunk's tail and heartbeat's since_seq
+    if use_msgpack(msgpack_port):
+        return msgpack_rpc.MsgpackServerProxy(urllib.parse.urlsplit(url).hostname, msgpack_port, timeout)
+    if timeout is not None:
+        return xmlrpc.client.ServerProxy(url, transport=TimeoutTransport(timeout), allow_none=True)
+    return xmlrpc.client.ServerProxy(url, allow_none=True)
+
+
 # core feature: resource matching
-def match_job_to_agent(job_dict):
-    # find qualified agent with least workload to do the job
-    for agent_id in list(agents):
-        if agents[agent_id]['status'] in ['icu', 'dead']:
-            continue
-        candidates = []
-        if agents[agent_id]['cpu'] >= job_dict['resource_requirement']['cpu'] and agents[agent_id]['memory'] >= job_dict['resource_requirement']['memory']:
-            candidates.append(agent_id)
-        candidates.sort(key=lambda agent_id : agents[agent_id]['cpu_usage'])
-        candidates.sort(key=lambda agent_id : agents[agent_id]['memory_usage'])
-        for agent_id in candidates:
+def launch_job(agent_id, job_dict):
+    # run the job on the agent its capacity was reserved on, returns whether the agent took it
+    try:
+        with agents[agent_id]['proxy_pool'].connection() as proxy:
+            return proxy.submit_job(job_dict)
+    except xmlrpc.client.Fault as err:
+        if err.faultCode == 1:
+            raise ImageNotFoundError()
+    except (xmlrpc.client.ProtocolError, http.client.HTTPException, OSError):
+        pass
+    return False
+
+
+def launch_jobs(agent_id, job_dicts):
+    # launch several jobs on one agent in a single system.multicall round trip.
+    # returns one entry per job: True launched, False refused, or an ImageNotFoundError
+    try:
+        with agents[agent_id]['proxy_pool'].connection() as proxy, agent_launch_seconds.time():
+            multicall = xmlrpc.client.MultiCall(proxy)
+            for job_dict in job_dicts:
+                multicall.submit_job(job_dict)
+            results = multicall()
+    except (xmlrpc.client.ProtocolError, xmlrpc.client.Fault, http.client.HTTPException, OSError):
+        return [False] * len(job_dicts)
+    launched = []
+    for i in range(len(job_dicts)):
+        try:
+            launched.append(bool(results[i]))
+        except xmlrpc.client.Fault as err:
+            launched.append(ImageNotFoundError() if err.faultCode == 1 else False)
+    return launched
+
+
+def match_job_to_agent(job_dict, exclude=()):
+    # reserve capacity on the agent picked by the scheduling policy, then launch the job there.
+    # agents that refuse the job are excluded and the next best one is tried.
+    job_id = job_dict['job_id']
+    tried = set(exclude)
+    with match_job_seconds.time():
+        while True:
+            agent_id = scheduler.reserve(job_id, job_dict['resource_requirement'], exclude=tried, image=job_dict['img_url'])
+            if agent_id is None:
+                # no qualified agent
+                return None
             try:
-                submission_result = False
-                with agents[agent_id]['proxy_lock']:
-                    submission_result = agents[agent_id]['proxy'].submit_job(job_dict)
-                if submission_result:
+                if launch_job(agent_id, job_dict):
                     return agent_id
-            except xmlrpc.client.Fault as err:
-                if err.faultCode == 1:
-                    raise ImageNotFoundError()
-            except xmlrpc.client.ProtocolError as ignored:
-                continue
-            except ConnectionRefusedError as ignored:
+            except ImageNotFoundError:
+                scheduler.release(job_id)
+                raise
+            scheduler.release(job_id)
+            tried.add(agent_id)
+
+
+# persistence: call with jobs_lock / agents_lock held so that the log order matches the order of the changes
+def persist_job(job_id, fields):
+    if state_store is not None:
+        return state_store.log_job(job_id, fields)
+    return 0
+
+
+def persist_agent(agent_id, fields):
+    if state_store is not None:
+        return state_store.log_agent(agent_id, fields)
+    return 0
+
+
+def persist_array(array_id, fields):
+    if state_store is not None:
+        return state_store.log_array(array_id, fields)
+    return 0
+
+
+def wait_persisted(seq):
+    if state_store is not None:
+        state_store.wait_durable(seq)
+
+
+def lookup_job(job_id):
+    # live job from the job table, or a copy of an archived one, or None
+    with jobs_lock:
+        job = jobs.get(job_id)
+    if job is None and job_archive is not None:
+        job = job_archive.get(job_id)
+    return job
+
+
+def record_job(job_dict):
+    # new jobs start as pending, the deploy pipeline places and launches them.
+    # returns the state store seq to wait on before handing out the job id
+    new_job = Job(job_dict)
+    with jobs_lock:
+        jobs[new_job.job_id] = new_job
+        job_index.update(new_job)
+        return persist_job(new_job.job_id, new_job.to_record())
+
+
+def forget_job(job_id):
+    # only for jobs whose id was never handed out
+    with jobs_lock:
+        jobs.pop(job_id).release_spec()
+        job_index.remove(job_id)
+        if state_store is not None:
+            state_store.log_job_deleted(job_id)
+
+
+def set_job_placement(job_id, agent_id):
+    # record the agent a pending job was launched on, or park the job when agent_id is None.
+    # a job stays pending while its launch rpc is in flight; one killed meanwhile is left
+    # failed, its reservation given back and the container just started killed
+    with jobs_lock:
+        job = jobs[job_id]
+        killed = job.status != PENDING
+        if killed:
+            pass
+        elif agent_id is not None:
+            job.agent_id = agent_id
+            job.set_status(DEPLOYING)
+            job.restart_count = 0
+            persist_job(job_id, {'agent_id': agent_id, 'status': DEPLOYING, 'restart_count': 0})
+            incr_stat(deploy_stats, 'deployed')
+        else:
+            persist_job(job_id, {'status': PENDING})
+            incr_stat(deploy_stats, 'unplaced')
+        job_index.update(job)
+    if killed:
+        scheduler.release(job_id)
+        capacity_changed.set()
+        if agent_id is not None:
+            kill_launched_job(agent_id, job_id)
+    elif agent_id is None:
+        park_pending(job_id)
+
+
+def kill_launched_job(agent_id, job_id):
+    try:
+        with agents[agent_id]['proxy_pool'].connection() as proxy:
+            proxy.kill_job(job_id)
+    except (xmlrpc.client.Error, http.client.HTTPException, OSError) as err:
+        print("job %s was killed during its launch, killing it on agent %s failed: %s" % (job_id, agent_id, err))
+
+
+def set_job_failed(job_id):
+    with jobs_lock:
+        jobs[job_id].set_status(FAIL)
+        job_index.update(jobs[job_id])
+        persist_job(job_id, {'status': FAIL, 'finished_at': jobs[job_id].finished_at})
+    # the caller released its reservation, an array task also makes room for the next ones
+    capacity_changed.set()
+
+
+def enqueue_deploy(job_id, timeout=None):
+    # returns False if the job could not be queued; with timeout=None a full queue is not waited on
+    with deploy_queued_lock:
+        if job_id in deploy_queued:
+            return True
+        deploy_queued.add(job_id)
+    try:
+        if timeout is None:
+            deploy_queue.put_nowait(job_id)
+        else:
+            deploy_queue.put(job_id, timeout=timeout)
+    except queue.Full:
+        with deploy_queued_lock:
+            deploy_queued.discard(job_id)
+        incr_stat(deploy_stats, 'rejected')
+        return False
+    incr_stat(deploy_stats, 'enqueued')
+    return True
+
+
+def launch_batch_on_agent(agent_id, job_ids):
+    # launch the jobs a deploy pass placed on one agent, falling back to a fresh match on refusal
+    for job_id, launched in zip(job_ids, launch_jobs(agent_id, [jobs[job_id].job_dict for job_id in job_ids])):
+        if isinstance(launched, ImageNotFoundError):
+            scheduler.release(job_id)
+            set_job_failed(job_id)
+            incr_stat(deploy_stats, 'failed')
+            continue
+        if launched:
+            set_job_placement(job_id, agent_id)
+        else:
+            redeploy_job(job_id, exclude=(agent_id,))
+
+
+def deploy_jobs(job_ids):
+    # place a batch of pending jobs in one scheduling pass and launch them, agents in parallel
+    for job_id in job_ids:
+        if job_id not in jobs or jobs[job_id].status in TERMINAL_STATUSES:
+            # killed after a pending pass reserved capacity for it
+            scheduler.release(job_id)
+    job_ids = [job_id for job_id in job_ids if job_id in jobs and jobs[job_id].status == PENDING]
+    requests = [(job_id, jobs[job_id].resource_requirement, jobs[job_id].spec['img_url']) for job_id in job_ids]
+    with placement_pass_seconds.time():
+        placements = scheduler.reserve_many(requests)
+    job_ids_by_agent = {}
+    for job_id, agent_id in zip(job_ids, placements):
+        if agent_id is None:
+            incr_stat(deploy_stats, 'unplaced')
+            park_pending(job_id)
+        else:
+            job_ids_by_agent.setdefault(agent_id, []).append(job_id)
+    futures = [submit_executor.submit(launch_batch_on_agent, agent_id, agent_job_ids) for agent_id, agent_job_ids in job_ids_by_agent.items()]
+    for future in futures:
+        future.result()
+
+
+def deploy_worker():
+    while True:
+        job_ids = [deploy_queue.get()]
+        while len(job_ids) < DEPLOY_BATCH_SIZE:
+            try:
+                job_ids.append(deploy_queue.get_nowait())
+            except queue.Empty:
+                break
+        with deploy_queued_lock:
+            deploy_queued.difference_update(job_ids)
+        try:
+            deploy_jobs(job_ids)
+            if any(task_array_id(job_id) is not None for job_id in job_ids):
+                # placed tasks make room for the next ones of their arrays
+                feed_arrays()
+        except Exception as err:
+            # keep the worker alive, jobs left pending wait for capacity like unplaced ones
+            print("deploy worker error:", str(err))
+            for job_id in job_ids:
+                if job_id in jobs and jobs[job_id].status == PENDING:
+                    scheduler.release(job_id)
+                    park_pending(job_id)
+            capacity_changed.set()
+
+
+def start_deploy_workers():
+    for i in range(DEPLOY_WORKERS):
+        deploy_thread = Thread(target=deploy_worker)
+        deploy_thread.setDaemon(True)
+        deploy_thread.start()
+    pending_thread = Thread(target=schedule_pending)
+    pending_thread.setDaemon(True)
+    pending_thread.start()
+
+
+# Pending Jobs
+def park_pending(job_id):
+    job = jobs.get(job_id)
+    if job is not None:
+        pending_queue.push(job_id, job.spec.get('priority', 0))
+
+
+def schedule_pending():
+    # event driven: the pending queue is only walked after capacity may have changed
+    # (agent registered or revived, job finished), never on a timer
+    while True:
+        capacity_changed.wait()
+        capacity_changed.clear()
+        try:
+            pending_pass()
+            feed_arrays()
+        except Exception as err:
+            # keep the thread alive, jobs left queued are retried on the next capacity change
+            print("pending scheduler error:", str(err))
+        if capacity_changed.is_set():
+            # deploy queue full, give the workers time before the next pass
+            time.sleep(DEPLOY_QUEUE_TIMEOUT)
+
+
+def pending_pass():
+    pass_start = time.time()
+    # requirements that failed in this pass; a job needing at least as much cannot fit either
+    failed_requirements = []
+
+    def try_place(job_id):
+        job = jobs.get(job_id)
+        if job is None or job.status != PENDING:
+            return None
+        requirement = job.resource_requirement
+        for cpu, memory in failed_requirements:
+            if requirement['cpu'] >= cpu and requirement['memory'] >= memory:
+                return False
+        if scheduler.reserve(job_id, requirement, image=job.spec['img_url']) is None:
+            failed_requirements.append((requirement['cpu'], requirement['memory']))
+            return False
+        return True
+
+    placed = pending_queue.drain(try_place)
+    for job_id in placed:
+        # the reservation made here is picked up by the deploy worker
+        if not enqueue_deploy(job_id, timeout=DEPLOY_QUEUE_TIMEOUT):
+            scheduler.release(job_id)
+            park_pending(job_id)
+            capacity_changed.set()
+    with stats_lock:
+        pending_stats['passes'] += 1
+        pending_stats['placed'] += len(placed)
+        pending_stats['last_pass_duration'] = time.time() - pass_start
+
+
+# Array Jobs
+def refresh_array(job_array):
+    # pull the statuses of the array's live tasks from the job table, job_arrays_lock held
+    missing = []
+    with jobs_lock:
+        for index in list(job_array.live):
+            job = jobs.get(job_array.task_id(index))
+            if job is None:
+                missing.append(job_array.task_id(index))
+            else:
+                job_array.set_status(index, job.status)
+    if len(missing) > 0:
+        # only finished jobs leave the table, for the archive
+        statuses = job_archive.get_statuses(missing) if job_archive is not None else {}
+        for task_id in missing:
+            job_array.set_status(task_index(task_id), statuses.get(task_id, FAIL))
+
+
+def feed_arrays():
+    # expand the next tasks of every array, keeping at most ARRAY_BATCH_SIZE of its expanded tasks
+    # waiting for an agent. runs after deploy batches with array tasks and after pending passes,
+    # so an array grows as fast as its tasks are placed and stops growing while the cluster is full
+    with job_arrays_lock:
+        for job_array in [job_array for job_array in job_arrays.values() if job_array.active()]:
+            refresh_array(job_array)
+            waiting = job_array.counts[STATUS_CODES[PENDING]]
+            count = min(ARRAY_BATCH_SIZE - waiting, job_array.size - job_array.next_index)
+            if count <= 0:
                 continue
-    # no qualified agent
-    return None
+            task_ids = []
+            for index in range(job_array.next_index, job_array.next_index + count):
+                record_job(job_array.task_dict(index))
+                job_array.expanded(index)
+                task_ids.append(job_array.task_id(index))
+            # logged after its tasks, recover_arrays also counts the recovered ones
+            persist_array(job_array.array_id, {'next_index': job_array.next_index})
+            incr_stat(array_stats, 'expanded', count)
+            parked = False
+            for task_id in task_ids:
+                if not enqueue_deploy(task_id):
+                    park_pending(task_id)
+                    parked = True
+            if parked:
+                capacity_changed.set()
+
+
+def recover_arrays():
+    # rebuild task statuses from the recovered job table and the archive, tasks of an
+    # expansion whose next_index was not logged yet are found in the job table
+    for job_id, job in jobs.items():
+        job_array = job_arrays.get(task_array_id(job_id))
+        if job_array is not None:
+            job_array.expanded(task_index(job_id))
+            job_array.set_status(task_index(job_id), job.status)
+    for job_array in job_arrays.values():
+        missing = [job_array.task_id(index) for index in range(job_array.next_index) if job_array.statuses[index] == STATUS_CODES[QUEUED]]
+        statuses = job_archive.get_statuses(missing) if job_archive is not None and len(missing) > 0 else {}
+        for task_id in missing:
+            job_array.set_status(task_index(task_id), statuses.get(task_id, FAIL))
+        if job_array.killed:
+            job_array.kill_queued()
 
 
 # RPC Methods
 def rpc_submit_job(job_dict):
+    # returns as soon as the job is recorded, placement and launch happen in the deploy workers
     if not validate_job(job_dict):
         raise xmlrpc.client.Fault(1, 'invalid job dict')
     job_id = get_id('job')
     job_dict['job_id'] = job_id
-    try:
-        agent_id = match_job_to_agent(job_dict)
-    except ImageNotFoundError:
-        raise xmlrpc.client.Fault(1, 'invalid job dict: docker image not exist')
-    new_job = {}
-    new_job['job_dict'] = job_dict
-    new_job['agent_id'] = agent_id
-    if agent_id is None:
-        new_job['status'] = 'pending'
-    else:
-        new_job['status'] = 'deploying'
-    new_job['restart_count'] = 0
-    with jobs_lock:
-        jobs[job_id] = new_job
+    persisted_seq = record_job(job_dict)
+    if not enqueue_deploy(job_id, timeout=DEPLOY_QUEUE_TIMEOUT):
+        # never handed out, safe to forget
+        forget_job(job_id)
+        raise xmlrpc.client.Fault(2, 'master busy: deploy queue full')
+    wait_persisted(persisted_seq)
     return job_id
 
 
-def rpc_register_agent(agent_dict):
-    if not validate_agent(agent_dict):
-        raise xmlrpc.client.Fault(1, 'invalid agent dict')
-    agent_id = get_id('agent')
+def rpc_submit_jobs(job_dict_list):
+    # batch submission in one round trip, the deploy workers place queued jobs in batched scheduling passes.
+    # returns one entry per job dict, either {'job_id': str} or {'error': str}
+    if not isinstance(job_dict_list, list):
+        raise xmlrpc.client.Fault(1, 'a list of job dicts is expected')
+    results = []
+    persisted_seq = 0
+    for job_dict in job_dict_list:
+        if not validate_job(job_dict):
+            results.append({'error': 'invalid job dict'})
+            continue
+        job_id = get_id('job')
+        job_dict['job_id'] = job_id
+        persisted_seq = record_job(job_dict)
+        if enqueue_deploy(job_id, timeout=DEPLOY_QUEUE_TIMEOUT):
+            results.append({'job_id': job_id})
+        else:
+            forget_job(job_id)
+            results.append({'error': 'master busy: deploy queue full'})
+    # one wait covers the whole batch, the records share group commits
+    wait_persisted(persisted_seq)
+    return results
+
+
+def rpc_submit_array(array_dict):
+    # one job dict for many tasks: array_dict['array'] is {'param': name, 'values': [...]} or
+    # {'param': name, 'range': [start, stop] or [start, stop, step]}, every '{name}' in the
+    # strings of the job dict is replaced by the task's value. the spec is stored once and
+    # tasks are expanded as the cluster takes them, see feed_arrays. returns the array id
+    validated = validate_array(array_dict)
+    if validated is None:
+        raise xmlrpc.client.Fault(1, 'invalid array dict')
+    param, values, value_range = validated
+    size = len(values) if values is not None else range_size(*value_range)
+    if size == 0 or size > MAX_ARRAY_SIZE:
+        raise xmlrpc.client.Fault(2, 'an array holds 1 to %d tasks' % MAX_ARRAY_SIZE)
+    spec = {key: value for key, value in array_dict.items() if key not in ['array', 'job_id']}
+    array_id = get_id('array')
+    job_array = JobArray(array_id, spec, param, values, value_range)
+    with job_arrays_lock:
+        job_arrays[array_id] = job_array
+        persisted_seq = persist_array(array_id, job_array.to_record())
+    wait_persisted(persisted_seq)
+    incr_stat(array_stats, 'submitted')
+    feed_arrays()
+    return array_id
+
+
+def rpc_get_array_status(array_id, status=None, cursor=None, limit=0):
+    # task counts per status, 'queued' for tasks not expanded yet. limit > 0 adds one page of
+    # tasks in index order, only those in status if given; pass the returned cursor back for
+    # the next page, it is None after the last one
+    if limit < 0 or limit > MAX_LIST_JOBS_LIMIT:
+        raise xmlrpc.client.Fault(2, 'limit must be between 0 and %d' % MAX_LIST_JOBS_LIMIT)
+    if status is not None and status not in TASK_STATUSES:
+        raise xmlrpc.client.Fault(3, 'unknown task status: %s' % status)
+    with job_arrays_lock:
+        job_array = job_arrays.get(array_id)
+        if job_array is None:
+            raise xmlrpc.client.Fault(1, 'array id not exist')
+        refresh_array(job_array)
+        array_status = {'array_id': array_id, 'size': job_array.size, 'killed': job_array.killed, 'counts': job_array.get_counts()}
+        if limit > 0:
+            tasks = job_array.page(status, cursor, limit)
+            array_status['tasks'] = [{'job_id': job_array.task_id(index), 'index': index, 'value': job_array.value(index), 'status': task_status} for index, task_status in tasks]
+            array_status['cursor'] = tasks[-1][0] if len(tasks) == limit else None
+    return array_status
+
+
+def rpc_kill_array(array_id):
+    # tasks not expanded yet fail right away, expanded ones are killed like kill_job
+    with job_arrays_lock:
+        job_array = job_arrays.get(array_id)
+        if job_array is None:
+            raise xmlrpc.client.Fault(1, 'array id not exist')
+        refresh_array(job_array)
+        job_array.kill_queued()
+        persist_array(array_id, {'killed': True})
+        task_ids = [job_array.task_id(index) for index in sorted(job_array.live)]
+    for task_id in task_ids:
+        try:
+            rpc_kill_job(task_id)
+        except xmlrpc.client.Fault as err:
+            print("kill %s failed: %s" % (task_id, err.faultString))
+    return True
+
+
+def add_agent(agent_id, agent_dict, status):
     new_agent = {}
-    new_agent['status'] = 'alive' # agent status in ['alive', 'icu', 'dead']
+    new_agent['status'] = status # agent status in ['alive', 'icu', 'dead']
+    new_agent['url'] = agent_dict['url']
     new_agent['cpu'] = agent_dict['cpu']
     new_agent['memory'] = agent_dict['memory']
-    agent_proxy = xmlrpc.client.ServerProxy(agent_dict['url']) 
-    if not validate_proxy(agent_proxy):
-        raise xmlrpc.client.Fault(2, 'invalid agent rpc server')
-    else:    
-        new_agent['proxy'] = agent_proxy
-    new_agent['proxy_lock'] = Lock()
+    new_agent['msgpack_port'] = agent_dict.get('msgpack_port')
+    new_agent['proxy_pool'] = ProxyPool(lambda: new_agent_proxy(agent_dict['url'], new_agent['msgpack_port']), AGENT_CONNECTIONS)
+    # heartbeats use their own connection so that they never queue behind a slow submit_job
+    new_agent['heartbeat_proxy'] = new_agent_proxy(agent_dict['url'], new_agent['msgpack_port'], HEARTBEAT_TIMEOUT)
+    new_agent['heartbeat_lock'] = Lock()
+    # orders job state reports, pushed by the agent or carried by heartbeats, see apply_job_states
+    new_agent['state_lock'] = Lock()
+    # heartbeat arrivals, read by supervise_agents
+    new_agent['detector'] = PhiAccrualDetector(HEARTBEAT_RATE, PHI_WINDOW, PHI_MIN_STD, PHI_ACCEPTABLE_PAUSE, time.time())
+    new_agent['missed_heartbeats'] = 0 # failed heartbeats since the last answer or push
+    new_agent['last_probe'] = 0 # last heartbeat to the agent while dead
+    new_agent['failover'] = None # Future of the failover of its jobs, the agent cannot rejoin before it is done
+    # last state seq applied from this agent and the agent run it belongs to, see request_pulse
+    new_agent['heartbeat_seq'] = None
+    new_agent['heartbeat_epoch'] = None
+    # images held by the agent, [{'refs': [tags and digests], 'id': str, 'size': int}], and their version
+    new_agent['images'] = agent_dict.get('images', [])
+    new_agent['images_version'] = agent_dict.get('images_version')
     new_agent['cpu_usage'] = 0.01 # set to nonzero small value for resource matching algorithm
     new_agent['memory_usage'] = 0.01
+    new_agent['cpu_peak'] = 0.01
+    new_agent['memory_peak'] = 0.01
     with agents_lock:
         agents[agent_id] = new_agent
+        persisted_seq = persist_agent(agent_id, {'url': new_agent['url'], 'msgpack_port': new_agent['msgpack_port'], 'cpu': new_agent['cpu'], 'memory': new_agent['memory'], 'status': status})
+    if status != 'dead':
+        scheduler.add_agent(agent_id, new_agent['cpu'], new_agent['memory'])
+        scheduler.set_agent_images(agent_id, image_refs(new_agent['images']))
+        capacity_changed.set()
+    return persisted_seq
+
+
+def image_refs(images):
+    return [ref for image in images for ref in image['refs']]
+
+
+def set_agent_images(agent_id, images, images_version):
+    with agents_lock:
+        agents[agent_id]['images'] = images
+        agents[agent_id]['images_version'] = images_version
+    scheduler.set_agent_images(agent_id, image_refs(images))
+
+
+def set_agent_status(agent_id, status):
+    with agents_lock:
+        agents[agent_id]['status'] = status
+        persist_agent(agent_id, {'status': status})
+
+
+def rpc_register_agent(agent_dict):
+    if not validate_agent(agent_dict):
+        raise xmlrpc.client.Fault(1, 'invalid agent dict')
+    agent_id = get_id('agent')
+    with xmlrpc.client.ServerProxy(agent_dict['url'], allow_none=True) as agent_proxy:
+        valid_proxy = validate_proxy(agent_proxy)
+    if not valid_proxy:
+        raise xmlrpc.client.Fault(2, 'invalid agent rpc server')
+    if use_msgpack(agent_dict.get('msgpack_port')):
+        try:
+            with new_agent_proxy(agent_dict['url'], agent_dict['msgpack_port']) as agent_proxy:
+                valid_proxy = validate_proxy(agent_proxy)
+        except OSError as err:
+            print("connection error:", str(err))
+            valid_proxy = False
+        if not valid_proxy:
+            # fall back to xml-rpc for this agent
+            agent_dict = dict(agent_dict, msgpack_port=None)
+    wait_persisted(add_agent(agent_id, agent_dict, 'alive'))
     print('agent added')
-    return True
+    # the agent pushes its job state reports under this id
+    return agent_id
 
 
 def rpc_get_status(job_id):
-    if job_id not in jobs:
+    job = lookup_job(job_id)
+    if job is None:
         raise xmlrpc.client.Fault(1, 'job id not exist')
     else:
-        return jobs[job_id]['status']
+        return job.status
 
 
-def rpc_kill_job(job_id):
-    if job_id not in jobs:
+def rpc_get_job_usage(job_id):
+    # cpu and memory use of a running job's container in percent: moving averages and recent
+    # peaks sampled by its agent, as of the agent's last heartbeat
+    job = lookup_job(job_id)
+    if job is None:
         raise xmlrpc.client.Fault(1, 'job id not exist')
-    if jobs[job_id]['status'] in ['end', 'fail']:
-        return True
-    agent_id = jobs[job_id]['agent_id']
+    if job.status != RUNNING:
+        raise xmlrpc.client.Fault(2, 'job not running')
+    with agents_lock:
+        usage = agents[job.agent_id].get('job_usage', {}).get(job_id)
+    if usage is None:
+        raise xmlrpc.client.Fault(3, 'job usage not sampled yet')
+    return usage
+
+
+def rpc_kill_job(job_id):
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if job is None:
+            if job_archive is not None and job_archive.get(job_id) is not None:
+                # archived jobs are finished
+                return True
+            raise xmlrpc.client.Fault(1, 'job id not exist')
+        if job.status in TERMINAL_STATUSES:
+            return True
+        if job.status == PENDING:
+            # not running anywhere yet: the deploy workers skip jobs that are no longer pending
+            # and set_job_placement undoes a launch that was in flight
+            job.set_status(FAIL)
+            job_index.update(job)
+            persist_job(job_id, {'status': FAIL, 'finished_at': job.finished_at})
+            # a pending pass may have reserved capacity for it already, and an array task
+            # makes room for the next tasks of its array
+            if scheduler.release(job_id) is not None or task_array_id(job_id) is not None:
+                capacity_changed.set()
+            return True
+        agent_id = job.agent_id
     try:
-        with agents[agent_id]['proxy_lock']:
-            return agents[agent_id]['proxy'].kill_job(job_id)
+        with agents[agent_id]['proxy_pool'].connection() as proxy:
+            return proxy.kill_job(job_id)
     except xmlrpc.client.ProtocolError as err:
         raise xmlrpc.client.Fault(2, str(err))
     except xmlrpc.client.Fault as err:
@@ -186,13 +885,25 @@ def rpc_kill_job(job_id):
         
 
 def rpc_output_request(job_id):
-    if job_id not in jobs:
+    job = lookup_job(job_id)
+    if job is None:
         raise xmlrpc.client.Fault(1, 'job id not exist')
-    agent_id = jobs[job_id]['agent_id']
+    agent_id = job.agent_id
+    finished = job.status in TERMINAL_STATUSES
+    if agent_id is None:
+        raise xmlrpc.client.Fault(2, 'job not deployed yet')
+    # a job relaunched elsewhere after failover starts a new log, cached chunks belong to one agent
+    cache_key = (job_id, agent_id, 'full')
+    if finished:
+        job_logs = log_cache.get(cache_key)
+        if job_logs is not None:
+            return job_logs
     try:
-        with agents[agent_id]['proxy_lock']:
-            job_logs = agents[agent_id]['proxy'].stream_output(job_id)
+        with agents[agent_id]['proxy_pool'].connection() as proxy, log_fetch_seconds.labels('full').time():
+            job_logs = proxy.stream_output(job_id)
         # type(job_logs) == <class 'xmlrpc.client.Binary'>
+        if finished:
+            log_cache.put(cache_key, job_logs, len(job_logs.data))
         return job_logs
     except xmlrpc.client.Fault as err:
         if err.faultCode == 1:
@@ -205,15 +916,179 @@ def rpc_output_request(job_id):
         raise xmlrpc.client.Fault(4, str(err))
     
 
-def rpc_list_jobs():
+def rpc_output_chunk(job_id, offset=0, max_bytes=LOG_CHUNK_SIZE, tail=None):
+    # incremental log read, see agent stream_output_chunk. returns {'data', 'offset', 'complete'}
+    job = lookup_job(job_id)
+    if job is None:
+        raise xmlrpc.client.Fault(1, 'job id not exist')
+    agent_id = job.agent_id
+    if agent_id is None:
+        raise xmlrpc.client.Fault(2, 'job not deployed yet')
+    max_bytes = max(1, min(max_bytes, MAX_LOG_CHUNK_SIZE))
+    if tail is not None:
+        tail = max(0, min(tail, MAX_LOG_CHUNK_SIZE))
+    cache_key = (job_id, agent_id, offset, max_bytes, tail)
+    chunk = log_cache.get(cache_key)
+    if chunk is not None:
+        return chunk
+    try:
+        with agents[agent_id]['proxy_pool'].connection() as proxy, log_fetch_seconds.labels('chunk').time():
+            chunk = proxy.stream_output_chunk(job_id, offset, max_bytes, tail)
+        # a full chunk never changes once written, nor does anything of a finished job
+        chunk_size = len(chunk['data'].data)
+        if chunk['complete'] or (tail is None and chunk_size == max_bytes):
+            log_cache.put(cache_key, chunk, chunk_size)
+        return chunk
+    except xmlrpc.client.Fault as err:
+        if err.faultCode == 1:
+            raise xmlrpc.client.Fault(1, 'job id not exist')
+        else:
+            raise xmlrpc.client.Fault(2, err.faultString)
+    except xmlrpc.client.ProtocolError as err:
+        raise xmlrpc.client.Fault(3, str(err))
+    except OSError as err:
+        raise xmlrpc.client.Fault(4, str(err))
+
+
+def rpc_get_statuses(job_ids):
+    # batched get_status: job_id -> status, unknown job ids are left out
+    if len(job_ids) > MAX_LIST_JOBS_LIMIT:
+        raise xmlrpc.client.Fault(1, 'at most %d job ids per call' % MAX_LIST_JOBS_LIMIT)
+    statuses = {}
+    with jobs_lock:
+        for job_id in job_ids:
+            job = jobs.get(job_id)
+            if job is not None:
+                statuses[job_id] = job.status
+    missing = [job_id for job_id in job_ids if job_id not in statuses]
+    if len(missing) > 0 and job_archive is not None:
+        statuses.update(job_archive.get_statuses(missing))
+    return statuses
+
+
+def rpc_list_jobs(job_filter=None, cursor=None, limit=LIST_JOBS_LIMIT):
+    # one page of jobs in job id order, live and archived.
+    # job_filter may hold 'status' and 'agent_id'. pass the returned cursor back for the
+    # next page, it is None after the last one
+    job_filter = job_filter or {}
+    if limit <= 0 or limit > MAX_LIST_JOBS_LIMIT:
+        raise xmlrpc.client.Fault(1, 'limit must be between 1 and %d' % MAX_LIST_JOBS_LIMIT)
+    status = job_filter.get('status')
+    agent_id = job_filter.get('agent_id')
     results = []
-    for job_id in list(jobs):
-        job_attrs = {}
-        job_attrs['job_id'] = job_id
-        job_attrs['job_status'] = jobs[job_id]['status']
-        job_attrs['job_restart_count'] = jobs[job_id]['restart_count']
-        results.append(job_attrs)
-    return results
+    with jobs_lock:
+        for job_id in job_index.page(status, agent_id, cursor, limit):
+            job = jobs[job_id]
+            results.append({'job_id': job_id, 'job_status': job.status, 'job_restart_count': job.restart_count})
+    more = len(results) == limit
+    if job_archive is not None:
+        archived = job_archive.page(status, agent_id, cursor, limit)
+        more = more or len(archived) == limit
+        # a job caught between the archive and the table shows up in both, keep one
+        listed = set(job_attrs['job_id'] for job_attrs in results)
+        for job_id, job_status, restart_count in archived:
+            if job_id not in listed:
+                results.append({'job_id': job_id, 'job_status': job_status, 'job_restart_count': restart_count})
+        results.sort(key=lambda job_attrs: job_attrs['job_id'])
+        results = results[:limit]
+    next_cursor = results[-1]['job_id'] if more and len(results) > 0 else None
+    return {'jobs': results, 'cursor': next_cursor}
+
+
+def rpc_get_metrics():
+    metrics = {}
+    with stats_lock:
+        metrics['heartbeat'] = dict(heartbeat_stats)
+        metrics['deploy'] = dict(deploy_stats)
+    metrics['deploy']['queue_depth'] = deploy_queue.qsize()
+    with stats_lock:
+        metrics['pending'] = dict(pending_stats)
+        metrics['failover'] = dict(failover_stats)
+        metrics['arrays'] = dict(array_stats)
+    metrics['pending']['queue_length'] = len(pending_queue)
+    with job_arrays_lock:
+        metrics['arrays']['active'] = sum(1 for job_array in job_arrays.values() if job_array.active())
+    metrics['log_cache'] = log_cache.stats()
+    if state_store is not None:
+        metrics['state_store'] = state_store.get_stats()
+    with stats_lock:
+        metrics['jobs'] = dict(archive_stats)
+    with jobs_lock:
+        metrics['jobs']['in_memory'] = len(jobs)
+    metrics['jobs']['distinct_specs'] = len(spec_table)
+    with scheduler.lock:
+        metrics['placement'] = dict(scheduler.locality_stats)
+    metrics['job_start'] = job_start_metrics()
+    metrics['cores'] = core_metrics()
+    # counters, gauges and histograms also served on GET /metrics
+    metrics['registry'] = registry.snapshot()
+    return metrics
+
+
+def core_metrics():
+    # agents' core allocators: how often jobs had to share a core or span NUMA nodes
+    totals = {'allocations': 0, 'oversubscribed': 0, 'spanning': 0, 'max_core_load': 0}
+    with agents_lock:
+        agent_stats = [agent.get('cores') for agent in agents.values()]
+    for stats in agent_stats:
+        if stats is None:
+            continue
+        for key in ['allocations', 'oversubscribed', 'spanning']:
+            totals[key] += stats[key]
+        totals['max_core_load'] = max(totals['max_core_load'], stats['max_core_load'])
+    return totals
+
+
+def job_start_metrics():
+    # time-to-running and warm pool hit rate summed over the agents' last heartbeats
+    totals = {'pooled': 0, 'cold': 0, 'pooled_seconds': 0.0, 'cold_seconds': 0.0, 'max_seconds': 0.0, 'pool_hits': 0, 'pool_misses': 0}
+    with agents_lock:
+        agent_stats = [agent.get('job_start') for agent in agents.values()]
+    for stats in agent_stats:
+        if stats is None:
+            continue
+        for key in ['pooled', 'cold', 'pooled_seconds', 'cold_seconds']:
+            totals[key] += stats[key]
+        totals['max_seconds'] = max(totals['max_seconds'], stats['max_seconds'])
+        if 'warm_pool' in stats:
+            totals['pool_hits'] += stats['warm_pool']['hits']
+            totals['pool_misses'] += stats['warm_pool']['misses']
+    for kind in ['pooled', 'cold']:
+        totals[kind + '_mean_seconds'] = totals[kind + '_seconds'] / totals[kind] if totals[kind] > 0 else 0.0
+    lookups = totals['pool_hits'] + totals['pool_misses']
+    totals['pool_hit_rate'] = totals['pool_hits'] / lookups if lookups > 0 else 0.0
+    return totals
+
+
+def prepull_on_agent(agent_id, img_url):
+    try:
+        with agents[agent_id]['proxy_pool'].connection() as proxy:
+            image = proxy.prepull_image(img_url)
+    except xmlrpc.client.Fault as err:
+        return err.faultString
+    except (xmlrpc.client.ProtocolError, http.client.HTTPException, OSError) as err:
+        return str(err)
+    # placements can use the image right away, the next heartbeat brings the full image list
+    scheduler.add_agent_images(agent_id, image['refs'])
+    return True
+
+
+def rpc_prepull_image(img_url, agent_ids=None):
+    # pull an image on the given agents (default: every alive agent) in parallel.
+    # returns agent_id -> True or an error string
+    if agent_ids is None:
+        with agents_lock:
+            agent_ids = [agent_id for agent_id, agent in agents.items() if agent['status'] == 'alive']
+    for agent_id in agent_ids:
+        if agent_id not in agents or agents[agent_id]['status'] == 'dead':
+            raise xmlrpc.client.Fault(1, 'agent %s not exist' % agent_id)
+    futures = {agent_id: prepull_executor.submit(prepull_on_agent, agent_id, img_url) for agent_id in agent_ids}
+    return {agent_id: future.result() for agent_id, future in futures.items()}
+
+
+def rpc_get_transports():
+    # lets clients upgrade from xml-rpc to msgpack
+    return {'msgpack_port': MSGPACK_PORT if use_msgpack(MSGPACK_PORT) else None}
 
 
 def rpc_is_even(num):
@@ -221,112 +1096,505 @@ def rpc_is_even(num):
 
 
 # Heartbeat Methods
-def redeploy_job(job_id):
-    job_dict = jobs[job_id]['job_dict']
+def redeploy_job(job_id, exclude=()):
+    job_dict = jobs[job_id].job_dict
     new_agent_id = None
+    scheduler.release(job_id)
+    if jobs[job_id].status != PENDING:
+        # killed while the refused launch was in flight
+        return
     try:
-        new_agent_id = match_job_to_agent(job_dict)
-        with jobs_lock:
-            if new_agent_id is not None:
-                jobs[job_id]['agent_id'] = new_agent_id
-                jobs[job_id]['status'] = 'deploying'
-                jobs[job_id]['restart_count'] = 0
-            else:
-                jobs[job_id]['status'] = 'pending'
+        new_agent_id = match_job_to_agent(job_dict, exclude)
+        set_job_placement(job_id, new_agent_id)
     except ImageNotFoundError:
-        with jobs_lock:
-            jobs[job_id]['status'] = 'fail'
+        set_job_failed(job_id)
+        incr_stat(deploy_stats, 'failed')
 
 
 def destroy_agent(agent_id):
+    set_agent_status(agent_id, 'dead')
+    scheduler.remove_agent(agent_id)
+    agents[agent_id]['proxy_pool'].close()
     with agents_lock:
-        agents[agent_id]['status'] = 'dead'
-    for job_id in list(jobs):
-        if jobs[job_id]['agent_id'] == agent_id and jobs[job_id]['status'] not in ['fail', 'end']:
-            redeploy_job(job_id)
-            
-
-def cpr_agent(agent_id):
-    for period in CPR_PERIODS:
-        time.sleep(period)
-        try:
-            with agents[agent_id]['proxy_lock']:
-                agent_pulse = agents[agent_id]['proxy'].heartbeat()
-            # agent revived
-            with agents_lock:
-                agents[agent_id]['cpu_usage'] = agent_pulse['cpu_usage']
-                agents[agent_id]['memory_usage'] = agent_pulse['memory_usage']
-                agents[agent_id]['status'] = 'alive'
-            with jobs_lock:
-                for job_attrs in agent_pulse['job_attrs_list']:
-                    jobs[job_attrs['job_id']]['status'] = job_attrs['status']
-                    jobs[job_attrs['job_id']]['restart_count'] = job_attrs['restart_count']
-        except xmlrpc.client.Fault:
-            pass
-        except xmlrpc.client.ProtocolError:
-            pass
-        except ConnectionRefusedError:
-            pass
-    destroy_agent(agent_id)
+        # should it answer again, the first pulse lists all of its jobs and images
+        agents[agent_id]['heartbeat_seq'] = None
+        agents[agent_id]['heartbeat_epoch'] = None
+        agents[agent_id]['images_version'] = None
+        agents[agent_id]['last_probe'] = time.time()
+        agents[agent_id]['failover'] = failover_runner.submit(run_failover, agent_id)
+
+
+def run_failover(agent_id):
+    try:
+        failover_jobs(agent_id)
+    except Exception as err:
+        print("failover of agent %s failed: %s" % (agent_id, err))
+
+
+def rejoin_agent(agent_id, agent_pulse):
+    # a dead agent answered again. a job of it still waiting for capacity since the failover gets
+    # its container back; every other container it still runs belongs to a job placed elsewhere
+    # (or killed, or being relaunched) meanwhile and is killed. the agent only takes new jobs
+    # once its adopted jobs hold their reservations again
+    scheduler.add_agent(agent_id, agents[agent_id]['cpu'], agents[agent_id]['memory'], schedulable=False)
+    if 'images' in agent_pulse:
+        set_agent_images(agent_id, agent_pulse['images'], agent_pulse['images_version'])
+    adopted = 0
+    duplicates = []
+    with jobs_lock:
+        for job_attrs in agent_pulse['job_attrs_list']:
+            if job_attrs['status'] in TERMINAL_STATUSES:
+                continue
+            job = jobs.get(job_attrs['job_id'])
+            # a reservation means a launch of the job is under way
+            if job is None or job.agent_id != agent_id or job.status in TERMINAL_STATUSES or scheduler.reserved_agent(job.job_id) is not None:
+                duplicates.append(job_attrs['job_id'])
+                continue
+            job.set_status(job_attrs['status'])
+            job.restart_count = job_attrs['restart_count']
+            job_index.update(job)
+            persist_job(job.job_id, {'status': job.status, 'restart_count': job.restart_count})
+            scheduler.reserve_on(job.job_id, agent_id, job.resource_requirement)
+            adopted += 1
+    for job_id in duplicates:
+        kill_launched_job(agent_id, job_id)
+    # the job states of the full pulse are taken as seen
+    with agents_lock:
+        agents[agent_id]['heartbeat_seq'] = agent_pulse['seq']
+        agents[agent_id]['heartbeat_epoch'] = agent_pulse['epoch']
+        agents[agent_id]['detector'] = PhiAccrualDetector(HEARTBEAT_RATE, PHI_WINDOW, PHI_MIN_STD, PHI_ACCEPTABLE_PAUSE, time.time())
+        agents[agent_id]['missed_heartbeats'] = 0
+    set_agent_status(agent_id, 'alive')
+    scheduler.set_schedulable(agent_id, True)
+    incr_stat(heartbeat_stats, 'rejoined')
+    capacity_changed.set()
+    print("agent %s rejoined: %d jobs adopted, %d duplicates killed" % (agent_id, adopted, len(duplicates)))
+
+
+def failover_jobs(agent_id):
+    # redeploy the live jobs of a dead agent: one placement pass for all of them spread over the
+    # surviving agents, then one launch batch per chosen agent, FAILOVER_WORKERS agents at a time.
+    # jobs no agent has room for wait in the pending queue. returns the seconds it took
+    failover_start = time.time()
+    with jobs_lock:
+        orphans = [job_id for job_id in job_index.agent_job_ids(agent_id) if job_id in jobs and jobs[job_id].status not in TERMINAL_STATUSES and jobs[job_id].status != PENDING]
+        requests = [(job_id, jobs[job_id].resource_requirement, jobs[job_id].spec['img_url']) for job_id in orphans]
+        # no longer running anywhere; pending until relaunched, so a kill meanwhile is not undone
+        for job_id in orphans:
+            jobs[job_id].set_status(PENDING)
+            job_index.update(jobs[job_id])
+            persist_job(job_id, {'status': PENDING})
+    placements = scheduler.reserve_many(requests, policy=FAILOVER_POLICY)
+    job_ids_by_agent = {}
+    parked = 0
+    for job_id, new_agent_id in zip(orphans, placements):
+        if new_agent_id is None:
+            set_job_placement(job_id, None)
+            parked += 1
+        else:
+            job_ids_by_agent.setdefault(new_agent_id, []).append(job_id)
+    futures = [failover_executor.submit(launch_batch_on_agent, new_agent_id, agent_job_ids) for new_agent_id, agent_job_ids in job_ids_by_agent.items()]
+    for future in futures:
+        future.result()
+    recover_duration = time.time() - failover_start
+    failover_seconds.observe(recover_duration)
+    with stats_lock:
+        failover_stats['failovers'] += 1
+        failover_stats['orphaned'] += len(orphans)
+        failover_stats['relaunched'] += len(orphans) - parked
+        failover_stats['parked'] += parked
+        failover_stats['last_recover_duration'] = recover_duration
+        failover_stats['max_recover_duration'] = max(failover_stats['max_recover_duration'], recover_duration)
+    print("agent %s failed over: %d jobs in %.3f seconds, %d waiting for capacity" % (agent_id, len(orphans), recover_duration, parked))
+    return recover_duration
+
+
+def request_pulse(agent_id):
+    # delta heartbeat: ask only for the job changes after the last seq we applied
+    with agents[agent_id]['heartbeat_lock']:
+        # the image list only comes back when it changed since images_version
+        return agents[agent_id]['heartbeat_proxy'].heartbeat(agents[agent_id]['heartbeat_seq'], agents[agent_id]['heartbeat_epoch'], agents[agent_id]['images_version'])
+
+
+def apply_agent_pulse(agent_id, agent_pulse):
+    with agents_lock:
+        agents[agent_id]['cpu_usage'] = agent_pulse['cpu_usage']
+        agents[agent_id]['memory_usage'] = agent_pulse['memory_usage']
+        agents[agent_id]['cpu_peak'] = agent_pulse.get('cpu_peak', agent_pulse['cpu_usage'])
+        agents[agent_id]['memory_peak'] = agent_pulse.get('memory_peak', agent_pulse['memory_usage'])
+        agents[agent_id]['job_start'] = agent_pulse.get('job_start')
+        agents[agent_id]['cores'] = agent_pulse.get('cores')
+        agents[agent_id]['job_usage'] = agent_pulse.get('job_usage', {})
+        if USAGE_AWARE_PLACEMENT:
+            # whole cores and gigabytes, a little background use does not shave a core off every agent
+            used_cpu = int(agents[agent_id]['cpu'] * agents[agent_id]['cpu_usage'] / 100)
+            used_memory = int(agents[agent_id]['memory'] * agents[agent_id]['memory_peak'] / 100)
+    if USAGE_AWARE_PLACEMENT and scheduler.set_agent_usage(agent_id, used_cpu, used_memory):
+        # jobs parked while the agent was busier may fit now
+        capacity_changed.set()
+    if 'images' in agent_pulse:
+        set_agent_images(agent_id, agent_pulse['images'], agent_pulse['images_version'])
+    apply_job_states(agent_id, agent_pulse)
+
+
+def apply_job_states(agent_id, report):
+    # apply a job state report, from a heartbeat reply or pushed by the agent.
+    # a report is taken only if it continues from the seq already applied (or is a full resync)
+    # and is not older than it, so a heartbeat reply overtaken by a push cannot roll states back.
+    # returns whether the report was applied
+    with agents[agent_id]['state_lock']:
+        applied = apply_job_states_locked(agent_id, report)
+    if not applied:
+        incr_stat(heartbeat_stats, 'stale_reports')
+    return applied
+
+
+def apply_job_states_locked(agent_id, report):
+    applied_seq = agents[agent_id]['heartbeat_seq']
+    same_epoch = report.get('epoch') == agents[agent_id]['heartbeat_epoch'] and applied_seq is not None
+    if same_epoch and report['seq'] < applied_seq:
+        return False
+    if not report.get('full') and not (same_epoch and report.get('since_seq') is not None and report['since_seq'] <= applied_seq):
+        return False
+    incr_stat(heartbeat_stats, 'jobs_reported', len(report['job_attrs_list']))
+    if report.get('full'):
+        incr_stat(heartbeat_stats, 'full_resyncs')
+    finished = []
+    lost = []
+    with jobs_lock:
+        if report.get('full') and not same_epoch:
+            # the agent restarted (or the master did): a job placed on it that its full report does not
+            # list is gone with the agent's old run. it is pending again and relaunched
+            reported = set(job_attrs['job_id'] for job_attrs in report['job_attrs_list'])
+            for job_id in job_index.agent_job_ids(agent_id):
+                job = jobs.get(job_id)
+                if job is None or job_id in reported or job.agent_id != agent_id or job.status in TERMINAL_STATUSES or job.status == PENDING:
+                    continue
+                job.set_status(PENDING)
+                job_index.update(job)
+                persist_job(job_id, {'status': PENDING})
+                lost.append(job_id)
+        for job_attrs in report['job_attrs_list']:
+            job = jobs.get(job_attrs['job_id'])
+            # a pending job is not running here (yet), e.g. one being relaunched whose old container was killed on this agent's rejoin
+            if job is None or job.agent_id != agent_id or job.status == PENDING:
+                continue
+            if job.status == job_attrs['status'] and job.restart_count == job_attrs['restart_count']:
+                continue
+            job.set_status(job_attrs['status'])
+            job.restart_count = job_attrs['restart_count']
+            job_index.update(job)
+            persist_job(job.job_id, {'status': job.status, 'restart_count': job.restart_count, 'finished_at': job.finished_at})
+            if job.status in TERMINAL_STATUSES:
+                finished.append(job_attrs['job_id'])
+    # only advance the seq once the changes it covers are applied
+    with agents_lock:
+        agents[agent_id]['heartbeat_seq'] = report.get('seq')
+        agents[agent_id]['heartbeat_epoch'] = report.get('epoch')
+    # finished jobs give their reserved capacity back
+    for job_id in finished:
+        scheduler.release(job_id)
+    if len(finished) > 0:
+        capacity_changed.set()
+    if len(lost) > 0:
+        incr_stat(heartbeat_stats, 'lost_jobs', len(lost))
+        print("agent %s restarted without %d of its jobs, relaunching them" % (agent_id, len(lost)))
+    for job_id in lost:
+        scheduler.release(job_id)
+        if not enqueue_deploy(job_id):
+            park_pending(job_id)
+    return True
+
+
+def rpc_report_job_states(agent_id, report):
+    # job state changes pushed by an agent as they happen.
+    # returns the seq and epoch now held for the agent, the agent resends everything after it
+    if agent_id not in agents:
+        raise xmlrpc.client.Fault(1, 'agent not exist')
+    if agents[agent_id]['status'] == 'dead':
+        # probe it with the next heartbeat sweep, it rejoins if it answers; the agent retries the push
+        agents[agent_id]['last_probe'] = 0
+        raise xmlrpc.client.Fault(1, 'agent declared dead, rejoining')
+    incr_stat(heartbeat_stats, 'pushed_reports')
+    # proof of life, but pushes come in bursts and would skew the learnt heartbeat intervals
+    agents[agent_id]['detector'].heartbeat(time.time(), sample=False)
+    agents[agent_id]['missed_heartbeats'] = 0
+    apply_job_states(agent_id, report)
+    with agents_lock:
+        return {'acked_seq': agents[agent_id]['heartbeat_seq'], 'epoch': agents[agent_id]['heartbeat_epoch']}
+
+
+def mark_agent_icu(agent_id):
+    set_agent_status(agent_id, 'icu')
+    scheduler.set_schedulable(agent_id, False)
+    incr_stat(heartbeat_stats, 'suspected')
+
+
+def revive_agent(agent_id):
+    set_agent_status(agent_id, 'alive')
+    scheduler.set_schedulable(agent_id, True)
+    incr_stat(heartbeat_stats, 'revived')
+    capacity_changed.set()
+
+
+def supervise_agents(supervisor_interval):
+    # one thread watches every agent: alive -> icu past PHI_SUSPECT, icu -> alive when heartbeats
+    # are answered again, dead past PHI_DEAD after DEAD_MISSED_HEARTBEATS failed heartbeats.
+    # icu agents are still probed by the heartbeat sweeps, dead ones every DEAD_PROBE_INTERVAL
+    while True:
+        time.sleep(supervisor_interval)
+        now = time.time()
+        for agent_id in list(agents):
+            status = agents[agent_id]['status']
+            if status == 'dead':
+                continue
+            phi = agents[agent_id]['detector'].phi(now)
+            try:
+                if phi >= PHI_DEAD and agents[agent_id]['missed_heartbeats'] >= DEAD_MISSED_HEARTBEATS:
+                    incr_stat(heartbeat_stats, 'declared_dead')
+                    destroy_agent(agent_id)
+                elif status == 'alive' and phi >= PHI_SUSPECT:
+                    mark_agent_icu(agent_id)
+                elif status == 'icu' and phi < PHI_SUSPECT:
+                    revive_agent(agent_id)
+            except Exception as err:
+                # keep supervising the other agents
+                print("agent supervisor error:", str(err))
 
 
 def check_agent_heartbeat(agent_id):
-    if agents[agent_id]['status'] in ['icu', 'dead']:
+    if agents[agent_id]['status'] == 'dead':
+        probe_dead_agent(agent_id)
         return
     try:
-        with agents[agent_id]['proxy_lock']:
-            agent_pulse = agents[agent_id]['proxy'].heartbeat()
-        with agents_lock:
-            agents[agent_id]['cpu_usage'] = agent_pulse['cpu_usage']
-            agents[agent_id]['memory_usage'] = agent_pulse['memory_usage']
-        with jobs_lock:
-            for job_attrs in agent_pulse['job_attrs_list']:
-                jobs[job_attrs['job_id']]['status'] = job_attrs['status']
-                jobs[job_attrs['job_id']]['restart_count'] = job_attrs['restart_count']
-    except xmlrpc.client.Fault:
-        with agents_lock:
-            agents[agent_id]['status'] = 'icu'
-        cpr_thread = Thread(target=cpr_agent, args=(agent_id,))
-        cpr_thread.start()
-    except xmlrpc.client.ProtocolError:
-        with agents_lock:
-            agents[agent_id]['status'] = 'icu'
-        cpr_thread = Thread(target=cpr_agent, args=(agent_id,))
-        cpr_thread.start()
-    except ConnectionRefusedError:
-        with agents_lock:
-            agents[agent_id]['status'] = 'icu'
-        cpr_thread = Thread(target=cpr_agent, args=(agent_id,))
-        cpr_thread.start()
-    except http.client.CannotSendRequest:
-        with agents_lock:
-            agents[agent_id]['status'] = 'icu'
-        cpr_thread = Thread(target=cpr_agent, args=(agent_id,))
-        cpr_thread.start()
-    
+        with heartbeat_check_seconds.time():
+            agent_pulse = request_pulse(agent_id)
+            apply_agent_pulse(agent_id, agent_pulse)
+        agents[agent_id]['detector'].heartbeat(time.time())
+        agents[agent_id]['missed_heartbeats'] = 0
+    except (xmlrpc.client.Fault, xmlrpc.client.ProtocolError, http.client.HTTPException, OSError):
+        # OSError covers refused connections as well as heartbeat deadline timeouts.
+        # no verdict here, the supervisor judges the missing arrival
+        incr_stat(heartbeat_stats, 'failed_checks')
+        agents[agent_id]['missed_heartbeats'] += 1
+
+
+def probe_dead_agent(agent_id):
+    if time.time() - agents[agent_id]['last_probe'] < DEAD_PROBE_INTERVAL:
+        return
+    failover = agents[agent_id]['failover']
+    if failover is not None and not failover.done():
+        # its jobs are not all pending or placed elsewhere yet, rejoin_agent would adopt some twice
+        return
+    agents[agent_id]['last_probe'] = time.time()
+    try:
+        agent_pulse = request_pulse(agent_id)
+    except (xmlrpc.client.Fault, xmlrpc.client.ProtocolError, http.client.HTTPException, OSError):
+        return
+    rejoin_agent(agent_id, agent_pulse)
+
+
+def run_heartbeat_check(agent_id):
+    try:
+        check_agent_heartbeat(agent_id)
+    except Exception as err:
+        # e.g. a malformed pulse; counted like a missed heartbeat, the other agents are unaffected
+        print("heartbeat check of agent %s failed: %s" % (agent_id, err))
+        incr_stat(heartbeat_stats, 'failed_checks')
+        agents[agent_id]['missed_heartbeats'] += 1
+    finally:
+        with heartbeat_inflight_lock:
+            heartbeat_inflight.discard(agent_id)
+
+
+def heartbeat_sweep():
+    # check all agents concurrently, at most HEARTBEAT_WORKERS at a time
+    sweep_start = time.time()
+    futures = []
+    for agent_id in list(agents):
+        with heartbeat_inflight_lock:
+            # an agent still being checked from the previous sweep is not checked twice
+            if agent_id in heartbeat_inflight:
+                incr_stat(heartbeat_stats, 'skipped_checks')
+                continue
+            heartbeat_inflight.add(agent_id)
+        futures.append(heartbeat_executor.submit(run_heartbeat_check, agent_id))
+    for future in futures:
+        future.result()
+    sweep_duration = time.time() - sweep_start
+    heartbeat_sweep_seconds.observe(sweep_duration)
+    with stats_lock:
+        heartbeat_stats['sweep_count'] += 1
+        heartbeat_stats['last_sweep_duration'] = sweep_duration
+        heartbeat_stats['max_sweep_duration'] = max(heartbeat_stats['max_sweep_duration'], sweep_duration)
+    return sweep_duration
+
 
 def heartbeat(heartbeat_rate):
+    sweep_duration = 0
     while True:
-        time.sleep(heartbeat_rate)
-        for agent_id in list(agents):
-            check_agent_heartbeat(agent_id)
-        for job_id in list(jobs):
-            if jobs[job_id]['status'] == 'pending':
-                redeploy_job(job_id)
+        time.sleep(max(0, heartbeat_rate - sweep_duration))
+        try:
+            sweep_duration = heartbeat_sweep()
+        except Exception as err:
+            # keep sweeping, the next sweep starts a full interval later
+            print("heartbeat sweep error:", str(err))
+            sweep_duration = 0
 
 
-if __name__ == '__main__':
-    heartbeat_thread = Thread(target=heartbeat, args=(HEARTBEAT_RATE,))
-    heartbeat_thread.setDaemon(True)
-    heartbeat_thread.start()
-    # rpc server
-    rpc_server = xmlrpc.server.SimpleXMLRPCServer((MASTER_IP, MASTER_PORT), allow_none=True)
-    print("master rpc server listening on port", MASTER_PORT)
+# Job Archival
+def archive_jobs(retention):
+    # move jobs that finished more than retention seconds ago from memory to the archive
+    sweep_start = time.time()
+    cutoff = sweep_start - retention
+    with jobs_lock:
+        expired = [job for job in jobs.values() if job.status in TERMINAL_STATUSES and job.finished_at is not None and job.finished_at < cutoff]
+    if len(expired) == 0:
+        return 0
+    # archive first, a crash in between leaves the jobs in both places which recovery tolerates
+    job_archive.archive(expired)
+    with jobs_lock:
+        for job in expired:
+            if jobs.get(job.job_id) is job and job.status in TERMINAL_STATUSES:
+                del jobs[job.job_id]
+                job.release_spec()
+                job_index.remove(job.job_id)
+                if state_store is not None:
+                    state_store.log_job_deleted(job.job_id)
+    with stats_lock:
+        archive_stats['archived'] += len(expired)
+        archive_stats['last_sweep_duration'] = time.time() - sweep_start
+    return len(expired)
+
+
+def archive_loop(archive_interval, retention):
+    while True:
+        time.sleep(archive_interval)
+        try:
+            archive_jobs(retention)
+        except Exception as err:
+            print("job archive error:", str(err))
+
+
+# State Persistence
+def capture_state():
+    # full copies of the persisted fields for a snapshot
+    with jobs_lock:
+        job_records = {}
+        for job_id, job in jobs.items():
+            job_records[job_id] = job.to_record()
+    with agents_lock:
+        agent_records = {}
+        for agent_id, agent in agents.items():
+            agent_records[agent_id] = {'url': agent['url'], 'msgpack_port': agent['msgpack_port'], 'cpu': agent['cpu'], 'memory': agent['memory'], 'status': agent['status']}
+    with job_arrays_lock:
+        array_records = {}
+        for array_id, job_array in job_arrays.items():
+            array_records[array_id] = job_array.to_record()
+    return job_records, agent_records, array_records
+
+
+def snapshot_state(snapshot_interval):
+    while True:
+        time.sleep(snapshot_interval)
+        try:
+            state_store.snapshot(capture_state)
+        except OSError as err:
+            print("snapshot error:", str(err))
+
+
+def recover_state():
+    # rebuild agents, jobs and scheduler reservations from the state store.
+    # agents start unverified with no heartbeat seq, the first heartbeat does a full resync
+    # or sends them to icu. returns the ids of jobs that need to be (re)deployed
+    recover_start = time.time()
+    job_records, agent_records, array_records = state_store.recover()
+    for agent_id, agent_record in agent_records.items():
+        add_agent(agent_id, agent_record, agent_record['status'] if agent_record['status'] == 'dead' else 'alive')
+    for array_id, array_record in array_records.items():
+        job_arrays[array_id] = JobArray.from_record(array_id, array_record)
+    to_deploy = []
+    with jobs_lock:
+        for job_id, job_record in job_records.items():
+            jobs[job_id] = Job.from_record(job_record)
+    for job_id, job in jobs.items():
+        if job.status in TERMINAL_STATUSES:
+            job_index.update(job)
+            continue
+        agent_id = job.agent_id
+        if job.status != PENDING and agent_id in agents and agents[agent_id]['status'] != 'dead':
+            scheduler.reserve_on(job_id, agent_id, job.resource_requirement)
+        else:
+            job.set_status(PENDING)
+            to_deploy.append(job_id)
+        job_index.update(job)
+    recover_arrays()
+    print("recovered %d agents, %d jobs and %d arrays in %.2f seconds" % (len(agent_records), len(job_records), len(array_records), time.time() - recover_start))
+    return to_deploy
+
+
+def register_rpc_functions(rpc_server):
     rpc_server.register_function(rpc_get_status, 'get_status')
     rpc_server.register_function(rpc_kill_job, 'kill_job')
+    rpc_server.register_function(rpc_get_job_usage, 'get_job_usage')
     rpc_server.register_function(rpc_list_jobs, 'list_jobs')
+    rpc_server.register_function(rpc_get_statuses, 'get_statuses')
     rpc_server.register_function(rpc_output_request, 'output_request')
+    rpc_server.register_function(rpc_output_chunk, 'output_chunk')
     rpc_server.register_function(rpc_register_agent, 'register_agent')
+    rpc_server.register_function(rpc_report_job_states, 'report_job_states')
     rpc_server.register_function(rpc_submit_job, 'submit_job')
+    rpc_server.register_function(rpc_submit_jobs, 'submit_jobs')
+    rpc_server.register_function(rpc_submit_array, 'submit_array')
+    rpc_server.register_function(rpc_get_array_status, 'get_array_status')
+    rpc_server.register_function(rpc_kill_array, 'kill_array')
     rpc_server.register_function(rpc_is_even, 'is_even')
-    rpc_server.serve_forever()
\ No newline at end of file
+    rpc_server.register_function(rpc_get_metrics, 'get_metrics')
+    rpc_server.register_function(rpc_get_transports, 'get_transports')
+    rpc_server.register_function(rpc_prepull_image, 'prepull_image')
+    rpc_server.register_multicall_functions()
+    instrument_rpc_server(rpc_server)
+
+
+if __name__ == '__main__':
+    to_deploy = []
+    if ARCHIVE_PATH is not None:
+        job_archive = JobArchive(ARCHIVE_PATH)
+        archive_thread = Thread(target=archive_loop, args=(ARCHIVE_INTERVAL, JOB_RETENTION))
+        archive_thread.setDaemon(True)
+        archive_thread.start()
+    if STATE_DIR is not None:
+        state_store = StateStore(STATE_DIR, WAL_COMMIT_INTERVAL)
+        to_deploy = recover_state()
+        state_store.start_writer()
+        snapshot_thread = Thread(target=snapshot_state, args=(SNAPSHOT_INTERVAL,))
+        snapshot_thread.setDaemon(True)
+        snapshot_thread.start()
+    heartbeat_thread = Thread(target=heartbeat, args=(HEARTBEAT_RATE,))
+    heartbeat_thread.setDaemon(True)
+    heartbeat_thread.start()
+    supervisor_thread = Thread(target=supervise_agents, args=(SUPERVISOR_INTERVAL,))
+    supervisor_thread.setDaemon(True)
+    supervisor_thread.start()
+    start_deploy_workers()
+    for job_id in to_deploy:
+        enqueue_deploy(job_id, timeout=DEPLOY_QUEUE_TIMEOUT)
+    feed_arrays()
+    # rpc server
+    if RPC_SERVER_MODE == 'threaded':
+        rpc_server = PooledXMLRPCServer((MASTER_IP, MASTER_PORT), RPC_WORKERS, RPC_REQUEST_TIMEOUT, RPC_KEEPALIVE_TIMEOUT, allow_none=True)
+    else:
+        rpc_server = xmlrpc.server.SimpleXMLRPCServer((MASTER_IP, MASTER_PORT), requestHandler=MetricsRequestHandler, allow_none=True)
+    print("master rpc server listening on port", MASTER_PORT)
+    register_rpc_functions(rpc_server)
+    if use_msgpack(MSGPACK_PORT):
+        msgpack_server = msgpack_rpc.MsgpackRPCServer((MASTER_IP, MSGPACK_PORT), RPC_KEEPALIVE_TIMEOUT)
+        register_rpc_functions(msgpack_server)
+        msgpack_thread = Thread(target=msgpack_server.serve_forever)
+        msgpack_thread.setDaemon(True)
+        msgpack_thread.start()
+        print("master msgpack rpc server listening on port", MSGPACK_PORT)
+    elif RPC_TRANSPORT == 'msgpack':
+        print("msgpack is not installed, serving xml-rpc only")
+    rpc_server.serve_forever()
+
@@ -0,0 +1,256 @@
+import time
+import bisect
+import xmlrpc.server
+from threading import Lock
+from contextlib import contextmanager
+
+# Process-wide counters, gauges and histograms, rendered in the Prometheus text format on
+# GET /metrics and as a dict by the get_metrics rpc. Updates take one uncontended lock,
+# lock wait timers only start the clock when the lock is already taken.
+# This file is kept identical in master/ and agent/.
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30) # seconds
+LOCK_WAIT_BUCKETS = (0.00001, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5) # seconds
+
+
+class Counter:
+    def __init__(self):
+        self.lock = Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        return [(name, labels, self.value)]
+
+    def snapshot(self):
+        return float(self.value)
+
+
+class Gauge:
+    # set explicitly, or read from function at collection time
+    def __init__(self, function=None):
+        self.function = function
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name, labels):
+        return [(name, labels, self.snapshot())]
+
+    def snapshot(self):
+        return float(self.function() if self.function is not None else self.value)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.lock = Lock()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def samples(self, name, labels):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(list(self.buckets) + ['+Inf'], counts):
+            cumulative += count
+            samples.append((name + '_bucket', labels + (('le', str(bound)),), cumulative))
+        samples.append((name + '_sum', labels, total))
+        samples.append((name + '_count', labels, cumulative))
+        return samples
+
+    def snapshot(self):
+        buckets = {}
+        count = 0.0
+        for name, labels, value in self.samples('', ()):
+            if name == '_bucket':
+                buckets[labels[0][1]] = float(value)
+            elif name == '_count':
+                count = float(value)
+        return {'count': count, 'sum': self.sum, 'buckets': buckets}
+
+
+class Family:
+    # one metric name with a child per label value tuple
+    def __init__(self, kind, name, help_text, label_names, new_child):
+        self.kind = kind
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.new_child = new_child
+        self.lock = Lock()
+        self.children = {}
+        if len(label_names) == 0:
+            self.children[()] = new_child()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.new_child())
+        return child
+
+    def child(self):
+        return self.children[()]
+
+    def samples(self):
+        samples = []
+        for values, child in sorted(self.children.items()):
+            samples.extend(child.samples(self.name, tuple(zip(self.label_names, values))))
+        return samples
+
+    def snapshot(self, snapshot):
+        for values, child in sorted(self.children.items()):
+            name = self.name
+            if len(values) > 0:
+                name = '%s{%s}' % (name, ','.join('%s="%s"' % label for label in zip(self.label_names, values)))
+            snapshot[name] = child.snapshot()
+
+
+class Registry:
+    def __init__(self):
+        self.lock = Lock()
+        self.families = {}
+
+    def register(self, kind, name, help_text, label_names, new_child):
+        with self.lock:
+            if name not in self.families:
+                self.families[name] = Family(kind, name, help_text, tuple(label_names), new_child)
+            return self.families[name]
+
+    # unlabelled metrics return the metric itself, labelled ones the family to call labels() on
+    def counter(self, name, help_text, label_names=()):
+        family = self.register('counter', name, help_text, label_names, Counter)
+        return family if label_names else family.child()
+
+    def gauge(self, name, help_text, function=None):
+        return self.register('gauge', name, help_text, (), lambda: Gauge(function)).child()
+
+    def histogram(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        family = self.register('histogram', name, help_text, label_names, lambda: Histogram(buckets))
+        return family if label_names else family.child()
+
+    def render(self):
+        # Prometheus text exposition format 0.0.4
+        lines = []
+        with self.lock:
+            families = sorted(self.families.values(), key=lambda family: family.name)
+        for family in families:
+            lines.append('# HELP %s %s' % (family.name, family.help_text))
+            lines.append('# TYPE %s %s' % (family.name, family.kind))
+            for name, labels, value in family.samples():
+                label_str = ','.join('%s="%s"' % (key, str(label).replace('\\', '\\\\').replace('"', '\\"')) for key, label in labels)
+                lines.append('%s{%s} %s' % (name, label_str, format_value(value)) if label_str else '%s %s' % (name, format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        # name or 'name{label="value"}' -> value, histograms -> {'count', 'sum', 'buckets': {le: cumulative count}}.
+        # floats so that xml-rpc can carry large counts
+        snapshot = {}
+        with self.lock:
+            families = list(self.families.values())
+        for family in families:
+            family.snapshot(snapshot)
+        return snapshot
+
+
+def format_value(value):
+    return repr(float(value)) if not isinstance(value, int) else str(value)
+
+
+registry = Registry()
+rpc_latency = registry.histogram('rpc_duration_seconds', 'time spent in rpc methods', ('method',))
+rpc_errors = registry.counter('rpc_errors_total', 'rpc methods that raised', ('method',))
+lock_wait = registry.histogram('lock_wait_seconds', 'time spent waiting for a contended lock', ('lock',), LOCK_WAIT_BUCKETS)
+lock_contended = registry.counter('lock_contended_total', 'acquisitions that found the lock taken', ('lock',))
+
+
+class TimedLock:
+    # drop-in for threading.Lock that records how long acquirers wait when it is taken
+    def __init__(self, name):
+        self.lock = Lock()
+        self.wait = lock_wait.labels(name)
+        self.contended = lock_contended.labels(name)
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self.lock.acquire(False):
+            return True
+        if not blocking:
+            return False
+        self.contended.inc()
+        start = time.perf_counter()
+        acquired = self.lock.acquire(True, timeout)
+        self.wait.observe(time.perf_counter() - start)
+        return acquired
+
+    def release(self):
+        self.lock.release()
+
+    def locked(self):
+        return self.lock.locked()
+
+    def __enter__(self):
+        # uncontended fast path inline, it is taken on every with block
+        if not self.lock.acquire(False):
+            self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.lock.release()
+
+
+def timed_rpc(function, name):
+    latency = rpc_latency.labels(name)
+    errors = rpc_errors.labels(name)
+
+    def timed(*params):
+        start = time.perf_counter()
+        try:
+            return function(*params)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            latency.observe(time.perf_counter() - start)
+    return timed
+
+
+def instrument_rpc_server(rpc_server):
+    # time every registered rpc method, call after all of them are registered.
+    # works for SimpleXMLRPCServer and msgpack_rpc.MsgpackRPCServer, multicall sub-calls are timed too
+    for name, function in list(rpc_server.funcs.items()):
+        rpc_server.funcs[name] = timed_rpc(function, name)
+
+
+class MetricsRequestHandler(xmlrpc.server.SimpleXMLRPCRequestHandler):
+    # xml-rpc over POST as before, plus GET /metrics for scrapers
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.report_404()
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
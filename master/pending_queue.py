@@ -0,0 +1,49 @@
+import heapq
+import itertools
+from threading import Lock
+
+# Jobs waiting for capacity, highest priority first and FIFO within a priority.
+# The queue is only re-evaluated when capacity changes, see main.schedule_pending.
+
+
+class PendingQueue:
+    def __init__(self):
+        self.lock = Lock()
+        self.heap = [] # (-priority, arrival, job_id)
+        self.queued = set()
+        self.arrivals = itertools.count()
+
+    def push(self, job_id, priority=0):
+        with self.lock:
+            if job_id in self.queued:
+                return
+            self.queued.add(job_id)
+            heapq.heappush(self.heap, (-priority, next(self.arrivals), job_id))
+
+    def drain(self, try_place):
+        # offer every queued job to try_place in priority order.
+        # try_place(job_id) -> True placed, False keep waiting, None drop (job no longer pending).
+        # returns the placed job ids in priority order
+        placed = []
+        with self.lock:
+            entries = [heapq.heappop(self.heap) for i in range(len(self.heap))]
+            kept = []
+            offered = 0
+            try:
+                for entry in entries:
+                    result = try_place(entry[2])
+                    offered += 1
+                    if result is False:
+                        kept.append(entry)
+                    else:
+                        self.queued.discard(entry[2])
+                        if result:
+                            placed.append(entry[2])
+            finally:
+                # if try_place raised, the entries it did not get to stay queued.
+                # entries were popped in order, so kept followed by them is already a valid heap
+                self.heap = kept + entries[offered:]
+        return placed
+
+    def __len__(self):
+        return len(self.heap)
@@ -0,0 +1,60 @@
+import time
+import uuid
+import shutil
+import argparse
+import tempfile
+from state_store import StateStore
+
+# Measures master state recovery time, from a write-ahead log only and from a snapshot.
+# usage: python recovery_bench.py [--jobs 1000000]
+
+JOB_DICT = {
+    'img_url': 'qizixi/barcode-generator:v0',
+    'resource_requirement': {'cpu': 1, 'memory': 1},
+    'resource_limit': {'cpu': 1, 'memory': 1},
+    'restart': True,
+    'restart_times': 5
+}
+
+
+def write_log(store, job_count):
+    # every job is submitted, placed and finished: three records per job
+    agent_id = str(uuid.uuid4())
+    store.log_agent(agent_id, {'url': 'http://localhost:8001', 'cpu': 64, 'memory': 256, 'status': 'alive'})
+    for i in range(job_count):
+        job_id = str(uuid.uuid4())
+        job_dict = dict(JOB_DICT, job_id=job_id)
+        store.log_job(job_id, {'job_dict': job_dict, 'agent_id': None, 'status': 'pending', 'restart_count': 0})
+        store.log_job(job_id, {'agent_id': agent_id, 'status': 'deploying', 'restart_count': 0})
+        store.log_job(job_id, {'status': 'end', 'restart_count': 0})
+        if len(store.pending) >= store.max_batch:
+            store.commit()
+    while len(store.pending) > 0:
+        store.commit()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='state store recovery benchmark')
+    parser.add_argument('--jobs', default=1000000, type=int)
+    args = parser.parse_args()
+    state_dir = tempfile.mkdtemp(prefix='master_state_')
+    try:
+        store = StateStore(state_dir)
+        store.recover()
+        write_start = time.time()
+        write_log(store, args.jobs)
+        write_duration = time.time() - write_start
+        print('wrote %d wal records in %.2f s (%.0f records/s, %d group commits)' % (
+            store.stats['records'], write_duration, store.stats['records'] / write_duration, store.stats['commits']))
+
+        recover_start = time.time()
+        jobs, agents, arrays = StateStore(state_dir).recover()
+        print('recovered %d jobs from wal in %.2f s' % (len(jobs), time.time() - recover_start))
+
+        store.snapshot(lambda: (jobs, agents, arrays))
+        print('wrote snapshot in %.2f s' % store.stats['last_snapshot_duration'])
+        recover_start = time.time()
+        jobs, agents, arrays = StateStore(state_dir).recover()
+        print('recovered %d jobs from snapshot in %.2f s' % (len(jobs), time.time() - recover_start))
+    finally:
+        shutil.rmtree(state_dir)
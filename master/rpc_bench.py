@@ -0,0 +1,57 @@
+import time
+import argparse
+import xmlrpc.client
+import xmlrpc.server
+from threading import Thread
+from rpc_server import PooledXMLRPCServer
+
+# Calls/sec against a local rpc server: a fresh connection per call (the old behaviour),
+# one keep-alive connection, and system.multicall batches over a keep-alive connection.
+# usage: python rpc_bench.py [--calls 5000] [--batch 100]
+
+
+def start_server(port):
+    server = PooledXMLRPCServer(('localhost', port), 8, 60, 5, allow_none=True, logRequests=False)
+    server.register_function(lambda job_id: 'running', 'get_status')
+    server.register_multicall_functions()
+    server_thread = Thread(target=server.serve_forever)
+    server_thread.setDaemon(True)
+    server_thread.start()
+    return server
+
+
+def fresh_connections(url, calls, batch):
+    for i in range(calls):
+        with xmlrpc.client.ServerProxy(url) as proxy:
+            proxy.get_status('job-%d' % i)
+
+
+def keep_alive(url, calls, batch):
+    with xmlrpc.client.ServerProxy(url) as proxy:
+        for i in range(calls):
+            proxy.get_status('job-%d' % i)
+
+
+def multicall(url, calls, batch):
+    with xmlrpc.client.ServerProxy(url) as proxy:
+        for start in range(0, calls, batch):
+            batch_call = xmlrpc.client.MultiCall(proxy)
+            for i in range(start, min(start + batch, calls)):
+                batch_call.get_status('job-%d' % i)
+            list(batch_call())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='rpc round trip benchmark')
+    parser.add_argument('--calls', default=5000, type=int)
+    parser.add_argument('--batch', default=100, type=int)
+    parser.add_argument('--port', default=8899, type=int)
+    args = parser.parse_args()
+    server = start_server(args.port)
+    url = 'http://localhost:%d' % args.port
+    for name, run in [('fresh connection', fresh_connections), ('keep-alive', keep_alive), ('multicall x%d' % args.batch, multicall)]:
+        start = time.time()
+        run(url, args.calls, args.batch)
+        duration = time.time() - start
+        print('%-18s %10.0f calls/s' % (name, args.calls / duration))
+    server.shutdown()
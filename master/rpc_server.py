@@ -0,0 +1,95 @@
+import time
+import queue
+import select
+import socket
+import selectors
+import xmlrpc.server
+from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+from metrics import MetricsRequestHandler
+
+# XML-RPC server of the master and the agents in threaded mode (RPC_SERVER_MODE), with
+# HTTP/1.1 keep-alive. Identical copies live in master/ and agent/.
+
+
+class KeepAliveRequestHandler(MetricsRequestHandler):
+    # HTTP/1.1: serve further requests on the same connection until the client closes it
+    # or no new request starts within the server's keep-alive timeout
+    protocol_version = 'HTTP/1.1'
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        if isinstance(self.server, PooledXMLRPCServer):
+            # the server parks the connection until its next request, no worker waits for it
+            return
+        while not self.close_connection:
+            # xmlrpc clients do not pipeline, so nothing of the next request is buffered yet
+            readable, _, _ = select.select([self.connection], [], [], self.server.keepalive_timeout)
+            if len(readable) == 0:
+                return
+            self.handle_one_request()
+
+
+class PooledXMLRPCServer(xmlrpc.server.SimpleXMLRPCServer):
+    # handles requests on a bounded pool of worker threads instead of one at a time.
+    # a worker serves one request; between requests a keep-alive connection is parked in a
+    # selector watched by one thread and gets a worker again when its next request arrives,
+    # so idle connections (every agent keeps one open for its pushes) never hold workers
+    request_queue_size = 128
+
+    def __init__(self, addr, workers, request_timeout, keepalive_timeout, **kwargs):
+        # keep-alive only here, in serial mode an idle connection would block the server
+        kwargs.setdefault('requestHandler', KeepAliveRequestHandler)
+        super().__init__(addr, **kwargs)
+        self.request_timeout = request_timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.parked = selectors.DefaultSelector() # only touched by the parking thread
+        self.to_park = queue.SimpleQueue()
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.parked.register(self.wakeup_recv, selectors.EVENT_READ)
+        parking_thread = Thread(target=self.watch_parked)
+        parking_thread.setDaemon(True)
+        parking_thread.start()
+
+    def process_request(self, request, client_address):
+        request.settimeout(self.request_timeout)
+        self.executor.submit(self.process_request_worker, request, client_address)
+
+    def finish_request(self, request, client_address):
+        return self.RequestHandlerClass(request, client_address, self)
+
+    def process_request_worker(self, request, client_address):
+        keep_alive = False
+        try:
+            handler = self.finish_request(request, client_address)
+            keep_alive = not getattr(handler, 'close_connection', True)
+        except Exception:
+            self.handle_error(request, client_address)
+        if keep_alive:
+            self.to_park.put((request, client_address))
+            self.wakeup_send.send(b'\0')
+        else:
+            self.shutdown_request(request)
+
+    def watch_parked(self):
+        # hand readable connections to the workers, close those idle for keepalive_timeout
+        next_expiry = time.time() + 1
+        while True:
+            for key, events in self.parked.select(timeout=1):
+                if key.fileobj is self.wakeup_recv:
+                    self.wakeup_recv.recv(4096)
+                    continue
+                self.parked.unregister(key.fileobj)
+                self.executor.submit(self.process_request_worker, key.fileobj, key.data[0])
+            now = time.time()
+            while not self.to_park.empty():
+                request, client_address = self.to_park.get()
+                self.parked.register(request, selectors.EVENT_READ, (client_address, now + self.keepalive_timeout))
+            if now >= next_expiry:
+                next_expiry = now + 1
+                for key in list(self.parked.get_map().values()):
+                    if key.fileobj is not self.wakeup_recv and key.data[1] <= now:
+                        self.parked.unregister(key.fileobj)
+                        self.shutdown_request(key.fileobj)
@@ -0,0 +1,370 @@
+import bisect
+import itertools
+from threading import Lock
+
+# Capacity-aware job placement.
+# Every schedulable agent sits in two sorted indexes:
+#   free_index:  (free_cpu, free_memory, agent_id)  -> least_loaded / bin_packing
+#   count_index: (job_count, agent_id)              -> spread
+# free capacity = registered capacity - the larger of the requirements of jobs reserved on the
+# agent and the use the agent measures (set_agent_usage), so the master neither overcommits an
+# agent between two heartbeats nor fills one that is busier than its reservations say.
+# Both are SortedIndex: keys kept in sorted buckets of at most INDEX_BUCKET_SIZE, so a lookup is a
+# bisect plus a short scan and an index update moves one bucket (plus the short list of bucket
+# maxima) rather than the whole index.
+# With image locality on, a job is first offered to the agents that already hold its image
+# (image_agents), in the order of the placement policy, and only then to every agent.
+# Few holders are ranked directly (O(holders)); when many agents hold the image the policy
+# walks its index skipping the others, which then finds a holder after a few steps.
+
+INDEX_BUCKET_SIZE = 256 # keys per SortedIndex bucket, a full bucket is split in two
+
+
+class SortedIndex:
+    # sorted keys in a list of sorted buckets; iterates in order, reversed() from the largest key
+    def __init__(self):
+        self.buckets = []
+        self.maxes = [] # largest key of each bucket
+        self.size = 0
+
+    def add(self, key):
+        if len(self.buckets) == 0:
+            self.buckets.append([key])
+            self.maxes.append(key)
+            self.size = 1
+            return
+        i = min(bisect.bisect_left(self.maxes, key), len(self.buckets) - 1)
+        bucket = self.buckets[i]
+        bisect.insort(bucket, key)
+        self.maxes[i] = bucket[-1]
+        self.size += 1
+        if len(bucket) > INDEX_BUCKET_SIZE:
+            half = len(bucket) // 2
+            self.buckets[i:i + 1] = [bucket[:half], bucket[half:]]
+            self.maxes[i:i + 1] = [bucket[half - 1], bucket[-1]]
+
+    def discard(self, key):
+        i = bisect.bisect_left(self.maxes, key)
+        if i == len(self.buckets):
+            return
+        bucket = self.buckets[i]
+        j = bisect.bisect_left(bucket, key)
+        if bucket[j] != key:
+            return
+        del bucket[j]
+        self.size -= 1
+        if len(bucket) == 0:
+            del self.buckets[i]
+            del self.maxes[i]
+        else:
+            self.maxes[i] = bucket[-1]
+
+    def irange(self, key):
+        # keys >= key in order
+        i = bisect.bisect_left(self.maxes, key)
+        if i == len(self.buckets):
+            return
+        bucket = self.buckets[i]
+        yield from itertools.islice(bucket, bisect.bisect_left(bucket, key), None)
+        for bucket in itertools.islice(self.buckets, i + 1, None):
+            yield from bucket
+
+    def __iter__(self):
+        for bucket in self.buckets:
+            yield from bucket
+
+    def __reversed__(self):
+        for bucket in reversed(self.buckets):
+            yield from reversed(bucket)
+
+    def __len__(self):
+        return self.size
+
+
+# Placement policies
+# policy(scheduler, cpu, memory, exclude) -> agent_id or None, called with scheduler.lock held
+def least_loaded_policy(scheduler, cpu, memory, exclude):
+    # agent with the most free cpu (then memory) that fits the job
+    for free_cpu, free_memory, agent_id in reversed(scheduler.free_index):
+        if free_cpu < cpu:
+            break
+        if free_memory >= memory and agent_id not in exclude:
+            return agent_id
+    return None
+
+
+def bin_packing_policy(scheduler, cpu, memory, exclude):
+    # agent with the least free cpu (then memory) that still fits the job
+    for free_cpu, free_memory, agent_id in scheduler.free_index.irange((cpu, memory)):
+        if free_memory >= memory and agent_id not in exclude:
+            return agent_id
+    return None
+
+
+def spread_policy(scheduler, cpu, memory, exclude):
+    # agent running the fewest jobs that fits the job
+    for job_count, agent_id in scheduler.count_index:
+        agent = scheduler.agents[agent_id]
+        if agent['free_cpu'] >= cpu and agent['free_memory'] >= memory and agent_id not in exclude:
+            return agent_id
+    return None
+
+
+# Locality policies
+# among(scheduler, cpu, memory, exclude, candidates) -> the agent the policy would pick out of candidates
+def fitting_agents(scheduler, cpu, memory, exclude, candidates):
+    for agent_id in candidates:
+        agent = scheduler.agents[agent_id]
+        if agent['schedulable'] and agent['free_cpu'] >= cpu and agent['free_memory'] >= memory and agent_id not in exclude:
+            yield agent_id, agent
+
+
+def least_loaded_among(scheduler, cpu, memory, exclude, candidates):
+    best = max(((agent['free_cpu'], agent['free_memory'], agent_id) for agent_id, agent in fitting_agents(scheduler, cpu, memory, exclude, candidates)), default=None)
+    return best[2] if best is not None else None
+
+
+def bin_packing_among(scheduler, cpu, memory, exclude, candidates):
+    best = min(((agent['free_cpu'], agent['free_memory'], agent_id) for agent_id, agent in fitting_agents(scheduler, cpu, memory, exclude, candidates)), default=None)
+    return best[2] if best is not None else None
+
+
+def spread_among(scheduler, cpu, memory, exclude, candidates):
+    best = min(((agent['job_count'], agent_id) for agent_id, agent in fitting_agents(scheduler, cpu, memory, exclude, candidates)), default=None)
+    return best[1] if best is not None else None
+
+
+class LocalityExclude:
+    # exclude set for the locality pass: everything excluded plus every agent without the image
+    def __init__(self, exclude, holders):
+        self.exclude = exclude
+        self.holders = holders
+
+    def __contains__(self, agent_id):
+        return agent_id not in self.holders or agent_id in self.exclude
+
+
+def normalize_image(image):
+    # 'ubuntu' and 'ubuntu:latest' name the same image, digests are kept as they are
+    if '@' in image or ':' in image.rsplit('/', 1)[-1]:
+        return image
+    return image + ':latest'
+
+
+POLICIES = {
+    'least_loaded': least_loaded_policy,
+    'bin_packing': bin_packing_policy,
+    'spread': spread_policy,
+}
+LOCALITY_POLICIES = {
+    'least_loaded': least_loaded_among,
+    'bin_packing': bin_packing_among,
+    'spread': spread_among,
+}
+
+
+def register_policy(name, policy, among=None):
+    # without among the locality pass walks the policy's index skipping agents without the image
+    POLICIES[name] = policy
+    if among is not None:
+        LOCALITY_POLICIES[name] = among
+    else:
+        LOCALITY_POLICIES.pop(name, None)
+
+
+class Scheduler:
+    def __init__(self, policy='least_loaded', image_locality=True, lock=None):
+        if policy not in POLICIES:
+            raise ValueError('unknown scheduling policy: %s' % policy)
+        self.policy = policy
+        self.image_locality = image_locality
+        self.lock = lock if lock is not None else Lock() # any Lock-like object, e.g. a metrics.TimedLock
+        self.agents = {} # agent_id -> {'cpu', 'memory', 'free_cpu', 'free_memory', 'reserved_cpu', 'reserved_memory', 'used_cpu', 'used_memory', 'job_count', 'schedulable', 'images'}
+        self.reservations = {} # job_id -> (agent_id, cpu, memory)
+        self.free_index = SortedIndex()
+        self.count_index = SortedIndex()
+        self.image_agents = {} # normalized image ref -> set of agent ids holding it
+        self.locality_stats = {'local': 0, 'remote': 0}
+
+    # index maintenance, scheduler.lock held
+    def _index_remove(self, agent_id):
+        agent = self.agents[agent_id]
+        self.free_index.discard((agent['free_cpu'], agent['free_memory'], agent_id))
+        self.count_index.discard((agent['job_count'], agent_id))
+
+    def _index_insert(self, agent_id):
+        agent = self.agents[agent_id]
+        if not agent['schedulable']:
+            return
+        self.free_index.add((agent['free_cpu'], agent['free_memory'], agent_id))
+        self.count_index.add((agent['job_count'], agent_id))
+
+    def _adjust(self, agent_id, cpu, memory, job_count):
+        # cpu and memory reserved (negative) or released (positive)
+        self._index_remove(agent_id)
+        agent = self.agents[agent_id]
+        agent['reserved_cpu'] -= cpu
+        agent['reserved_memory'] -= memory
+        agent['job_count'] += job_count
+        self._set_free(agent)
+        self._index_insert(agent_id)
+
+    def _set_free(self, agent):
+        agent['free_cpu'] = agent['cpu'] - max(agent['reserved_cpu'], agent['used_cpu'])
+        agent['free_memory'] = agent['memory'] - max(agent['reserved_memory'], agent['used_memory'])
+
+    # agent lifecycle
+    def add_agent(self, agent_id, cpu, memory, schedulable=True):
+        with self.lock:
+            self.agents[agent_id] = {
+                'cpu': cpu,
+                'memory': memory,
+                'free_cpu': cpu,
+                'free_memory': memory,
+                'reserved_cpu': 0,
+                'reserved_memory': 0,
+                'used_cpu': 0,
+                'used_memory': 0,
+                'job_count': 0,
+                'schedulable': schedulable,
+                'images': set()
+            }
+            self._index_insert(agent_id)
+
+    def set_agent_images(self, agent_id, images):
+        # replace the set of image refs (tags and digests) the agent holds locally
+        with self.lock:
+            if agent_id not in self.agents:
+                return
+            self._drop_images(agent_id)
+            self._add_images(agent_id, images)
+
+    def add_agent_images(self, agent_id, images):
+        with self.lock:
+            if agent_id in self.agents:
+                self._add_images(agent_id, images)
+
+    def _add_images(self, agent_id, images):
+        for image in images:
+            image = normalize_image(image)
+            self.agents[agent_id]['images'].add(image)
+            self.image_agents.setdefault(image, set()).add(agent_id)
+
+    def _drop_images(self, agent_id):
+        for image in self.agents[agent_id]['images']:
+            holders = self.image_agents[image]
+            holders.discard(agent_id)
+            if len(holders) == 0:
+                del self.image_agents[image]
+        self.agents[agent_id]['images'] = set()
+
+    def set_agent_usage(self, agent_id, cpu, memory):
+        # cpu and memory the agent measures in use, jobs and everything else on the host.
+        # returns whether the agent's free cpu or memory grew
+        with self.lock:
+            if agent_id not in self.agents:
+                return False
+            self._index_remove(agent_id)
+            agent = self.agents[agent_id]
+            free = (agent['free_cpu'], agent['free_memory'])
+            agent['used_cpu'] = cpu
+            agent['used_memory'] = memory
+            self._set_free(agent)
+            self._index_insert(agent_id)
+            return agent['free_cpu'] > free[0] or agent['free_memory'] > free[1]
+
+    def set_schedulable(self, agent_id, schedulable):
+        # agents in icu keep their reservations but take no new jobs
+        with self.lock:
+            agent = self.agents[agent_id]
+            if agent['schedulable'] == schedulable:
+                return
+            self._index_remove(agent_id)
+            agent['schedulable'] = schedulable
+            self._index_insert(agent_id)
+
+    def remove_agent(self, agent_id):
+        # drop the agent and every reservation held on it, returns the released job ids
+        with self.lock:
+            self._index_remove(agent_id)
+            self._drop_images(agent_id)
+            del self.agents[agent_id]
+            released = [job_id for job_id, reservation in self.reservations.items() if reservation[0] == agent_id]
+            for job_id in released:
+                del self.reservations[job_id]
+            return released
+
+    # job placement
+    def _pick(self, cpu, memory, exclude, policy, image):
+        # scheduler.lock held. agents holding the image first, then any agent
+        policy = policy or self.policy
+        place = POLICIES[policy]
+        if image is not None and self.image_locality:
+            holders = self.image_agents.get(normalize_image(image))
+            if holders:
+                among = LOCALITY_POLICIES.get(policy)
+                if among is not None and len(holders) * len(holders) <= len(self.agents):
+                    agent_id = among(self, cpu, memory, exclude, holders)
+                else:
+                    agent_id = place(self, cpu, memory, LocalityExclude(exclude, holders))
+                if agent_id is not None:
+                    self.locality_stats['local'] += 1
+                    return agent_id
+            agent_id = place(self, cpu, memory, exclude)
+            if agent_id is not None:
+                self.locality_stats['remote'] += 1
+            return agent_id
+        return place(self, cpu, memory, exclude)
+
+    def reserve(self, job_id, requirement, exclude=(), policy=None, image=None):
+        # pick an agent for the job and reserve its requirement there, returns agent_id or None
+        cpu = requirement['cpu']
+        memory = requirement['memory']
+        with self.lock:
+            if job_id in self.reservations:
+                return self.reservations[job_id][0]
+            agent_id = self._pick(cpu, memory, exclude, policy, image)
+            if agent_id is None:
+                return None
+            self.reservations[job_id] = (agent_id, cpu, memory)
+            self._adjust(agent_id, -cpu, -memory, 1)
+            return agent_id
+
+    def reserve_on(self, job_id, agent_id, requirement):
+        # reserve on a given agent regardless of its free capacity, used when restoring state
+        with self.lock:
+            if job_id in self.reservations or agent_id not in self.agents:
+                return
+            self.reservations[job_id] = (agent_id, requirement['cpu'], requirement['memory'])
+            self._adjust(agent_id, -requirement['cpu'], -requirement['memory'], 1)
+
+    def reserve_many(self, requests, policy=None):
+        # place a batch of (job_id, requirement, image) in one pass under a single lock acquisition,
+        # returns the agent_id (or None) for each request in order
+        placements = []
+        with self.lock:
+            for job_id, requirement, image in requests:
+                if job_id in self.reservations:
+                    placements.append(self.reservations[job_id][0])
+                    continue
+                cpu = requirement['cpu']
+                memory = requirement['memory']
+                agent_id = self._pick(cpu, memory, (), policy, image)
+                if agent_id is not None:
+                    self.reservations[job_id] = (agent_id, cpu, memory)
+                    self._adjust(agent_id, -cpu, -memory, 1)
+                placements.append(agent_id)
+        return placements
+
+    def release(self, job_id):
+        with self.lock:
+            if job_id not in self.reservations:
+                return None
+            agent_id, cpu, memory = self.reservations.pop(job_id)
+            if agent_id in self.agents:
+                self._adjust(agent_id, cpu, memory, -1)
+            return agent_id
+
+    def reserved_agent(self, job_id):
+        reservation = self.reservations.get(job_id)
+        return reservation[0] if reservation is not None else None
@@ -0,0 +1,49 @@
+import time
+import random
+import argparse
+from scheduler import Scheduler, POLICIES
+
+# Measures placement latency as the number of agents grows.
+# usage: python scheduler_bench.py [--policy least_loaded] [--placements 20000]
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+def bench(agent_count, policy, placements):
+    scheduler = Scheduler(policy)
+    for i in range(agent_count):
+        scheduler.add_agent('agent-%d' % i, random.choice([8, 16, 32, 64]), random.choice([16, 32, 64, 128]))
+    latencies = []
+    live_jobs = []
+    for i in range(placements):
+        job_id = 'job-%d' % i
+        requirement = {'cpu': random.randint(1, 4), 'memory': random.randint(1, 8)}
+        start = time.perf_counter()
+        agent_id = scheduler.reserve(job_id, requirement)
+        latencies.append(time.perf_counter() - start)
+        if agent_id is not None:
+            live_jobs.append(job_id)
+        # keep the cluster around half full so placements neither always succeed nor always fail
+        if len(live_jobs) > agent_count * 4:
+            scheduler.release(live_jobs.pop(random.randrange(len(live_jobs))))
+    return latencies
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='scheduler placement benchmark')
+    parser.add_argument('--policy', default=None, choices=sorted(POLICIES))
+    parser.add_argument('--placements', default=20000, type=int)
+    args = parser.parse_args()
+    policies = [args.policy] if args.policy else sorted(POLICIES)
+    print('%-14s %8s %12s %12s %12s' % ('policy', 'agents', 'mean (us)', 'p50 (us)', 'p99 (us)'))
+    for policy in policies:
+        for agent_count in [10, 100, 1000, 5000, 50000]:
+            latencies = bench(agent_count, policy, args.placements)
+            print('%-14s %8d %12.2f %12.2f %12.2f' % (
+                policy, agent_count,
+                sum(latencies) / len(latencies) * 1e6,
+                percentile(latencies, 50) * 1e6,
+                percentile(latencies, 99) * 1e6))
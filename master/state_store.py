@@ -0,0 +1,206 @@
+import os
+import json
+import time
+from threading import Thread, Lock, Condition
+
+# Durable master state: an append-only write-ahead log of job/agent transitions plus
+# periodic compacted snapshots.
+#
+# Every record is one json line {'kind': 'job'|'agent'|'array', 'id': str, 'fields': {...}} holding
+# the fields that changed (or 'deleted': true). Replaying records in order over the latest
+# snapshot rebuilds the state; records only set fields, so replaying one that the snapshot
+# already contains is harmless.
+#
+# Layout of the state directory:
+#   wal.<segment>   log segments, a new one is started by every snapshot
+#   snapshot        {'kind': 'header', 'segment': n} then one full record per job, agent and array,
+#                   covering everything logged before segment n
+#
+# Appends are group committed: callers only queue their record, a writer thread writes
+# everything queued in one write + fsync every commit_interval seconds. Callers that need
+# durability wait for the commit seq returned by log_job/log_agent. A batch stays queued until
+# its write + fsync succeeded; after a failed one the segment is cut back to where the batch
+# started and the writer retries, so waiters are never told a record is durable before it is.
+
+
+class StateStore:
+    def __init__(self, directory, commit_interval=0.01, max_batch=10000):
+        self.directory = directory
+        self.commit_interval = commit_interval
+        self.max_batch = max_batch
+        self.lock = Lock() # guards pending and the seqs
+        self.write_lock = Lock() # guards wal_file and segment
+        self.committed = Condition(self.lock)
+        self.pending = [] # serialized records waiting for the next group commit
+        self.appended_seq = 0 # seq of the last queued record
+        self.durable_seq = 0 # seq of the last record known to be on disk
+        self.segment = 0
+        self.wal_file = None
+        self.stats = {'records': 0, 'commits': 0, 'snapshots': 0, 'last_commit_size': 0, 'last_snapshot_duration': 0.0}
+
+    # recovery
+    def recover(self):
+        # rebuild state from snapshot + wal, returns (jobs, agents, arrays) as id -> fields dicts
+        os.makedirs(self.directory, exist_ok=True)
+        jobs = {}
+        agents = {}
+        arrays = {}
+        tables = {'job': jobs, 'agent': agents, 'array': arrays}
+        first_segment = 0
+        snapshot_path = os.path.join(self.directory, 'snapshot')
+        if os.path.exists(snapshot_path):
+            with open(snapshot_path) as snapshot_file:
+                header = json.loads(snapshot_file.readline())
+                first_segment = header['segment']
+                for line in snapshot_file:
+                    record = json.loads(line)
+                    tables[record['kind']][record['id']] = record['fields']
+        segments = self.list_segments()
+        for segment in segments:
+            if segment < first_segment:
+                continue
+            with open(self.segment_path(segment)) as wal_file:
+                lines = wal_file.readlines()
+            for line_number, line in enumerate(lines):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    if line_number == len(lines) - 1 and not line.endswith('\n'):
+                        # torn write at the tail of the segment from a crash
+                        print("state store: dropping torn record at the end of %s" % self.segment_path(segment))
+                        break
+                    raise ValueError('corrupt record at line %d of %s' % (line_number + 1, self.segment_path(segment)))
+                table = tables[record['kind']]
+                if record.get('deleted'):
+                    table.pop(record['id'], None)
+                elif record['id'] in table:
+                    table[record['id']].update(record['fields'])
+                else:
+                    table[record['id']] = record['fields']
+        self.segment = max(segments + [first_segment]) + 1
+        self.wal_file = self.open_segment(self.segment)
+        return jobs, agents, arrays
+
+    def list_segments(self):
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.startswith('wal.'):
+                segments.append(int(name[len('wal.'):]))
+        return sorted(segments)
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, 'wal.%d' % segment)
+
+    def open_segment(self, segment):
+        # unbuffered, a failed write leaves nothing behind in a buffer to be flushed later
+        return open(self.segment_path(segment), 'ab', buffering=0)
+
+    # appends
+    def append(self, record):
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self.lock:
+            self.pending.append(line)
+            self.appended_seq += 1
+            return self.appended_seq
+
+    def log_job(self, job_id, fields):
+        return self.append({'kind': 'job', 'id': job_id, 'fields': fields})
+
+    def log_agent(self, agent_id, fields):
+        return self.append({'kind': 'agent', 'id': agent_id, 'fields': fields})
+
+    def log_array(self, array_id, fields):
+        return self.append({'kind': 'array', 'id': array_id, 'fields': fields})
+
+    def log_job_deleted(self, job_id):
+        return self.append({'kind': 'job', 'id': job_id, 'deleted': True})
+
+    def wait_durable(self, seq, timeout=None):
+        with self.lock:
+            return self.committed.wait_for(lambda: self.durable_seq >= seq, timeout)
+
+    def commit(self):
+        # write everything queued so far in one write + fsync. appenders are only blocked
+        # for the list copy, not for the disk write. the batch leaves pending once it is on disk
+        with self.write_lock:
+            with self.lock:
+                batch = self.pending[:self.max_batch]
+                batch_seq = self.durable_seq + len(batch)
+            if len(batch) == 0:
+                return
+            data = ''.join(batch).encode()
+            start = os.fstat(self.wal_file.fileno()).st_size
+            try:
+                written = 0
+                while written < len(data):
+                    written += self.wal_file.write(data[written:])
+                os.fsync(self.wal_file.fileno())
+            except OSError:
+                # drop whatever part of the batch reached the segment, the retry writes all of it.
+                # if even that fails the segment may end in a partial batch, start a new one
+                try:
+                    os.ftruncate(self.wal_file.fileno(), start)
+                except OSError:
+                    wal_file = self.open_segment(self.segment + 1)
+                    self.wal_file.close()
+                    self.segment += 1
+                    self.wal_file = wal_file
+                raise
+            with self.lock:
+                del self.pending[:len(batch)]
+                self.durable_seq = batch_seq
+                self.stats['records'] += len(batch)
+                self.stats['commits'] += 1
+                self.stats['last_commit_size'] = len(batch)
+                self.committed.notify_all()
+
+    def run_writer(self):
+        while True:
+            time.sleep(self.commit_interval)
+            try:
+                while len(self.pending) > 0:
+                    self.commit()
+            except OSError as err:
+                print("state store commit error:", str(err))
+
+    def start_writer(self):
+        writer_thread = Thread(target=self.run_writer)
+        writer_thread.setDaemon(True)
+        writer_thread.start()
+        return writer_thread
+
+    # compaction
+    def snapshot(self, capture_state):
+        # capture_state() -> (jobs, agents, arrays) as id -> full fields dicts, taken after the wal switch
+        snapshot_start = time.time()
+        self.commit()
+        with self.write_lock:
+            # the new segment holds everything written from here on, older ones are covered by the snapshot
+            old_segment = self.segment
+            self.wal_file.close()
+            self.segment += 1
+            new_segment = self.segment
+            self.wal_file = self.open_segment(new_segment)
+        jobs, agents, arrays = capture_state()
+        snapshot_path = os.path.join(self.directory, 'snapshot')
+        with open(snapshot_path + '.tmp', 'w') as snapshot_file:
+            snapshot_file.write(json.dumps({'kind': 'header', 'segment': new_segment}) + '\n')
+            for kind, table in [('job', jobs), ('agent', agents), ('array', arrays)]:
+                for record_id, fields in table.items():
+                    snapshot_file.write(json.dumps({'kind': kind, 'id': record_id, 'fields': fields}, separators=(',', ':')) + '\n')
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(snapshot_path + '.tmp', snapshot_path)
+        for segment in self.list_segments():
+            if segment <= old_segment:
+                os.remove(self.segment_path(segment))
+        with self.lock:
+            self.stats['snapshots'] += 1
+            self.stats['last_snapshot_duration'] = time.time() - snapshot_start
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['pending'] = len(self.pending)
+        stats['segment'] = self.segment
+        return stats
@@ -0,0 +1,65 @@
+import unittest
+from failure_detector import PhiAccrualDetector
+
+# usage (from master/): python -m pytest -q test_failure_detector.py
+
+
+def regular_detector(interval=1.0, beats=50, window=100, min_std_deviation=0.1, acceptable_pause=0.0):
+    detector = PhiAccrualDetector(interval, window, min_std_deviation, acceptable_pause, 0.0)
+    for beat in range(1, beats + 1):
+        detector.heartbeat(beat * interval)
+    return detector
+
+
+class TestPhiAccrualDetector(unittest.TestCase):
+    def test_phi_grows_with_silence(self):
+        detector = regular_detector()
+        last = 50.0
+        phis = [detector.phi(last + elapsed) for elapsed in [0.5, 1.0, 1.2, 1.5, 2.0, 5.0]]
+        self.assertEqual(phis, sorted(phis))
+        self.assertLess(phis[0], 0.1)
+        # at the mean interval the agent is late as often as not
+        self.assertAlmostEqual(phis[1], 0.30103, places=3)
+        self.assertGreater(phis[-1], 8)
+
+    def test_no_overflow_far_past_the_deadline(self):
+        detector = regular_detector()
+        self.assertGreater(detector.phi(1e9), 100)
+        self.assertLess(detector.phi(50.0), 1)
+
+    def test_acceptable_pause_delays_suspicion(self):
+        strict = regular_detector()
+        lenient = regular_detector(acceptable_pause=2.0)
+        self.assertGreater(strict.phi(53.0), 8)
+        self.assertLess(lenient.phi(53.0), 1)
+
+    def test_irregular_intervals_are_suspected_later(self):
+        regular = regular_detector()
+        irregular = PhiAccrualDetector(1.0, 100, 0.1, 0.0, 0.0)
+        now = 0.0
+        for beat in range(50):
+            now += 0.5 if beat % 2 else 1.5
+            irregular.heartbeat(now)
+        self.assertLess(irregular.phi(now + 2.0), regular.phi(50.0 + 2.0))
+
+    def test_window_forgets_old_intervals(self):
+        detector = regular_detector(interval=10.0, beats=5, window=5)
+        for beat in range(1, 6):
+            detector.heartbeat(50.0 + beat)
+        # only the 1 second intervals are left, a 10 second silence is now suspicious
+        self.assertEqual(list(detector.intervals), [1.0] * 5)
+        self.assertGreater(detector.phi(65.0), 8)
+
+    def test_push_proves_liveness_without_a_sample(self):
+        detector = regular_detector()
+        detector.heartbeat(60.0, sample=False)
+        self.assertLess(detector.phi(60.5), 0.1)
+        self.assertEqual(len(detector.intervals), 51)
+        self.assertEqual(detector.last_sample, 50.0)
+        # a late sample still measures from the last sampled heartbeat
+        detector.heartbeat(61.0)
+        self.assertEqual(detector.intervals[-1], 11.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
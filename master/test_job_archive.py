@@ -0,0 +1,86 @@
+import unittest
+from job_table import Job, SpecTable, spec_table, PENDING, RUNNING, END, FAIL, intern_status
+from job_archive import JobArchive
+
+# usage (from master/): python -m pytest -q test_job_archive.py
+
+JOB_DICT = {'img_url': 'ubuntu', 'restart': 0, 'resource_requirement': {'cpu': 1, 'memory': 1}, 'resource_limit': {'cpu': 1, 'memory': 1}}
+
+
+def new_job(job_id, agent_id=None, status=PENDING):
+    return Job(dict(JOB_DICT, job_id=job_id), agent_id, status)
+
+
+class TestJobTable(unittest.TestCase):
+    def test_identical_specs_are_shared(self):
+        table = SpecTable()
+        key, spec = table.acquire(dict(JOB_DICT, job_id='j1'))
+        other_key, other_spec = table.acquire(dict(JOB_DICT, job_id='j2'))
+        self.assertIs(spec, other_spec)
+        self.assertNotIn('job_id', spec)
+        self.assertEqual(len(table), 1)
+        table.release(key)
+        table.release(other_key)
+        self.assertEqual(len(table), 0)
+
+    def test_status_and_finished_at(self):
+        job = new_job('j1')
+        self.assertIsNone(job.finished_at)
+        job.set_status('end')
+        self.assertIs(job.status, END)
+        self.assertIsNotNone(job.finished_at)
+        job.set_status(RUNNING)
+        self.assertIsNone(job.finished_at)
+        self.assertIs(intern_status(''.join(['fa', 'il'])), FAIL)
+        job.release_spec()
+
+    def test_record_round_trip(self):
+        job = new_job('j1', 'a1', RUNNING)
+        copy = Job.from_record(job.to_record())
+        self.assertEqual((copy.job_id, copy.agent_id, copy.status, copy.job_dict), ('j1', 'a1', RUNNING, job.job_dict))
+        job.release_spec()
+        copy.release_spec()
+
+
+class TestJobArchive(unittest.TestCase):
+    def setUp(self):
+        self.archive = JobArchive(':memory:')
+        jobs = [new_job('j%d' % i, 'a%d' % (i % 2), END if i % 3 else FAIL) for i in range(10)]
+        self.archive.archive(jobs)
+        for job in jobs:
+            job.release_spec()
+
+    def test_get(self):
+        specs = len(spec_table)
+        job = self.archive.get('j4')
+        self.assertEqual((job.job_id, job.agent_id, job.status), ('j4', 'a0', END))
+        self.assertEqual(job.job_dict, dict(JOB_DICT, job_id='j4'))
+        # a detached copy, it holds no spec table reference
+        self.assertEqual(len(spec_table), specs)
+        self.assertIsNone(self.archive.get('j10'))
+        self.assertEqual(sorted(self.archive.get_many(['j1', 'j2', 'j10'])), ['j1', 'j2'])
+
+    def test_get_statuses(self):
+        job_ids = ['j%d' % i for i in range(10)] + ['missing-%d' % i for i in range(1000)]
+        statuses = self.archive.get_statuses(job_ids)
+        self.assertEqual(len(statuses), 10)
+        self.assertEqual(statuses['j3'], FAIL)
+
+    def test_page(self):
+        self.assertEqual(self.archive.count(), 10)
+        first = self.archive.page(limit=4)
+        self.assertEqual([row[0] for row in first], ['j0', 'j1', 'j2', 'j3'])
+        second = self.archive.page(cursor=first[-1][0], limit=4)
+        self.assertEqual([row[0] for row in second], ['j4', 'j5', 'j6', 'j7'])
+        self.assertEqual([row[0] for row in self.archive.page(status=FAIL, agent_id='a1')], ['j3', 'j9'])
+
+    def test_archive_replaces(self):
+        job = new_job('j1', 'a1', FAIL)
+        self.archive.archive([job])
+        job.release_spec()
+        self.assertEqual(self.archive.count(), 10)
+        self.assertEqual(self.archive.get('j1').status, FAIL)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+from job_table import PENDING, RUNNING, END, FAIL
+from job_array import JobArray, QUEUED, range_size, task_array_id, task_index
+
+# usage (from master/): python -m pytest -q test_job_array.py
+
+SPEC = {'img_url': 'ubuntu', 'restart': 0, 'command': ['run', '--seed', '{seed}'], 'environment': {'SEED': '{seed}'},
+        'resource_requirement': {'cpu': 1, 'memory': 1}, 'resource_limit': {'cpu': 1, 'memory': 1}}
+
+
+class TestJobArray(unittest.TestCase):
+    def test_range_size(self):
+        self.assertEqual(range_size(0, 10, 1), len(range(0, 10, 1)))
+        self.assertEqual(range_size(0, 10, 3), len(range(0, 10, 3)))
+        self.assertEqual(range_size(10, 0, -4), len(range(10, 0, -4)))
+        self.assertEqual(range_size(5, 5, 1), 0)
+        self.assertEqual(range_size(5, 0, 1), 0)
+
+    def test_task_ids(self):
+        job_array = JobArray('array-1', SPEC, 'seed', values=['a', 'b'])
+        self.assertEqual(job_array.task_id(1), 'array-1.1')
+        self.assertEqual(task_array_id('array-1.1'), 'array-1')
+        self.assertEqual(task_index('array-1.1'), 1)
+        self.assertIsNone(task_array_id('5b2f4c1e-uuid-of-a-plain-job'))
+
+    def test_task_dict(self):
+        job_array = JobArray('array-1', SPEC, 'seed', value_range=[100, 200, 10])
+        self.assertEqual(job_array.size, 10)
+        task = job_array.task_dict(3)
+        self.assertEqual(task['job_id'], 'array-1.3')
+        self.assertEqual(task['command'], ['run', '--seed', '130'])
+        self.assertEqual(task['environment'], {'SEED': '130'})
+        self.assertEqual(task['resource_requirement'], SPEC['resource_requirement'])
+        # the template is left as it is
+        self.assertEqual(SPEC['command'][2], '{seed}')
+
+    def test_lazy_expansion(self):
+        job_array = JobArray('array-1', SPEC, 'seed', value_range=[0, 1000000, 1])
+        # nothing but one status byte per task until tasks are expanded
+        self.assertEqual(len(job_array.statuses), 1000000)
+        self.assertEqual(job_array.get_counts()[QUEUED], 1000000)
+        self.assertTrue(job_array.active())
+        for index in range(3):
+            job_array.expanded(index)
+        self.assertEqual(job_array.next_index, 3)
+        self.assertEqual(job_array.live, {0, 1, 2})
+        job_array.set_status(0, RUNNING)
+        job_array.set_status(1, END)
+        self.assertEqual(job_array.live, {0, 2})
+        counts = job_array.get_counts()
+        self.assertEqual((counts[QUEUED], counts[PENDING], counts[RUNNING], counts[END]), (999997, 1, 1, 1))
+
+    def test_kill_queued(self):
+        job_array = JobArray('array-1', SPEC, 'seed', values=['a', 'b', 'c', 'd'])
+        job_array.expanded(0)
+        job_array.kill_queued()
+        self.assertFalse(job_array.active())
+        self.assertEqual(job_array.next_index, 1)
+        counts = job_array.get_counts()
+        self.assertEqual((counts[PENDING], counts[FAIL], counts[QUEUED]), (1, 3, 0))
+
+    def test_page(self):
+        job_array = JobArray('array-1', SPEC, 'seed', value_range=[0, 10, 1])
+        for index in range(6):
+            job_array.expanded(index)
+            if index % 2:
+                job_array.set_status(index, RUNNING)
+        self.assertEqual(job_array.page(limit=3), [(0, PENDING), (1, RUNNING), (2, PENDING)])
+        self.assertEqual(job_array.page(cursor=2, limit=2), [(3, RUNNING), (4, PENDING)])
+        self.assertEqual(job_array.page(RUNNING), [(1, RUNNING), (3, RUNNING), (5, RUNNING)])
+        self.assertEqual(job_array.page(QUEUED, cursor=7), [(8, QUEUED), (9, QUEUED)])
+        self.assertEqual(job_array.page(END), [])
+
+    def test_record_round_trip(self):
+        job_array = JobArray('array-1', SPEC, 'seed', values=['a', 'b', 'c'])
+        job_array.expanded(0)
+        job_array.expanded(1)
+        copy = JobArray.from_record('array-1', job_array.to_record())
+        self.assertEqual((copy.size, copy.next_index, copy.values, copy.created_at), (3, 2, ['a', 'b', 'c'], job_array.created_at))
+        # task statuses are rebuilt from the job table, see recover_arrays
+        self.assertEqual(copy.get_counts()[QUEUED], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
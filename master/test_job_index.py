@@ -0,0 +1,116 @@
+import unittest
+import main
+from job_table import Job, PENDING, RUNNING, END, FAIL
+from job_index import JobIndex
+from job_archive import JobArchive
+
+# usage (from master/): python -m pytest -q test_job_index.py
+
+JOB_DICT = {'img_url': 'ubuntu', 'restart': 0, 'resource_requirement': {'cpu': 1, 'memory': 1}, 'resource_limit': {'cpu': 1, 'memory': 1}}
+AGENT_ID = 'job-index-test-agent' # list_jobs tests filter on it, other jobs of the master module are not listed
+
+
+def new_job(job_id, agent_id=None, status=PENDING):
+    return Job(dict(JOB_DICT, job_id=job_id), agent_id, status)
+
+
+class TestJobIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = JobIndex()
+        self.jobs = {}
+        for i in range(20):
+            job = new_job('j%02d' % i, 'a%d' % (i % 2) if i % 4 else None, [PENDING, RUNNING, END][i % 3])
+            self.jobs[job.job_id] = job
+            self.index.update(job)
+
+    def tearDown(self):
+        for job in self.jobs.values():
+            job.release_spec()
+
+    def expected(self, status=None, agent_id=None):
+        return sorted(job_id for job_id, job in self.jobs.items() if (status is None or job.status == status) and (agent_id is None or job.agent_id == agent_id))
+
+    def all_pages(self, status=None, agent_id=None, limit=3):
+        job_ids = []
+        cursor = None
+        while True:
+            page = self.index.page(status, agent_id, cursor, limit)
+            job_ids.extend(page)
+            if len(page) < limit:
+                return job_ids
+            cursor = page[-1]
+
+    def test_filters(self):
+        self.assertEqual(self.all_pages(), self.expected())
+        self.assertEqual(self.all_pages(status=RUNNING), self.expected(status=RUNNING))
+        self.assertEqual(self.all_pages(agent_id='a1'), self.expected(agent_id='a1'))
+        self.assertEqual(self.all_pages(status=END, agent_id='a0'), self.expected(status=END, agent_id='a0'))
+        self.assertEqual(self.index.page(status='unknown'), [])
+
+    def test_reindex_and_remove(self):
+        job = self.jobs['j01']
+        job.set_status(FAIL)
+        job.agent_id = 'a9'
+        self.index.update(job)
+        self.assertEqual(self.all_pages(status=FAIL), ['j01'])
+        self.assertEqual(self.index.agent_job_ids('a9'), ['j01'])
+        self.assertNotIn('j01', self.index.agent_job_ids('a1'))
+        self.index.remove('j01')
+        self.index.remove('j01')
+        self.assertEqual(self.index.agent_job_ids('a9'), [])
+        self.assertEqual(len(self.index), 19)
+        self.assertNotIn('j01', self.all_pages())
+
+
+class TestListJobs(unittest.TestCase):
+    # pages of list_jobs merge the live job table and the archive
+    def setUp(self):
+        self.job_archive = main.job_archive
+        main.job_archive = JobArchive(':memory:')
+        archived = [new_job('list-%02d' % i, AGENT_ID, END) for i in range(0, 20, 2)]
+        # a finished job caught between the archive and the table
+        archived.append(new_job('list-05', AGENT_ID, END))
+        main.job_archive.archive(archived)
+        for job in archived:
+            job.release_spec()
+        self.live_ids = ['list-%02d' % i for i in range(1, 20, 2)]
+        with main.jobs_lock:
+            for job_id in self.live_ids:
+                main.jobs[job_id] = new_job(job_id, AGENT_ID, END if job_id == 'list-05' else RUNNING)
+                main.job_index.update(main.jobs[job_id])
+
+    def tearDown(self):
+        with main.jobs_lock:
+            for job_id in self.live_ids:
+                main.job_index.remove(job_id)
+                main.jobs.pop(job_id).release_spec()
+        main.job_archive = self.job_archive
+
+    def list_all(self, job_filter, limit):
+        listed = []
+        cursor = None
+        while True:
+            page = main.rpc_list_jobs(job_filter, cursor, limit)
+            self.assertLessEqual(len(page['jobs']), limit)
+            listed.extend(page['jobs'])
+            cursor = page['cursor']
+            if cursor is None:
+                return listed
+
+    def test_merged_pages(self):
+        for limit in [1, 3, 7, 100]:
+            listed = self.list_all({'agent_id': AGENT_ID}, limit)
+            # listed once even though it is in both
+            self.assertEqual([job_attrs['job_id'] for job_attrs in listed], ['list-%02d' % i for i in range(20)])
+
+    def test_status_filter(self):
+        listed = self.list_all({'agent_id': AGENT_ID, 'status': END}, 4)
+        self.assertEqual([job_attrs['job_id'] for job_attrs in listed], sorted(['list-%02d' % i for i in range(0, 20, 2)] + ['list-05']))
+
+    def test_limit_bounds(self):
+        with self.assertRaises(main.xmlrpc.client.Fault):
+            main.rpc_list_jobs({}, None, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
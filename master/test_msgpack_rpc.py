@@ -0,0 +1,115 @@
+import io
+import unittest
+import xmlrpc.client
+from threading import Thread
+import msgpack_rpc
+
+# usage (from master/): python -m pytest -q test_msgpack_rpc.py. skipped without msgpack
+
+
+def frame_of(value):
+    body = msgpack_rpc.pack(value)
+    return msgpack_rpc.HEADER.pack(len(body)) + body
+
+
+@unittest.skipUnless(msgpack_rpc.available, 'msgpack is not installed')
+class TestCodec(unittest.TestCase):
+    def test_round_trip(self):
+        value = {'job_id': 'j1', 'cpu': 1.5, 'count': 3, 'none': None, 'flags': [True, False], 'nested': {'1': [1, 2]}}
+        self.assertEqual(msgpack_rpc.unpack(msgpack_rpc.pack(value)), value)
+
+    def test_bytes_arrive_as_binary(self):
+        # like xml-rpc, wherever they are nested
+        value = msgpack_rpc.unpack(msgpack_rpc.pack({'data': b'\x00log', 'chunks': [b'a', 'b'], 'inner': {'data': b'c'}}))
+        self.assertIsInstance(value['data'], xmlrpc.client.Binary)
+        self.assertEqual(value['data'].data, b'\x00log')
+        self.assertEqual([type(item) for item in value['chunks']], [xmlrpc.client.Binary, str])
+        self.assertEqual(value['inner']['data'].data, b'c')
+        self.assertEqual(msgpack_rpc.unpack(msgpack_rpc.pack(b'top')).data, b'top')
+
+    def test_binary_is_sent_as_is(self):
+        value = msgpack_rpc.unpack(msgpack_rpc.pack([xmlrpc.client.Binary(b'\xff')]))
+        self.assertEqual(value[0].data, b'\xff')
+
+    def test_unserializable(self):
+        with self.assertRaises(TypeError):
+            msgpack_rpc.pack({'lock': object()})
+
+    def test_frames(self):
+        stream = io.BytesIO(frame_of(['get_status', ['j1']]) + frame_of([None, 'running']))
+        self.assertEqual(msgpack_rpc.read_frame(stream), ['get_status', ['j1']])
+        self.assertEqual(msgpack_rpc.read_frame(stream), [None, 'running'])
+        with self.assertRaises(EOFError):
+            msgpack_rpc.read_frame(stream)
+
+    def test_bad_frames(self):
+        with self.assertRaises(EOFError):
+            msgpack_rpc.read_frame(io.BytesIO(frame_of(['get_status', ['j1']])[:-1]))
+        with self.assertRaises(xmlrpc.client.ProtocolError):
+            msgpack_rpc.read_frame(io.BytesIO(msgpack_rpc.HEADER.pack(msgpack_rpc.MAX_FRAME_SIZE + 1)))
+        with self.assertRaises(xmlrpc.client.ProtocolError):
+            msgpack_rpc.read_frame(io.BytesIO(msgpack_rpc.HEADER.pack(1) + b'\xc1'))
+
+
+@unittest.skipUnless(msgpack_rpc.available, 'msgpack is not installed')
+class TestServer(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = msgpack_rpc.MsgpackRPCServer(('localhost', 0), 5)
+        cls.server.register_function(lambda a, b: a + b, 'add')
+        cls.server.register_function(lambda: object(), 'unmarshalable')
+        cls.server.register_function(cls.fail, 'fail')
+        cls.server.register_introspection_functions()
+        cls.server.register_multicall_functions()
+        Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    @staticmethod
+    def fail(code):
+        raise xmlrpc.client.Fault(code, 'failed')
+
+    def proxy(self):
+        return msgpack_rpc.MsgpackServerProxy('localhost', self.server.server_address[1], 5)
+
+    def test_calls_and_faults(self):
+        with self.proxy() as proxy:
+            self.assertEqual(proxy.add(1, 2), 3)
+            with self.assertRaises(xmlrpc.client.Fault) as fault:
+                proxy.fail(7)
+            self.assertEqual(fault.exception.faultCode, 7)
+            with self.assertRaises(xmlrpc.client.Fault):
+                proxy.missing()
+            with self.assertRaises(xmlrpc.client.Fault):
+                proxy.unmarshalable()
+            # the connection survives faults
+            self.assertEqual(proxy.add('a', 'b'), 'ab')
+            self.assertIn('add', proxy.system.listMethods())
+
+    def test_multicall(self):
+        with self.proxy() as proxy:
+            multicall = xmlrpc.client.MultiCall(proxy)
+            multicall.add(1, 1)
+            multicall.fail(3)
+            results = multicall()
+            self.assertEqual(results[0], 2)
+            with self.assertRaises(xmlrpc.client.Fault):
+                results[1]
+
+    def test_reconnects_after_a_dropped_connection(self):
+        proxy = self.proxy()
+        self.assertEqual(proxy.add(1, 2), 3)
+        # the connection broke while idle
+        proxy.sock.close()
+        proxy.sock = msgpack_rpc.socket.create_connection(proxy.address)
+        proxy.sock_file = proxy.sock.makefile('rb')
+        proxy.sock.shutdown(msgpack_rpc.socket.SHUT_RDWR)
+        self.assertEqual(proxy.add(2, 2), 4)
+        proxy('close')()
+
+
+if __name__ == '__main__':
+    unittest.main()
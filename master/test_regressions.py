@@ -0,0 +1,262 @@
+import io
+import time
+import argparse
+import unittest
+import contextlib
+import xmlrpc.client
+import main
+from cluster_bench import start_master, wait_for, JOB_DICT
+from fake_agent import FakeAgentHost, DEFAULT_MODEL
+
+# Regression tests against an in-process master and fake agents (fake_agent.py, no docker).
+# usage (from master/): python -m pytest -q test_regressions.py
+
+MASTER_PORT = 9700
+HOST_PORT = 9701
+AGENTS = 2
+BIG_AGENT_CPU = 12 # one more agent that alone fits a job of this many cores
+
+master = None
+host = None
+
+
+def setUpModule():
+    global master, host
+    main.DEAD_PROBE_INTERVAL = 1
+    start_master(MASTER_PORT, argparse.Namespace(heartbeat_rate=0.5, acceptable_pause=0.5))
+    host = FakeAgentHost(('localhost', HOST_PORT))
+    for i in range(AGENTS):
+        host.add_agent(8, 16, dict(DEFAULT_MODEL, job_duration=0))
+    host.add_agent(BIG_AGENT_CPU, 32, dict(DEFAULT_MODEL, job_duration=0))
+    host.start()
+    # the master prints one line per registered agent
+    with contextlib.redirect_stdout(io.StringIO()):
+        host.register('http://localhost:%d' % MASTER_PORT)
+    master = xmlrpc.client.ServerProxy('http://localhost:%d' % MASTER_PORT, allow_none=True)
+
+
+def tearDownModule():
+    host.stop()
+
+
+def fake_job_status(job_id):
+    for agent in host.agents:
+        with agent.lock:
+            if job_id in agent.job_states:
+                return agent.job_states[job_id]['status']
+    return None
+
+
+def slow_submits(seconds):
+    # every fake agent takes this long to answer submit_job, the launch stays in flight
+    for agent in host.agents:
+        submit_job = agent.funcs['submit_job']
+        agent.funcs['submit_job'] = lambda job_dict, submit_job=submit_job: time.sleep(seconds) or submit_job(job_dict)
+
+
+def fast_submits():
+    for agent in host.agents:
+        agent.funcs['submit_job'] = agent.submit_job
+
+
+class TestStatePushes(unittest.TestCase):
+    def test_each_agent_pushes_over_its_own_connection(self):
+        self.assertEqual(len(set(id(agent.master_proxy) for agent in host.agents)), len(host.agents))
+        pushed = main.heartbeat_stats['pushed_reports']
+        job_ids = [result['job_id'] for result in master.submit_jobs([dict(JOB_DICT) for i in range(2 * len(host.agents))])]
+        self.assertTrue(wait_for(lambda: all(master.get_status(job_id) == 'running' for job_id in job_ids), 5))
+        self.assertGreater(main.heartbeat_stats['pushed_reports'], pushed)
+        for agent in host.agents:
+            self.assertTrue(wait_for(lambda: agent.acked_seq == agent.state_seq, 5))
+        for job_id in job_ids:
+            master.kill_job(job_id)
+
+    def test_jobs_lost_by_an_agent_restart_are_relaunched(self):
+        job_id = master.submit_job(dict(JOB_DICT))
+        self.assertTrue(wait_for(lambda: master.get_status(job_id) == 'running', 5))
+        agent = [agent for agent in host.agents if agent.agent_id == main.jobs[job_id].agent_id][0]
+        with contextlib.redirect_stdout(io.StringIO()):
+            agent.restart()
+            # the new run reports no jobs, the job runs again somewhere
+            self.assertTrue(wait_for(lambda: main.agents[agent.agent_id]['heartbeat_epoch'] == agent.epoch, 5))
+            self.assertTrue(wait_for(lambda: master.get_status(job_id) == 'running' and fake_job_status(job_id) == 'running', 5))
+        self.assertEqual(main.scheduler.reserved_agent(job_id), main.jobs[job_id].agent_id)
+        master.kill_job(job_id)
+
+
+class TestMalformedJobs(unittest.TestCase):
+    def test_bad_entries_do_not_fail_the_batch(self):
+        bad = [
+            'not a dict',
+            dict(JOB_DICT, img_url=1),
+            {key: value for key, value in JOB_DICT.items() if key != 'restart'},
+            dict(JOB_DICT, resource_requirement={'cpu': 'one', 'memory': 1}),
+            dict(JOB_DICT, resource_limit=None)
+        ]
+        results = master.submit_jobs(bad + [dict(JOB_DICT)])
+        self.assertEqual([result.get('error') for result in results[:-1]], ['invalid job dict'] * len(bad))
+        job_id = results[-1]['job_id']
+        # the master keeps scheduling
+        self.assertTrue(wait_for(lambda: master.get_status(job_id) == 'running', 5))
+        master.kill_job(job_id)
+
+    def test_submit_jobs_needs_a_list(self):
+        with self.assertRaises(xmlrpc.client.Fault):
+            master.submit_jobs(dict(JOB_DICT))
+
+
+class TestKillRace(unittest.TestCase):
+    def tearDown(self):
+        fast_submits()
+
+    def test_kill_during_launch_stays_failed(self):
+        slow_submits(1)
+        job_id = master.submit_job(dict(JOB_DICT))
+        time.sleep(0.3)
+        self.assertEqual(master.get_status(job_id), 'pending')
+        self.assertTrue(master.kill_job(job_id))
+        # the launch returns, the container it started is killed and the job stays failed
+        self.assertTrue(wait_for(lambda: fake_job_status(job_id) == 'fail', 5))
+        time.sleep(0.5)
+        self.assertEqual(master.get_status(job_id), 'fail')
+        self.assertIsNone(main.scheduler.reserved_agent(job_id))
+
+
+class TestNoneArguments(unittest.TestCase):
+    def test_first_heartbeat_resyncs(self):
+        # the first heartbeat of an agent sends a None seq and epoch
+        self.assertTrue(wait_for(lambda: all(main.agents[agent.agent_id]['heartbeat_epoch'] == agent.epoch for agent in host.agents), 5))
+
+    def test_output_chunk_without_tail(self):
+        job_id = master.submit_job(dict(JOB_DICT))
+        self.assertTrue(wait_for(lambda: master.get_status(job_id) == 'running', 5))
+        chunk = master.output_chunk(job_id, 0, 1024, None)
+        self.assertGreater(len(chunk['data'].data), 0)
+        master.kill_job(job_id)
+
+
+class TestReservations(unittest.TestCase):
+    def test_killed_jobs_give_capacity_back(self):
+        slow_submits(0.5)
+        try:
+            job_ids = [result['job_id'] for result in master.submit_jobs([dict(JOB_DICT) for i in range(6)])]
+            time.sleep(0.2)
+            for job_id in job_ids:
+                master.kill_job(job_id)
+        finally:
+            fast_submits()
+        self.assertTrue(wait_for(lambda: all(fake_job_status(job_id) in [None, 'fail'] for job_id in job_ids), 5))
+        self.assertTrue(wait_for(lambda: all(main.scheduler.reserved_agent(job_id) is None for job_id in job_ids), 5))
+
+    def test_deploy_skips_job_killed_after_reservation(self):
+        job_id = main.get_id('job')
+        main.record_job(dict(JOB_DICT, job_id=job_id))
+        main.rpc_kill_job(job_id)
+        # a pending pass that reserved for it just before the kill
+        main.scheduler.reserve_on(job_id, host.agents[0].agent_id, JOB_DICT['resource_requirement'])
+        main.deploy_jobs([job_id])
+        self.assertIsNone(main.scheduler.reserved_agent(job_id))
+        self.assertIsNone(fake_job_status(job_id))
+
+
+class TestDeadAgent(unittest.TestCase):
+    def test_duplicate_is_killed_on_rejoin(self):
+        job_id = master.submit_job(dict(JOB_DICT))
+        self.assertTrue(wait_for(lambda: master.get_status(job_id) == 'running', 5))
+        crashed = [index for index, agent in enumerate(host.agents) if agent.agent_id == main.jobs[job_id].agent_id][0]
+        agent = host.agents[crashed]
+        with contextlib.redirect_stdout(io.StringIO()):
+            host.crash(crashed)
+            try:
+                self.assertTrue(wait_for(lambda: main.agents[agent.agent_id]['status'] == 'dead', 15))
+                self.assertTrue(wait_for(lambda: main.jobs[job_id].agent_id != agent.agent_id and master.get_status(job_id) == 'running', 5))
+            finally:
+                host.revive(crashed)
+            self.assertTrue(wait_for(lambda: main.agents[agent.agent_id]['status'] == 'alive', 10))
+        # the container left on the rejoined agent is killed, the job runs on the other one
+        self.assertTrue(wait_for(lambda: agent.job_states[job_id]['status'] == 'fail', 5))
+        time.sleep(0.5)
+        self.assertEqual(master.get_status(job_id), 'running')
+        master.kill_job(job_id)
+
+    def test_parked_job_is_adopted_on_rejoin(self):
+        # only the big agent fits the job, it waits for capacity while the agent is dead
+        job_id = master.submit_job(dict(JOB_DICT, resource_requirement={'cpu': BIG_AGENT_CPU, 'memory': 1}))
+        self.assertTrue(wait_for(lambda: master.get_status(job_id) == 'running', 5))
+        agent = host.agents[-1]
+        self.assertEqual(main.jobs[job_id].agent_id, agent.agent_id)
+        with contextlib.redirect_stdout(io.StringIO()):
+            host.crash(len(host.agents) - 1)
+            try:
+                self.assertTrue(wait_for(lambda: main.agents[agent.agent_id]['status'] == 'dead', 15))
+                self.assertTrue(wait_for(lambda: master.get_status(job_id) == 'pending', 5))
+            finally:
+                host.revive(len(host.agents) - 1)
+            self.assertTrue(wait_for(lambda: main.agents[agent.agent_id]['status'] == 'alive', 10))
+        # the container it kept running is the job's again
+        self.assertTrue(wait_for(lambda: master.get_status(job_id) == 'running', 5))
+        time.sleep(1)
+        self.assertEqual(master.get_status(job_id), 'running')
+        self.assertEqual(agent.job_states[job_id]['status'], 'running')
+        self.assertEqual(agent.containers[job_id], 1)
+        self.assertEqual(main.scheduler.reserved_agent(job_id), agent.agent_id)
+        master.kill_job(job_id)
+
+    def test_failover_runs_off_the_supervisor(self):
+        job_id = master.submit_job(dict(JOB_DICT))
+        self.assertTrue(wait_for(lambda: master.get_status(job_id) == 'running', 5))
+        crashed = [index for index, agent in enumerate(host.agents) if agent.agent_id == main.jobs[job_id].agent_id][0]
+        agent = host.agents[crashed]
+        failover_jobs = main.failover_jobs
+        main.failover_jobs = lambda agent_id: time.sleep(2) or failover_jobs(agent_id)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                host.crash(crashed)
+                try:
+                    self.assertTrue(wait_for(lambda: main.agents[agent.agent_id]['status'] == 'dead', 15))
+                    # destroy_agent returned while the failover is still running
+                    self.assertFalse(main.agents[agent.agent_id]['failover'].done())
+                finally:
+                    host.revive(crashed)
+                # the agent answers again but only rejoins once its jobs are failed over
+                time.sleep(1)
+                self.assertEqual(main.agents[agent.agent_id]['status'], 'dead')
+                self.assertTrue(wait_for(lambda: main.agents[agent.agent_id]['status'] == 'alive', 10))
+        finally:
+            main.failover_jobs = failover_jobs
+        self.assertTrue(wait_for(lambda: master.get_status(job_id) == 'running', 5))
+        self.assertNotEqual(main.jobs[job_id].agent_id, agent.agent_id)
+        master.kill_job(job_id)
+
+
+class TestUsageAwarePlacement(unittest.TestCase):
+    def tearDown(self):
+        for agent in host.agents:
+            agent.__dict__.pop('usage', None)
+
+    def test_parked_job_runs_once_measured_use_drops(self):
+        for agent in host.agents:
+            agent.usage = lambda: (100.0, 100.0)
+        self.assertTrue(wait_for(lambda: all(main.scheduler.agents[agent.agent_id]['free_cpu'] == 0 for agent in host.agents), 5))
+        job_id = master.submit_job(dict(JOB_DICT))
+        time.sleep(1)
+        self.assertEqual(master.get_status(job_id), 'pending')
+        for agent in host.agents:
+            del agent.usage
+        # no job finishes or agent joins, only the heartbeats report less use
+        self.assertTrue(wait_for(lambda: master.get_status(job_id) == 'running', 5))
+        master.kill_job(job_id)
+
+    def test_job_usage(self):
+        job_id = master.submit_job(dict(JOB_DICT))
+        self.assertTrue(wait_for(lambda: master.get_status(job_id) == 'running', 5))
+        self.assertTrue(wait_for(lambda: job_id in main.agents[main.jobs[job_id].agent_id]['job_usage'], 5))
+        self.assertEqual(master.get_job_usage(job_id)['cpu'], 100.0 * JOB_DICT['resource_limit']['cpu'])
+        master.kill_job(job_id)
+        self.assertTrue(wait_for(lambda: master.get_status(job_id) == 'fail', 5))
+        with self.assertRaises(xmlrpc.client.Fault):
+            master.get_job_usage(job_id)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+import random
+import unittest
+import scheduler
+from scheduler import Scheduler, SortedIndex
+
+# usage (from master/): python -m pytest -q test_scheduler.py
+
+REQUIREMENT = {'cpu': 2, 'memory': 4}
+
+
+def new_scheduler(policy):
+    # a: 8 cpu / 16 memory, b: 16 / 32, c: 4 / 8
+    sched = Scheduler(policy)
+    sched.add_agent('a', 8, 16)
+    sched.add_agent('b', 16, 32)
+    sched.add_agent('c', 4, 8)
+    return sched
+
+
+class TestSortedIndex(unittest.TestCase):
+    def test_matches_a_sorted_list(self):
+        random.seed(7)
+        index = SortedIndex()
+        keys = []
+        for i in range(5 * scheduler.INDEX_BUCKET_SIZE):
+            key = (random.randint(0, 64), random.randint(0, 128), 'agent-%d' % i)
+            index.add(key)
+            keys.append(key)
+            if random.random() < 0.3:
+                key = keys.pop(random.randrange(len(keys)))
+                index.discard(key)
+        keys.sort()
+        self.assertEqual(list(index), keys)
+        self.assertEqual(list(reversed(index)), keys[::-1])
+        self.assertEqual(len(index), len(keys))
+        self.assertEqual(list(index.irange((32, 64))), [key for key in keys if key >= (32, 64)])
+        self.assertGreater(len(index.buckets), 1)
+
+    def test_discard_of_a_missing_key(self):
+        index = SortedIndex()
+        index.discard((1, 1, 'a'))
+        index.add((1, 1, 'a'))
+        index.discard((2, 2, 'a'))
+        index.discard((0, 0, 'a'))
+        self.assertEqual(list(index), [(1, 1, 'a')])
+
+
+class TestPolicies(unittest.TestCase):
+    def test_least_loaded(self):
+        sched = new_scheduler('least_loaded')
+        self.assertEqual(sched.reserve('j1', REQUIREMENT), 'b')
+
+    def test_bin_packing(self):
+        sched = new_scheduler('bin_packing')
+        self.assertEqual(sched.reserve('j1', REQUIREMENT), 'c')
+        self.assertEqual(sched.reserve('j2', REQUIREMENT), 'c')
+        # c is full
+        self.assertEqual(sched.reserve('j3', REQUIREMENT), 'a')
+
+    def test_spread(self):
+        sched = new_scheduler('spread')
+        placed = [sched.reserve('j%d' % i, REQUIREMENT) for i in range(3)]
+        self.assertEqual(sorted(placed), ['a', 'b', 'c'])
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            Scheduler('round_robin')
+
+
+class TestReservations(unittest.TestCase):
+    def test_no_overcommit(self):
+        sched = new_scheduler('least_loaded')
+        placed = [sched.reserve('j%d' % i, REQUIREMENT) for i in range(20)]
+        self.assertEqual(placed.count(None), 6)
+        self.assertEqual(placed.count('a'), 4)
+        self.assertEqual(placed.count('b'), 8)
+        self.assertEqual(placed.count('c'), 2)
+        self.assertEqual(sched.release('j0'), placed[0])
+        self.assertEqual(sched.reserve('j20', REQUIREMENT), placed[0])
+
+    def test_reserve_is_idempotent(self):
+        sched = new_scheduler('least_loaded')
+        agent_id = sched.reserve('j1', REQUIREMENT)
+        self.assertEqual(sched.reserve('j1', REQUIREMENT), agent_id)
+        self.assertEqual(sched.agents[agent_id]['job_count'], 1)
+        self.assertEqual(sched.reserve_many([('j1', REQUIREMENT, None), ('j2', REQUIREMENT, None)]), [agent_id, 'b'])
+        self.assertIsNone(sched.release('j3'))
+
+    def test_reserve_on_ignores_free_capacity(self):
+        sched = new_scheduler('least_loaded')
+        sched.reserve_on('j1', 'c', {'cpu': 6, 'memory': 1})
+        self.assertEqual(sched.reserved_agent('j1'), 'c')
+        self.assertEqual(sched.agents['c']['free_cpu'], -2)
+        self.assertIsNone(sched.reserve('j2', {'cpu': 1, 'memory': 1}, exclude=('a', 'b')))
+
+    def test_unschedulable_and_removed_agents(self):
+        sched = new_scheduler('least_loaded')
+        sched.reserve_on('j1', 'b', REQUIREMENT)
+        sched.set_schedulable('b', False)
+        self.assertEqual(sched.reserve('j2', REQUIREMENT), 'a')
+        self.assertEqual(sched.remove_agent('b'), ['j1'])
+        self.assertIsNone(sched.reserved_agent('j1'))
+        self.assertEqual(sched.release('j2'), 'a')
+
+
+class TestUsage(unittest.TestCase):
+    def test_measured_use_above_reservations(self):
+        sched = new_scheduler('least_loaded')
+        self.assertFalse(sched.set_agent_usage('b', 15, 4))
+        self.assertEqual(sched.reserve('j1', REQUIREMENT), 'a')
+        # free capacity grows again once the agent measures less use
+        self.assertTrue(sched.set_agent_usage('b', 1, 4))
+        self.assertEqual(sched.reserve('j2', REQUIREMENT), 'b')
+        self.assertFalse(sched.set_agent_usage('unknown', 1, 1))
+
+
+class TestImageLocality(unittest.TestCase):
+    def test_holders_first(self):
+        sched = new_scheduler('least_loaded')
+        sched.set_agent_images('c', ['ubuntu'])
+        self.assertEqual(sched.reserve('j1', REQUIREMENT, image='ubuntu:latest'), 'c')
+        self.assertEqual(sched.reserve('j2', REQUIREMENT, image='ubuntu'), 'c')
+        # the holder is full, any agent then
+        self.assertEqual(sched.reserve('j3', REQUIREMENT, image='ubuntu'), 'b')
+        self.assertEqual(sched.locality_stats, {'local': 2, 'remote': 1})
+
+    def test_without_locality(self):
+        sched = Scheduler('least_loaded', image_locality=False)
+        sched.add_agent('a', 8, 16)
+        sched.add_agent('b', 16, 32)
+        sched.add_agent_images('a', ['ubuntu:22.04'])
+        self.assertEqual(sched.reserve('j1', REQUIREMENT, image='ubuntu:22.04'), 'b')
+
+    def test_normalize_image(self):
+        self.assertEqual(scheduler.normalize_image('ubuntu'), 'ubuntu:latest')
+        self.assertEqual(scheduler.normalize_image('localhost:5000/ubuntu'), 'localhost:5000/ubuntu:latest')
+        self.assertEqual(scheduler.normalize_image('ubuntu@sha256:ab'), 'ubuntu@sha256:ab')
+
+
+if __name__ == '__main__':
+    unittest.main()
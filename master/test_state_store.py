@@ -0,0 +1,104 @@
+import os
+import shutil
+import tempfile
+import unittest
+from state_store import StateStore
+
+# usage (from master/): python -m pytest -q test_state_store.py
+
+
+class FailingFile:
+    # wraps a wal segment, the first write puts half of the data on disk and then fails
+    def __init__(self, wal_file):
+        self.wal_file = wal_file
+        self.failed = False
+
+    def write(self, data):
+        if not self.failed:
+            self.failed = True
+            self.wal_file.write(data[:len(data) // 2])
+            raise OSError(28, 'No space left on device')
+        return self.wal_file.write(data)
+
+    def fileno(self):
+        return self.wal_file.fileno()
+
+    def close(self):
+        self.wal_file.close()
+
+
+class TestStateStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = StateStore(self.directory)
+        self.store.recover()
+
+    def tearDown(self):
+        if self.store.wal_file is not None:
+            self.store.wal_file.close()
+        shutil.rmtree(self.directory)
+
+    def reopen(self):
+        self.store.wal_file.close()
+        self.store = StateStore(self.directory)
+        return self.store.recover()
+
+    def test_replay(self):
+        self.store.log_job('j1', {'status': 'pending', 'agent_id': None})
+        self.store.log_agent('a1', {'status': 'alive', 'cpu': 4})
+        self.store.log_job('j1', {'status': 'running', 'agent_id': 'a1'})
+        self.store.log_job('j2', {'status': 'pending'})
+        seq = self.store.log_job_deleted('j2')
+        self.store.commit()
+        self.assertTrue(self.store.wait_durable(seq, 0))
+        jobs, agents, arrays = self.reopen()
+        self.assertEqual(jobs, {'j1': {'status': 'running', 'agent_id': 'a1'}})
+        self.assertEqual(agents, {'a1': {'status': 'alive', 'cpu': 4}})
+        self.assertEqual(arrays, {})
+
+    def test_snapshot_covers_older_segments(self):
+        self.store.log_job('j1', {'status': 'pending'})
+        self.store.log_array('r1', {'size': 3})
+        self.store.snapshot(lambda: ({'j1': {'status': 'pending'}}, {}, {'r1': {'size': 3}}))
+        self.store.log_job('j1', {'status': 'running'})
+        self.store.commit()
+        self.assertEqual(self.store.list_segments(), [self.store.segment])
+        jobs, agents, arrays = self.reopen()
+        self.assertEqual(jobs, {'j1': {'status': 'running'}})
+        self.assertEqual(arrays, {'r1': {'size': 3}})
+
+    def test_torn_last_line_is_dropped(self):
+        self.store.log_job('j1', {'status': 'pending'})
+        self.store.commit()
+        self.store.wal_file.write(b'{"kind":"job","id":"j1","fie')
+        jobs, agents, arrays = self.reopen()
+        self.assertEqual(jobs, {'j1': {'status': 'pending'}})
+
+    def test_corrupt_line_before_the_end_raises(self):
+        self.store.log_job('j1', {'status': 'pending'})
+        self.store.commit()
+        self.store.wal_file.write(b'{"kind":"job","id":"j1","fie\n')
+        self.store.log_job('j1', {'status': 'running'})
+        self.store.commit()
+        with self.assertRaises(ValueError):
+            self.reopen()
+
+    def test_failed_commit_keeps_the_batch(self):
+        self.store.log_job('j1', {'status': 'pending'})
+        self.store.commit()
+        self.store.wal_file = FailingFile(self.store.wal_file)
+        seq = self.store.log_job('j2', {'status': 'pending'})
+        with self.assertRaises(OSError):
+            self.store.commit()
+        self.assertFalse(self.store.wait_durable(seq, 0))
+        self.assertEqual(self.store.get_stats()['pending'], 1)
+        # a later record is not reported durable either while the failed one is not on disk
+        later_seq = self.store.log_job('j3', {'status': 'pending'})
+        self.store.commit()
+        self.assertTrue(self.store.wait_durable(later_seq, 0))
+        jobs, agents, arrays = self.reopen()
+        self.assertEqual(sorted(jobs), ['j1', 'j2', 'j3'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import os
+import time
+import uuid
+import argparse
+import xmlrpc.client
+from threading import Thread
+import msgpack_rpc
+from rpc_server import PooledXMLRPCServer
+
+# Compares xml-rpc with msgpack frames on the two heaviest payloads, a heartbeat reply and a log chunk:
+# bytes on the wire and encode+decode time per message, then round trip latency against local servers.
+# usage: python transport_bench.py [--jobs 200] [--chunk 1048576] [--rounds 200]
+
+
+def heartbeat_reply(job_count):
+    job_attrs_list = [{'job_id': str(uuid.uuid4()), 'status': 'running', 'restart_count': 0} for i in range(job_count)]
+    job_usage = {job_attrs['job_id']: {'cpu': 12.5, 'memory': 3.25, 'cpu_peak': 40.0, 'memory_peak': 4.5} for job_attrs in job_attrs_list}
+    return {'cpu_usage': 42.0, 'memory_usage': 61.5, 'cpu_peak': 80.0, 'memory_peak': 70.0,
+            'job_usage': job_usage, 'job_attrs_list': job_attrs_list, 'epoch': str(uuid.uuid4()), 'seq': 123456, 'full': False}
+
+
+def log_chunk(chunk_size):
+    return {'data': xmlrpc.client.Binary(os.urandom(chunk_size)), 'offset': chunk_size, 'complete': False}
+
+
+def xmlrpc_codec(value):
+    body = xmlrpc.client.dumps((value,), methodresponse=True, allow_none=True)
+    xmlrpc.client.loads(body)
+    return len(body)
+
+
+def msgpack_codec(value):
+    body = msgpack_rpc.pack([None, value])
+    msgpack_rpc.unpack(body)
+    return len(body)
+
+
+def bench_codec(codec, value, rounds):
+    start = time.perf_counter()
+    for i in range(rounds):
+        size = codec(value)
+    return size, (time.perf_counter() - start) / rounds
+
+
+def start_servers(payloads, xmlrpc_port, msgpack_port):
+    xmlrpc_server = PooledXMLRPCServer(('localhost', xmlrpc_port), 4, 60, 5, allow_none=True, logRequests=False)
+    msgpack_server = msgpack_rpc.MsgpackRPCServer(('localhost', msgpack_port), 5)
+    for server in [xmlrpc_server, msgpack_server]:
+        for name, value in payloads.items():
+            server.register_function(lambda value=value: value, name)
+        server_thread = Thread(target=server.serve_forever)
+        server_thread.setDaemon(True)
+        server_thread.start()
+    return xmlrpc_server, msgpack_server
+
+
+def bench_round_trip(proxy, name, rounds):
+    getattr(proxy, name)()
+    start = time.perf_counter()
+    for i in range(rounds):
+        getattr(proxy, name)()
+    return (time.perf_counter() - start) / rounds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='xml-rpc vs msgpack transport benchmark')
+    parser.add_argument('--jobs', default=200, type=int, help='jobs in the heartbeat reply')
+    parser.add_argument('--chunk', default=1024 * 1024, type=int, help='bytes per log chunk')
+    parser.add_argument('--rounds', default=200, type=int)
+    args = parser.parse_args()
+    if not msgpack_rpc.available:
+        print('msgpack is not installed')
+        quit()
+    payloads = {'heartbeat': heartbeat_reply(args.jobs), 'log_chunk': log_chunk(args.chunk)}
+    print('%-10s %-8s %12s %14s' % ('payload', 'codec', 'bytes', 'encode+decode'))
+    for name, value in payloads.items():
+        for codec_name, codec in [('xmlrpc', xmlrpc_codec), ('msgpack', msgpack_codec)]:
+            size, duration = bench_codec(codec, value, args.rounds)
+            print('%-10s %-8s %12d %11.3f ms' % (name, codec_name, size, duration * 1000))
+    xmlrpc_server, msgpack_server = start_servers(payloads, 8897, 8898)
+    print('%-10s %-8s %12s' % ('payload', 'codec', 'round trip'))
+    with xmlrpc.client.ServerProxy('http://localhost:8897') as xmlrpc_proxy, msgpack_rpc.MsgpackServerProxy('localhost', 8898) as msgpack_proxy:
+        for name in payloads:
+            for codec_name, proxy in [('xmlrpc', xmlrpc_proxy), ('msgpack', msgpack_proxy)]:
+                print('%-10s %-8s %9.3f ms' % (name, codec_name, bench_round_trip(proxy, name, args.rounds) * 1000))
+    xmlrpc_server.shutdown()
+    msgpack_server.shutdown()